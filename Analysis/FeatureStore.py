@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import json
+import argparse
+import numpy
+
+'''
+Binary columnar store of the wavelet features, replacing the CSV file between the feature extraction
+(WaveletFeatures.py, MainScript.py) and the ROC analysis (ToothFractureROCAnalysis.py).
+
+A store is a directory (named <name>.features) with one file per column and a JSON schema:
+- schema.json: the names and types of the columns and the number of rows
+- column<i>.f4, column<i>.f8: the values of a numeric column, raw little-endian float32 or float64
+- column<i>.txt: the values of a text column (case name, wavelet directory, classification), one per line
+The type of a numeric column is the type of its values in the first row: 'float32', 'float64' (numpy) or 'float'
+(Python, stored as float64), so that exportCSV() writes the same text as str(value) in the CSV files. Numbers given
+as text (e.g. the rows of ToothFractureRoutines.simulateFractureAndCreateWavelets, str() of the values) are stored
+as float64 in 'decimal' columns and exported with repr(), which gives back that text.
+
+Rows are appended as the features of each case are computed (see FeatureStoreWriter). They are buffered and written in
+blocks of blockRows rows (and by flush() and close()), so that each column file is opened once per block: the values
+of the block are appended to the column files, then the number of rows of the schema is updated, so that an
+interrupted write is ignored (and overwritten by the next one). A column is loaded (memory mapped) without reading the
+other ones.
+
+    FeatureStore.py store.features output.csv
+exports a store to a CSV file.
+'''
+
+extension = '.features'
+schemaFileName = 'schema.json'
+# Number of rows appended to the column files at once
+defaultBlockRows = 64
+numericTypes = {'float32': '<f4', 'float64': '<f8', 'float': '<f8', 'decimal': '<f8'}
+fileExtensions = {'float32': '.f4', 'float64': '.f8', 'float': '.f8', 'decimal': '.f8', 'text': '.txt'}
+
+
+def isFeatureStore(path):
+    return path.endswith(extension) or os.path.exists(os.path.join(path, schemaFileName))
+
+
+def valueType(value, numeric=False):
+    '''
+    Column type of a value of the first row. If numeric is True, a string is a number ('decimal').
+    '''
+    if isinstance(value, basestring):
+        return 'decimal' if numeric else 'text'
+    if isinstance(value, numpy.floating):
+        return 'float32' if value.dtype == numpy.float32 else 'float64'
+    return 'float'
+
+
+def formatValue(value, columnType):
+    '''
+    str() of value as it was given to FeatureStore.append()
+    '''
+    if columnType == 'float':
+        return str(float(value))
+    if columnType == 'decimal':
+        return repr(float(value))
+    return str(value)
+
+
+class FeatureStore(object):
+    '''
+    Opens the store path or, if names is given, creates an empty store with these columns (their types are set by the
+    first row), replacing the columns of an existing store. The appended rows are written blockRows at a time.
+    '''
+    def __init__(self, path, names=None, blockRows=defaultBlockRows):
+        self.path = path
+        self.blockRows = blockRows
+        # Appended rows not written yet
+        self.pending = []
+        if names is None:
+            with open(os.path.join(path, schemaFileName), 'r') as f:
+                schema = json.load(f)
+            self.names = [str(name) for name in schema['names']]
+            self.types = schema['types']
+            self.rows = schema['rows']
+            return
+        if os.path.exists(os.path.join(path, schemaFileName)):
+            FeatureStore(path).removeColumnFiles()
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        self.names = list(names)
+        self.types = None
+        self.rows = 0
+        self.save()
+
+    def columnFileName(self, index):
+        return os.path.join(self.path, 'column' + str(index) + fileExtensions[self.types[index]])
+
+    def removeColumnFiles(self):
+        if self.types is not None:
+            for index in range(0, len(self.names)):
+                if os.path.exists(self.columnFileName(index)):
+                    os.remove(self.columnFileName(index))
+
+    def save(self):
+        temporaryPath = os.path.join(self.path, schemaFileName + '.tmp')
+        with open(temporaryPath, 'w') as f:
+            json.dump({'names': self.names, 'types': self.types, 'rows': self.rows}, f, indent=1)
+        os.rename(temporaryPath, os.path.join(self.path, schemaFileName))
+
+    def truncate(self):
+        '''
+        Removes the values of an interrupted append from the column files
+        '''
+        if self.types is None:
+            return
+        for index, columnType in enumerate(self.types):
+            fileName = self.columnFileName(index)
+            if columnType == 'text':
+                with open(fileName, 'r') as f:
+                    lines = f.readlines()
+                if len(lines) != self.rows:
+                    with open(fileName, 'w') as f:
+                        f.writelines(lines[:self.rows])
+            elif os.path.getsize(fileName) != self.rows * numpy.dtype(numericTypes[columnType]).itemsize:
+                with open(fileName, 'r+b') as f:
+                    f.truncate(self.rows * numpy.dtype(numericTypes[columnType]).itemsize)
+
+    def append(self, row, numericColumns=()):
+        '''
+        Appends a row (one value per column: strings for the text columns, numbers for the others). The strings of the
+        numericColumns (indices) are numbers. The row is written with the next block (see flush()).
+        '''
+        if len(row) != len(self.names):
+            raise ValueError('%d values for the %d columns of %s' % (len(row), len(self.names), self.path))
+        if self.types is None:
+            numericColumns = set(numericColumns)
+            self.types = [valueType(value, index in numericColumns) for index, value in enumerate(row)]
+            for index in range(0, len(self.names)):
+                open(self.columnFileName(index), 'wb').close()
+        for index, (value, columnType) in enumerate(zip(row, self.types)):
+            if columnType == 'text' and '\n' in value:
+                raise ValueError('Line break in the value of column ' + self.names[index])
+        self.pending.append(list(row))
+        if len(self.pending) >= self.blockRows:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the appended rows: each column file is opened once for all of them
+        '''
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            for index, columnType in enumerate(self.types):
+                values = [row[index] for row in rows]
+                with open(self.columnFileName(index), 'ab') as f:
+                    if columnType == 'text':
+                        f.write(''.join(value + '\n' for value in values))
+                    else:
+                        if columnType == 'decimal':
+                            values = [float(value) for value in values]
+                        f.write(numpy.array(values, dtype=numericTypes[columnType]).tostring())
+        except BaseException:
+            self.truncate()
+            raise
+        self.rows += len(rows)
+        self.save()
+
+    def close(self):
+        self.flush()
+
+    def column(self, name):
+        '''
+        Values of the column name: a read-only memory map for the numeric columns, an array of strings for the text
+        columns
+        '''
+        index = self.names.index(name)
+        self.flush()
+        if self.rows == 0:
+            return numpy.empty(0)
+        if self.types[index] == 'text':
+            with open(self.columnFileName(index), 'r') as f:
+                return numpy.array([f.readline()[:-1] for row in range(0, self.rows)])
+        return numpy.memmap(self.columnFileName(index), dtype=numericTypes[self.types[index]], mode='r',
+                            shape=(self.rows,))
+
+    def exportCSV(self, csvFileName):
+        '''
+        Writes the store to a CSV file, with the same text as the CSV files of WaveletFeatures.FeatureCSVWriter
+        '''
+        columns = [self.column(name) for name in self.names]
+        with open(csvFileName, 'w') as csvFile:
+            csvWriter = csv.writer(csvFile, delimiter=',')
+            csvWriter.writerow(self.names)
+            types = self.types or []
+            for row in range(0, self.rows):
+                csvWriter.writerow([value if columnType == 'text' else formatValue(value, columnType)
+                                    for value, columnType in zip([column[row] for column in columns], types)])
+
+
+class FeatureStoreWriter(object):
+    '''
+    Same interface as WaveletFeatures.FeatureCSVWriter: appends one row of wavelet features per (case, wavelet
+    directory) to a feature store. If append is True, an existing store with the same columns is appended to.
+    '''
+    def __init__(self, storePath, waveletRange, statistics, append=True):
+        self.statistics = statistics
+        names = ['Case Name', 'FractureNumber', 'Classification'] + statistics.names(waveletRange)
+        if append and os.path.exists(os.path.join(storePath, schemaFileName)):
+            self.store = FeatureStore(storePath)
+            if self.store.names != names:
+                raise ValueError('%s exists with different columns' % storePath)
+            self.store.truncate()
+        else:
+            self.store = FeatureStore(storePath, names)
+        self.numericColumns = set(range(3, len(names)))
+
+    def writeRow(self, caseName, waveletDirectory, classification, values):
+        self.store.append([caseName, waveletDirectory, classification] + list(values),
+                          numericColumns=self.numericColumns)
+
+    def close(self):
+        self.store.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description='Exports a feature store to a CSV file')
+    parser.add_argument('storePath')
+    parser.add_argument('csvFileName')
+    args = parser.parse_args(argv[1:])
+    FeatureStore(args.storePath).exportCSV(args.csvFileName)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import itertools
+import multiprocessing
+import numpy
+from sklearn.externals import joblib
+from NrrdIO import readNrrd, readNrrdHeader, createNrrd
+from WaveletFeatures import nrrdGeometry, continuousIndex, waveletRange
+
+'''
+Voxel-wise fracture probability map computed with a classifier trained on the wavelet features (e.g. the
+BlaggingClassifier saved by ToothFractureROCAnalysis.py --saveClassifier).
+
+The feature vector of a voxel is |wavelet<n>| at that voxel for each requested wavelet band, in the order of the
+columns the classifier was trained on (wavelet0 ... wavelet15 by default). The bands of the coarser levels are
+resampled (linear interpolation) on the reference grid: wavelet0 (the grid of the analyzed image) by default.
+The output is a float NRRD image of the probability of the positive class (1), with the geometry of the reference
+grid.
+
+The map is a score, not a calibrated probability: the classifier is trained on one feature vector per volume (the
+max, or a percentile, of |wavelet| over the whole tooth), and is applied here to the |wavelet| values of single
+voxels, which come from another distribution (most voxels are far below the max of their volume). The map shows
+where the voxels look like the fractured volumes, and can be compared between voxels and images of the same run,
+but its values are not the probability that a voxel is on a fracture.
+
+The reference grid is processed in slabs of slices: each slab only reads the part of the (memory mapped) wavelet
+images it needs, its features are stored in a buffer reused by the next slabs, and predict_proba is called on
+chunks of chunkSize voxels. The slabs are distributed to a pool of worker processes and written to the memory
+mapped output as they come back, so that the memory used does not depend on the size of the image.
+
+    FractureProbabilityMap.py classifierFile waveletDirectory outputFileName [--wavelets 0,...,15]
+                              [--prefix wavelet] [--reference image.nrrd] [--chunkSize voxels] [--jobs n]
+'''
+
+defaultChunkSize = 2**16
+defaultSlabChunks = 8
+
+
+def sampleLinear(array, index):
+    '''
+    Linear interpolation of array ([k, j, i]) at the continuous index (i, j, k) (see WaveletFeatures.continuousIndex),
+    clamped at the image boundary.
+    '''
+    base = []
+    weights = []
+    sizes = []
+    for axis in range(0, 3):
+        size = array.shape[2 - axis]
+        position = numpy.clip(index[axis], 0, size - 1)
+        axisBase = numpy.minimum(numpy.floor(position).astype(numpy.int64), max(size - 2, 0))
+        base.append(axisBase)
+        weights.append(position - axisBase)
+        sizes.append(size)
+    result = 0.0
+    for corner in itertools.product((0, 1), repeat=3):
+        weight = 1.0
+        cornerIndex = []
+        for axis in range(0, 3):
+            weight = weight * (weights[axis] if corner[axis] else 1.0 - weights[axis])
+            cornerIndex.append(numpy.minimum(base[axis] + corner[axis], sizes[axis] - 1))
+        result = result + weight * array[cornerIndex[2], cornerIndex[1], cornerIndex[0]]
+    return result
+
+
+def loadClassifier(classifierFileName, numberOfWavelets):
+    '''
+    Loads the classifier, checking that it uses one feature per wavelet
+    '''
+    classifier = joblib.load(classifierFileName)
+    numberOfFeatures = getattr(classifier, 'n_features_', numberOfWavelets)
+    if numberOfFeatures != numberOfWavelets:
+        raise ValueError('The classifier uses %d features, %d wavelets given' % (numberOfFeatures, numberOfWavelets))
+    return classifier
+
+
+def checkInputs(classifierFileName, waveletFileNames):
+    '''
+    Checks the classifier and reads the geometry of the wavelets (headers only), so that errors (e.g. a missing file)
+    are reported before the worker processes are started
+    '''
+    loadClassifier(classifierFileName, len(waveletFileNames))
+    for fileName in waveletFileNames:
+        nrrdGeometry(readNrrdHeader(fileName))
+
+
+class ProbabilityMapper(object):
+    '''
+    Computes the fracture probability of slabs [first, last[ of the slices of the reference grid geometry.
+    '''
+    def __init__(self, classifierFileName, waveletFileNames, geometry, chunkSize=defaultChunkSize):
+        self.classifier = loadClassifier(classifierFileName, len(waveletFileNames))
+        self.positiveColumn = list(self.classifier.classes_).index(1)
+        self.wavelets = []
+        for fileName in waveletFileNames:
+            waveletArray, header = readNrrd(fileName)
+            self.wavelets.append((waveletArray, nrrdGeometry(header)))
+        self.geometry = geometry
+        self.chunkSize = chunkSize
+        self.features = numpy.empty((0, len(waveletFileNames)))
+
+    def __call__(self, slab):
+        first, last = slab
+        slabShape = (last - first,) + self.geometry.shape[1:]
+        count = int(numpy.prod(slabShape))
+        if self.features.shape[0] < count:
+            self.features = numpy.empty((count, len(self.wavelets)))
+        features = self.features[:count]
+        for column, (waveletArray, waveletGeometry) in enumerate(self.wavelets):
+            if waveletGeometry.key() == self.geometry.key():
+                values = waveletArray[first:last]
+            else:
+                values = sampleLinear(waveletArray, continuousIndex(waveletGeometry, self.geometry, first, last))
+            numpy.abs(numpy.broadcast_to(values, slabShape).reshape(-1), out=features[:, column])
+        probabilities = numpy.empty(count, dtype=numpy.float32)
+        for start in range(0, count, self.chunkSize):
+            chunk = features[start:start + self.chunkSize]
+            probabilities[start:start + len(chunk)] = self.classifier.predict_proba(chunk)[:, self.positiveColumn]
+        return first, probabilities.reshape(slabShape)
+
+
+# Mapper of each worker process
+workerMapper = None
+
+
+def initializeWorker(classifierFileName, waveletFileNames, geometry, chunkSize):
+    global workerMapper
+    workerMapper = ProbabilityMapper(classifierFileName, waveletFileNames, geometry, chunkSize)
+
+
+def mapSlab(slab):
+    return workerMapper(slab)
+
+
+def slabs(geometry, slabSize):
+    '''
+    Ranges of slices of about slabSize voxels (at least one slice)
+    '''
+    sliceSize = int(numpy.prod(geometry.shape[1:]))
+    slices = max(1, slabSize // max(1, sliceSize))
+    return [(first, min(geometry.shape[0], first + slices)) for first in range(0, geometry.shape[0], slices)]
+
+
+def probabilityMap(classifierFileName, waveletFileNames, referenceFileName, outputFileName,
+                   chunkSize=defaultChunkSize, jobs=1):
+    '''
+    Writes the fracture probability map of the wavelets waveletFileNames on the grid of referenceFileName to
+    outputFileName, with jobs worker processes.
+    '''
+    geometry = nrrdGeometry(readNrrdHeader(referenceFileName))
+    output = createNrrd(outputFileName, geometry.shape, numpy.float32, geometry.origin, geometry.spacing,
+                        geometry.direction)
+    tasks = slabs(geometry, defaultSlabChunks * chunkSize)
+    print 'Computing the fracture probability of %d voxels in %d slabs' % (int(numpy.prod(geometry.shape)),
+                                                                           len(tasks))
+    initializerArguments = (classifierFileName, waveletFileNames, geometry, chunkSize)
+    if jobs == 1:
+        mapper = ProbabilityMapper(*initializerArguments)
+        results = (mapper(slab) for slab in tasks)
+    else:
+        # The workers load the classifier and the wavelets, the inputs are only checked here
+        checkInputs(classifierFileName, waveletFileNames)
+        pool = multiprocessing.Pool(jobs, initializeWorker, initializerArguments)
+        results = pool.imap_unordered(mapSlab, tasks)
+    try:
+        for first, probabilities in results:
+            output[first:first + probabilities.shape[0]] = probabilities
+    except BaseException:
+        if jobs != 1:
+            pool.terminate()
+            pool.join()
+        raise
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    output.flush()
+    del output
+
+
+def parseWavelets(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+                                     description='Voxel-wise fracture probability map. The classifier is trained on '
+                                                 'per-volume features (max or percentile of |wavelet|): applied to '
+                                                 'single voxels, its output is a relative score, not a calibrated '
+                                                 'probability.')
+    parser.add_argument('classifierFile', help='classifier saved by ToothFractureROCAnalysis.py --saveClassifier')
+    parser.add_argument('waveletDirectory')
+    parser.add_argument('outputFileName')
+    parser.add_argument('--wavelets', type=parseWavelets, default=list(waveletRange),
+                        help='comma separated wavelet numbers, in the order of the classifier features')
+    parser.add_argument('--prefix', default='wavelet', help='prefix of the wavelet images')
+    parser.add_argument('--reference', default=None,
+                        help='image whose grid the map is computed on (default: the first wavelet)')
+    parser.add_argument('--chunkSize', type=int, default=defaultChunkSize,
+                        help='number of voxels sent to the classifier at once')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    args = parser.parse_args(argv[1:])
+    waveletFileNames = [os.path.join(args.waveletDirectory, args.prefix + str(waveletNumber) + '.nrrd')
+                        for waveletNumber in args.wavelets]
+    referenceFileName = args.reference if args.reference is not None else waveletFileNames[0]
+    probabilityMap(args.classifierFile, waveletFileNames, referenceFileName, args.outputFileName, args.chunkSize,
+                   args.jobs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
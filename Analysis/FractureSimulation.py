@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import numpy
+import itk
+
+'''
+Fracture simulation of ToothFractureSimulation.cxx computed in the Python process with whole-array NumPy operations.
+
+The resampling, the label statistics and the noise image are computed by the same ITK filters as the command line
+tool, once per case (FractureSimulator). Each fracture then replaces the per-voxel loop of the tool by array
+operations over slabs of slices:
+- the physical point of every voxel is computed from the index-to-physical matrix of the image (obtained once),
+- the tooth voxels closer to the plane than the fracture size are filled with the noise image,
+- the other voxels are displaced away from the plane, and the label of the voxel becomes tooth if the displaced
+  point is in the tooth (TransformPhysicalPointToIndex + GetPixel in the tool).
+The arithmetic follows the order of the ITK computations in double precision (the displacement vector is a float
+vector in the tool), so for the same noise seed the fractured image and label are identical to the ones written by
+ToothFractureSimulation built with the same ITK version. Displaced points outside of the image are not in the tooth
+(the tool reads outside of the buffer there).
+The noise filter is seeded with the noise seed (0 by default, as in the tool), so the noise is the same on every run.
+Left unseeded (None), ITK seeds it with the time.
+
+The fractured images are ITK images, passed in memory to the wavelet analysis: sweeping many planes of a case spawns
+no process and writes no file.
+    FractureSimulation.py input reference label outputImage outputLabel a b c d displacement [seed]
+'''
+
+PixelType = itk.SS
+LabelPixelType = itk.UC
+ImageType = itk.Image[PixelType, 3]
+LabelImageType = itk.Image[LabelPixelType, 3]
+NoiseImageType = itk.Image[itk.F, 3]
+
+darkLabel = 2
+toothLabel = 1
+standardDeviationCorrectionFactor = 5
+# Number of slices processed at once: bounds the memory of the per-voxel arrays
+defaultSlabSize = 16
+
+
+def indexTransforms(image):
+    '''
+    Returns (origin, indexToPhysicalPoint, physicalPointToIndex) of image as float64 NumPy arrays: the matrices ITK
+    uses in TransformIndexToPhysicalPoint and TransformPhysicalPointToIndex. They are not wrapped in Python, so their
+    columns are read back from the continuous index transforms of an image with the same spacing and direction and
+    a null origin (the products by 1 and 0 are exact).
+    '''
+    probe = itk.Image[itk.UC, 3].New()
+    probe.SetSpacing(image.GetSpacing())
+    probe.SetDirection(image.GetDirection())
+    indexToPhysicalPoint = numpy.zeros((3, 3))
+    physicalPointToIndex = numpy.zeros((3, 3))
+    for axis in range(0, 3):
+        unitIndex = itk.ContinuousIndex[itk.D, 3]()
+        unitIndex.Fill(0)
+        unitIndex.SetElement(axis, 1.0)
+        indexToPhysicalPoint[:, axis] = list(probe.TransformContinuousIndexToPhysicalPoint(unitIndex))
+        unitPoint = [0.0, 0.0, 0.0]
+        unitPoint[axis] = 1.0
+        physicalPointToIndex[:, axis] = list(probe.TransformPhysicalPointToContinuousIndex(unitPoint))
+    return numpy.array(list(image.GetOrigin()), dtype=numpy.float64), indexToPhysicalPoint, physicalPointToIndex
+
+
+def resampleImage(image, referenceImage, interpolator=None):
+    '''
+    Resamples image on the grid of referenceImage (linear interpolation by default). Returns the disconnected output.
+    '''
+    imageType = type(image)
+    resample = itk.ResampleImageFilter[imageType, imageType].New()
+    resample.SetInput(image)
+    if interpolator is not None:
+        resample.SetInterpolator(interpolator)
+    resample.SetReferenceImage(referenceImage)
+    resample.UseReferenceImageOn()
+    resample.Update()
+    output = resample.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def resampledImages(inputImage, referenceImage, labelImage):
+    '''
+    Resamples the grayscale image (linear) and the label map (nearest neighbor) on the grid of referenceImage, like
+    ToothFractureSimulation
+    '''
+    resampled = resampleImage(inputImage, referenceImage)
+    labelResampled = resampleImage(labelImage, referenceImage,
+                                   itk.NearestNeighborInterpolateImageFunction[LabelImageType, itk.D].New())
+    return resampled, labelResampled
+
+
+def noiseImage(resampled, labelResampled, noiseSeed=None):
+    '''
+    Gaussian noise image with the mean and standard deviation (divided by standardDeviationCorrectionFactor) of the
+    dark label, clamped to the pixel type, as in ToothFractureSimulation. noiseSeed: seed of the noise filter, None
+    for the ITK default (the time, different noise on every run). The noise is generated on a single thread, so that
+    a seed gives the same noise whatever the number of threads.
+    '''
+    statisticsFilter = itk.LabelStatisticsImageFilter[ImageType, LabelImageType].New()
+    statisticsFilter.SetInput(resampled)
+    statisticsFilter.SetLabelInput(labelResampled)
+    statisticsFilter.Update()
+    # Converted to the pixel type (truncated) like in the tool
+    mean = int(statisticsFilter.GetMean(darkLabel))
+    std = int(statisticsFilter.GetSigma(darkLabel))
+
+    noise = NoiseImageType.New()
+    noise.SetRegions(resampled.GetLargestPossibleRegion())
+    noise.SetSpacing(resampled.GetSpacing())
+    noise.SetDirection(resampled.GetDirection())
+    noise.SetOrigin(resampled.GetOrigin())
+    noise.Allocate()
+    noise.FillBuffer(0)
+    noiseFilter = itk.AdditiveGaussianNoiseImageFilter[NoiseImageType, NoiseImageType].New()
+    noiseFilter.SetInput(noise)
+    if noiseSeed is not None:
+        noiseFilter.SetSeed(noiseSeed)
+    # The filter seeds a generator per region it splits the image in: a single region, so that the noise does not
+    # depend on the number of threads (see ToothFractureRoutines.shareThreads())
+    if hasattr(noiseFilter, 'SetNumberOfWorkUnits'):
+        noiseFilter.SetNumberOfWorkUnits(1)
+    else:
+        noiseFilter.SetNumberOfThreads(1)
+    noiseFilter.SetMean(mean)
+    noiseFilter.SetStandardDeviation(std / float(standardDeviationCorrectionFactor))
+    clampFilter = itk.ClampImageFilter[NoiseImageType, ImageType].New()
+    clampFilter.SetInput(noiseFilter.GetOutput())
+    clampFilter.Update()
+    clamped = clampFilter.GetOutput()
+    clamped.DisconnectPipeline()
+    return clamped
+
+
+def displacementVector(planeEquation, displacement):
+    '''
+    normal*displacement as computed by the tool: itk::Vector<double,3>::Normalize(), then converted to float
+    '''
+    normal = numpy.array(planeEquation[0:3], dtype=numpy.float64)
+    squaredNorm = 0.0
+    for value in normal:
+        squaredNorm += value * value
+    norm = numpy.sqrt(squaredNorm)
+    if norm != 0:
+        normal = normal / norm
+    return (normal * displacement).astype(numpy.float32).astype(numpy.float64)
+
+
+class FractureSimulator(object):
+    '''
+    The resampled image, label map and noise image of a case, shared by all its fractures (like the batch mode of
+    ToothFractureSimulation).
+    '''
+    def __init__(self, resampled, labelResampled, noise, slabSize=defaultSlabSize):
+        self.resampled = resampled
+        self.labelResampled = labelResampled
+        self.noise = noise
+        self.imageArray = itk.GetArrayViewFromImage(resampled)
+        self.labelArray = itk.GetArrayViewFromImage(labelResampled)
+        self.noiseArray = itk.GetArrayViewFromImage(noise)
+        self.origin, self.indexToPhysicalPoint, self.physicalPointToIndex = indexTransforms(resampled)
+        self.slabSize = slabSize
+
+    def physicalPoints(self, firstSlice, lastSlice):
+        '''
+        Physical coordinates (x, y, z) of the voxels of slices [firstSlice, lastSlice[, in the order of the sums of
+        TransformIndexToPhysicalPoint
+        '''
+        sizeK, sizeJ, sizeI = self.imageArray.shape
+        index = [numpy.arange(0, sizeI, dtype=numpy.float64).reshape(1, 1, sizeI),
+                 numpy.arange(0, sizeJ, dtype=numpy.float64).reshape(1, sizeJ, 1),
+                 numpy.arange(firstSlice, lastSlice, dtype=numpy.float64).reshape(lastSlice - firstSlice, 1, 1)]
+        points = []
+        for dimension in range(0, 3):
+            point = self.origin[dimension] + self.indexToPhysicalPoint[dimension, 0] * index[0]
+            point = point + self.indexToPhysicalPoint[dimension, 1] * index[1]
+            point = point + self.indexToPhysicalPoint[dimension, 2] * index[2]
+            points.append(point)
+        return points
+
+    def physicalPointsToIndices(self, points):
+        '''
+        TransformPhysicalPointToIndex of the points: returns the (i, j, k) index arrays (rounded half up)
+        '''
+        offsets = [points[dimension] - self.origin[dimension] for dimension in range(0, 3)]
+        indices = []
+        for dimension in range(0, 3):
+            continuousIndex = self.physicalPointToIndex[dimension, 0] * offsets[0]
+            continuousIndex = continuousIndex + self.physicalPointToIndex[dimension, 1] * offsets[1]
+            continuousIndex = continuousIndex + self.physicalPointToIndex[dimension, 2] * offsets[2]
+            indices.append(numpy.floor(continuousIndex + 0.5).astype(numpy.int64))
+        return indices
+
+    def fractureArrays(self, planeEquation, displacement):
+        '''
+        Returns the fractured image and label arrays ([k, j, i]) for the plane ax+by+cz-d (RAS, see
+        ToothFractureSimulation.cxx) and the fracture size displacement
+        '''
+        a, b, c, d = [float(value) for value in planeEquation[0:4]]
+        forwardDisplacement = displacementVector(planeEquation, displacement)
+        output = numpy.array(self.imageArray)
+        labelOutput = numpy.array(self.labelArray)
+        sizeK, sizeJ, sizeI = self.imageArray.shape
+        for firstSlice in range(0, sizeK, self.slabSize):
+            lastSlice = min(sizeK, firstSlice + self.slabSize)
+            points = self.physicalPoints(firstSlice, lastSlice)
+            # Plane equation in RAS, points in LPS
+            val = -a*points[0] - b*points[1] + c*points[2] - d
+            slabLabel = self.labelArray[firstSlice:lastSlice]
+            crack = (numpy.abs(val) < displacement) & (slabLabel == toothLabel)
+            output[firstSlice:lastSlice][crack] = self.noiseArray[firstSlice:lastSlice][crack]
+
+            # Displacement away from the plane, inverted on the "other" side
+            negative = val < 0
+            displacedPoints = [points[dimension] + numpy.where(negative, -forwardDisplacement[dimension],
+                                                               forwardDisplacement[dimension])
+                               for dimension in range(0, 3)]
+            del points, val, negative
+            indexI, indexJ, indexK = self.physicalPointsToIndices(displacedPoints)
+            del displacedPoints
+            inside = (indexI >= 0) & (indexI < sizeI) & (indexJ >= 0) & (indexJ < sizeJ) & \
+                     (indexK >= 0) & (indexK < sizeK)
+            displacedTooth = numpy.zeros(inside.shape, dtype=bool)
+            displacedTooth[inside] = self.labelArray[indexK[inside], indexJ[inside], indexI[inside]] == toothLabel
+            # The image keeps its value there, only the label changes
+            labelOutput[firstSlice:lastSlice][displacedTooth & ~crack] = toothLabel
+        return output, labelOutput
+
+    def imageFromArray(self, array, reference):
+        image = itk.GetImageFromArray(array)
+        image.SetSpacing(reference.GetSpacing())
+        image.SetOrigin(reference.GetOrigin())
+        image.SetDirection(reference.GetDirection())
+        return image
+
+    def simulate(self, planeEquation, displacement):
+        '''
+        Returns the fractured (image, label map) as ITK images, with the grid of the resampled image
+        '''
+        print 'Equation: ' + ' '.join(str(value) for value in planeEquation[0:4])
+        output, labelOutput = self.fractureArrays(planeEquation, displacement)
+        return self.imageFromArray(output, self.resampled), self.imageFromArray(labelOutput, self.labelResampled)
+
+    def iterateFractures(self, planeEquations, displacement):
+        '''
+        Generator over the fractures of planeEquations: yields (planeEquation, image, label map)
+        '''
+        for planeEquation in planeEquations:
+            image, label = self.simulate(planeEquation, displacement)
+            yield planeEquation, image, label
+
+
+def createSimulator(inputFileName, referenceFileName, labelFileName, noiseSeed=0, slabSize=defaultSlabSize):
+    '''
+    Reads the input image, reference grid and label map, and computes what all the fractures of the case share
+    '''
+    inputImage = itk.imread(inputFileName, PixelType)
+    referenceImage = itk.imread(referenceFileName, PixelType)
+    labelImage = itk.imread(labelFileName, LabelPixelType)
+    resampled, labelResampled = resampledImages(inputImage, referenceImage, labelImage)
+    return FractureSimulator(resampled, labelResampled, noiseImage(resampled, labelResampled, noiseSeed), slabSize)
+
+
+# Simulator of the last case, reused by the planes of the same case in a process
+lastSimulator = {'key': None, 'simulator': None}
+
+
+def cachedSimulator(inputFileName, referenceFileName, labelFileName, noiseSeed=0):
+    '''
+    Same as createSimulator(), but reuses the simulator of the previous call if it was for the same files
+    (the files are assumed not to change during the run).
+    '''
+    key = (inputFileName, referenceFileName, labelFileName, noiseSeed)
+    if lastSimulator['key'] != key:
+        lastSimulator['key'] = None
+        lastSimulator['simulator'] = None
+        lastSimulator['simulator'] = createSimulator(inputFileName, referenceFileName, labelFileName, noiseSeed)
+        lastSimulator['key'] = key
+    return lastSimulator['simulator']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+                                     description='Tooth fracture simulation (same arguments and outputs as '
+                                                 'ToothFractureSimulation)')
+    parser.add_argument('input')
+    parser.add_argument('reference', help='image used to resample the output image')
+    parser.add_argument('label', help='1=tooth, 2=dark/fracture')
+    parser.add_argument('outputImage')
+    parser.add_argument('outputLabel')
+    parser.add_argument('plane', type=float, nargs=4, metavar=('a', 'b', 'c', 'd'), help='plane equation')
+    parser.add_argument('displacement', type=float)
+    parser.add_argument('seed', type=int, nargs='?', default=0,
+                        help='seed of the noise (default: 0, the same noise on every run)')
+    args = parser.parse_args(argv[1:])
+    simulator = createSimulator(args.input, args.reference, args.label, args.seed)
+    image, label = simulator.simulate(args.plane, args.displacement)
+    itk.imwrite(image, args.outputImage)
+    itk.imwrite(label, args.outputLabel)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
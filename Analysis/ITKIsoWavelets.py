@@ -1,72 +1,707 @@
 #!/usr/bin/env python
-import itk, sys
+import itk, sys, os, argparse, hashlib, tempfile, shutil, math, resource
+import numpy
+from collections import OrderedDict
 from itk import IsotropicWavelets
 
-if len(sys.argv) != 5:
-    print "Usage: " + sys.argv[0] + " inputImage outputImage High_sub_bands levels"
-    sys.exit(1)
-print ("Generating Wavelet Space for input image %s" % sys.argv[1])
-inputImage = sys.argv[1]
-outputImage = sys.argv[2]
-high_sub_bands = int(sys.argv[3])
-levels = int(sys.argv[4])
-
-print "Reading image"
-reader = itk.ImageFileReader.New(FileName=inputImage)
-reader.Update()
-spacing = reader.GetOutput().GetSpacing()
-origin = reader.GetOutput().GetOrigin()
-direction = reader.GetOutput().GetDirection()
-castFilter = itk.CastImageFilter[itk.output(reader),itk.Image[itk.F,3]].New(reader)
-
-print "Perform FFT on input image"
-fftFilter = itk.ForwardFFTImageFilter.New(castFilter)
-fftFilter.Update()
-ComplexType=itk.output(fftFilter.GetOutput())
+'''
+Isotropic wavelet analysis (ITKIsotropicWavelets, Simoncelli wavelet) of a 3D image.
+
+The functions below can be imported (see ToothFractureRoutines.py) so that the ITK import and the instantiation of
+the wrapped types are paid once per process instead of once per image. Running this file as a script keeps the
+original command line:
+    ITKIsoWavelets.py inputImage outputImage High_sub_bands levels [--filterBankStore directory]
+                      [--label labelImage [--margin mm]] [--pad] [--wavelet Simoncelli]
+                      [--sweep Simoncelli:4:2,Held:2:3,...]
+
+The filter bank only depends on the image size, so it is not written by default. With a filter bank store, each
+filter bank is written once in a sub-directory named after a hash of (size, high_sub_bands, wavelet type) and
+shared by all the images with that size.
+
+The FFT is slow (or, with VNL, fails) for sizes with large prime factors, and most of a resampled CBCT volume is
+outside of the tooth. cropAndPad() crops the image to a region (e.g. the bounding box of the tooth label plus a
+margin, see labelRegion()) grown to the next FFT friendly size, a multiple of 2**levels with only 2, 3 and 5 as
+prime factors. Only when the image is smaller than that size is it padded (mirrored). The wavelet images then cover
+that region, with its origin.
+
+The wavelet decomposition of an image is computed from its spectrum (forwardFFT()): iterateWaveletSweep() computes
+the spectrum once and decomposes it with each (wavelet, high_sub_bands, levels) configuration of a parameter study,
+so that each configuration only costs its inverse FFTs. The filter banks of each level are generated once per image
+size and kept in a WaveletFilterCache for the next images. With --sweep, the wavelet images of each configuration are
+written in a sub-directory <wavelet>_<high_sub_bands>_<levels> of the directory of outputImage (High_sub_bands and
+levels are then only used for the padding: the image is padded for the largest number of levels).
+
+The spectrum of a real image is Hermitian: with --lowMemory (lowMemory=True), the decomposition is computed with
+NumPy on half spectra (the last NumPy axis, i, only has its size/2+1 non negative frequencies), as
+WaveletFrequencyForward does on the full spectrum: for level l and band b, the band spectrum is
+2**(3/2*(b/high_sub_bands - l)) * filterBank_l[b+1] * spectrum_l, and spectrum_l+1 is spectrum_l * filterBank_l[0]
+shrunk by 2 (alias average, as FrequencyShrinkImageFilter). The FFTs are computed one axis at a time on slabs, into
+single precision half spectra, and only one band spectrum and its wavelet image are alive at a time. Only the real
+part of the half of each filter bank is kept. The results are equal to the ITK ones up to float rounding.
+The peak memory of the process (peakMemory()) is printed at the end of the script.
+'''
+
 RealImageType = itk.Image[itk.F,3]
-inverseFFT = itk.InverseFFTImageFilter[ ComplexType, RealImageType].New()
-print "Create Forward Filter Bank"
-PointType=itk.Point[itk.D,3]
-SimoncelliType = itk.SimoncelliIsotropicWavelet[itk.F,3,PointType]
-forwardFilterBankType = itk.WaveletFrequencyFilterBankGenerator[ComplexType,SimoncelliType]
-forwardFilterBank = forwardFilterBankType.New()
-forwardFilterBank.SetHighPassSubBands( high_sub_bands )
-forwardFilterBank.SetSize( fftFilter.GetOutput().GetLargestPossibleRegion().GetSize() )
-forwardFilterBank.Update()
-print  "Store wavelet filter bank."
-for band in range(0,high_sub_bands):
-    inverseFFT.SetInput( forwardFilterBank.GetOutput( band ) )
-    itk.ImageFileWriter.New(Input=inverseFFT.GetOutput(), FileName=outputImage+str(band)+"FilterBank.nrrd").Update()
-
-wavelet = itk.WaveletFrequencyForward[ComplexType,ComplexType, forwardFilterBankType].New()
-wavelet.SetHighPassSubBands(high_sub_bands)
-wavelet.SetLevels( levels )
-wavelet.SetInput(fftFilter.GetOutput())
-wavelet.Update()
-
-for level in range(0, levels):
-    for band in range(0,high_sub_bands):
-        nOutput = level * wavelet.GetHighPassSubBands() + band;
-        print "OutputIndex : " + str(nOutput)
-        print "Level: " + str(level + 1) + " / " +str(wavelet.GetLevels())
-        print "Band: " + str(band + 1) + " / " + str(wavelet.GetHighPassSubBands())
-        print "Largest Region: " + str(wavelet.GetOutput( nOutput ).GetLargestPossibleRegion())
-        print "Origin: " + str(wavelet.GetOutput( nOutput ).GetOrigin())
-        print "Spacing: " + str(wavelet.GetOutput( nOutput ).GetSpacing())
-
-        inverseFFT.SetInput( wavelet.GetOutput( nOutput ) )
-        image = inverseFFT.Update()
-        image = inverseFFT.GetOutput()
-        image.SetSpacing(spacing*(2**level))
-        image.SetDirection(direction)
-        image.SetOrigin(origin)
+ComplexImageType = itk.Image[itk.complex[itk.F],3]
+PointType = itk.Point[itk.D,3]
+
+# Isotropic wavelet functions available in ITKIsotropicWavelets
+WaveletFunctions = {'Simoncelli': itk.SimoncelliIsotropicWavelet,
+                    'Held': itk.HeldIsotropicWavelet,
+                    'Vow': itk.VowIsotropicWavelet,
+                    'Shannon': itk.ShannonIsotropicWavelet}
+
+# Memory (in bytes) that the default filter bank cache may use
+DefaultCacheMemory = 2 * 1024**3
+
+
+class WaveletFilterCache(object):
+    '''
+    LRU cache of the filter banks of the wavelet decompositions (see getFilterBank() and getHalfFilterBank()), keyed
+    by (size, high_sub_bands, levels, wavelet type). All the images of a case have the same size after resampling, so
+    the filter banks of each level are generated once and reused for the healthy and the fractured images.
+    Entries are evicted, least recently used first, when the filter banks held use more than maxMemory bytes.
+    An entry is only used by one decomposition at a time: a concurrent request for the same key gets a fresh entry.
+    '''
+    def __init__(self, maxMemory=DefaultCacheMemory):
+        self.maxMemory = maxMemory
+        self.entries = OrderedDict()
+
+    def memory(self):
+        return sum(entry['memory'] for entry in self.entries.values())
+
+    def acquire(self, size, high_sub_bands, levels, waveletType='Simoncelli'):
+        key = (tuple(size), high_sub_bands, levels, waveletType)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry['inUse']:
+            if entry is not None:
+                self.entries[key] = entry
+            entry = {'key': key, 'inUse': False, 'memory': 0, 'filterBanks': {}, 'halfFilterBanks': {}}
+        self.entries[key] = entry
+        entry['inUse'] = True
+        return entry
+
+    def release(self, entry):
+        entry['inUse'] = False
+        self.evict()
+
+    def evict(self):
+        for key in list(self.entries.keys()):
+            if self.memory() <= self.maxMemory:
+                break
+            if not self.entries[key]['inUse']:
+                del self.entries[key]
+
+
+def forwardFilterBankType(waveletType):
+    WaveletType = WaveletFunctions[waveletType][itk.F,3,PointType]
+    return itk.WaveletFrequencyFilterBankGenerator[ComplexImageType,WaveletType]
+
+
+def createForwardFilterBank(size, high_sub_bands, waveletType):
+    '''
+    Returns the forward filter bank generator for images of size, updated
+    '''
+    forwardFilterBank = forwardFilterBankType(waveletType).New()
+    forwardFilterBank.SetHighPassSubBands( high_sub_bands )
+    forwardFilterBank.SetSize( size )
+    forwardFilterBank.Update()
+    return forwardFilterBank
+
+
+# Cache used by the wavelet decompositions unless another one is given
+filterCache = WaveletFilterCache()
+
+
+def bandScale(level, band, high_sub_bands):
+    '''
+    Factor WaveletFrequencyForward applies to the filter of a band at a level
+    '''
+    return 2**(1.5 * (float(band) / high_sub_bands - level))
+
+
+def getFilterBank(entry, level):
+    '''
+    Returns the forward filter bank of a cache entry at a level (the size of the image divided by 2**level) as real
+    images, generating it on first use: the low pass filter, followed by the high pass band filters multiplied by
+    bandScale(), as WaveletFrequencyForward applies them. The filters have no imaginary part.
+    '''
+    filterBanks = entry['filterBanks']
+    if level not in filterBanks:
+        size, high_sub_bands, levels, waveletType = entry['key']
+        levelSize = [int(s) // 2**level for s in size]
+        print "Create Forward Filter Bank, level " + str(level)
+        forwardFilterBank = createForwardFilterBank(levelSize, high_sub_bands, waveletType)
+        filterBank = []
+        for nOutput in range(0, forwardFilterBank.GetNumberOfOutputs()):
+            realFilter = itk.ComplexToRealImageFilter[ComplexImageType, RealImageType].New(
+                forwardFilterBank.GetOutput(nOutput))
+            if nOutput == 0:
+                outputFilter = realFilter
+            else:
+                outputFilter = itk.MultiplyImageFilter[RealImageType, RealImageType, RealImageType].New()
+                outputFilter.SetInput1(realFilter.GetOutput())
+                outputFilter.SetConstant2(bandScale(level, nOutput - 1, high_sub_bands))
+            outputFilter.Update()
+            filterImage = outputFilter.GetOutput()
+            filterImage.DisconnectPipeline()
+            filterBank.append(filterImage)
+            forwardFilterBank.GetOutput(nOutput).ReleaseData()
+        filterBanks[level] = filterBank
+        numberOfVoxels = 1
+        for s in levelSize:
+            numberOfVoxels *= s
+        entry['memory'] += 4 * numberOfVoxels * len(filterBank)
+    return filterBanks[level]
+
+
+def filterSpectrum(spectrum, filterImage):
+    '''
+    Returns spectrum multiplied by the real filterImage (same size), disconnected from the pipeline
+    '''
+    # The filter bank generator does not set the geometry of the spectrum
+    filterImage.CopyInformation(spectrum)
+    multiplyFilter = itk.MultiplyImageFilter[ComplexImageType, RealImageType, ComplexImageType].New()
+    multiplyFilter.SetInput1(spectrum)
+    multiplyFilter.SetInput2(filterImage)
+    multiplyFilter.Update()
+    output = multiplyFilter.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def filterBankKey(size, high_sub_bands, waveletType):
+    '''
+    Name of the filter bank store sub-directory: the filter bank only depends on these parameters
+    '''
+    description = 'size=%s high_sub_bands=%d wavelet=%s' % (tuple(int(s) for s in size), high_sub_bands, waveletType)
+    return hashlib.sha1(description).hexdigest(), description
+
+
+def storeFilterBank(size, high_sub_bands, waveletType, filterBankStore):
+    '''
+    Writes the filter bank for images of size to <filterBankStore>/<hash>/<band>FilterBank.nrrd unless it is already
+    there. The bank is written in a temporary directory that is then renamed, so that concurrent runs never see (or
+    write) a partial bank. Returns the directory of the filter bank.
+    '''
+    key, description = filterBankKey(size, high_sub_bands, waveletType)
+    filterBankDirectory = os.path.join(filterBankStore, key)
+    if os.path.isdir(filterBankDirectory):
+        return filterBankDirectory
+    if not os.path.isdir(filterBankStore):
+        os.makedirs(filterBankStore)
+    print "Create Forward Filter Bank"
+    forwardFilterBank = createForwardFilterBank(size, high_sub_bands, waveletType)
+    print  "Store wavelet filter bank in " + filterBankDirectory
+    temporaryDirectory = tempfile.mkdtemp(prefix=key, dir=filterBankStore)
+    try:
+        with open(os.path.join(temporaryDirectory, 'FilterBank.txt'), 'w') as f:
+            f.write(description + '\n')
+        inverseFFT = itk.InverseFFTImageFilter[ComplexImageType, RealImageType].New()
+        for band in range(0,high_sub_bands):
+            inverseFFT.SetInput( forwardFilterBank.GetOutput( band ) )
+            itk.ImageFileWriter.New(Input=inverseFFT.GetOutput(),
+                                    FileName=os.path.join(temporaryDirectory, str(band)+"FilterBank.nrrd")).Update()
+        os.rename(temporaryDirectory, filterBankDirectory)
+    except OSError:
+        # Another process stored the same filter bank first
+        if not os.path.isdir(filterBankDirectory):
+            raise
+    finally:
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    return filterBankDirectory
+
+
+def readImage(inputImage):
+    reader = itk.ImageFileReader.New(FileName=inputImage)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def isFFTFriendly(size):
+    for factor in (2, 3, 5):
+        while size % factor == 0:
+            size //= factor
+    return size == 1
+
+
+def fftFriendlySize(size, levels):
+    '''
+    Smallest size >= size that is a multiple of 2**levels (each level halves the size) with only 2, 3 and 5 as prime
+    factors
+    '''
+    levelSize = int(math.ceil(size / float(2**levels)))
+    while not isFFTFriendly(levelSize):
+        levelSize += 1
+    return levelSize * 2**levels
+
+
+def labelBounds(image, labelImage, margin=0.0, labels=None):
+    '''
+    Returns (lower, upper), the continuous indices (i, j, k) in the index space of image of the edges of the bounding
+    box of the voxels of labelImage (which can be on another grid) with a value in labels (default: non zero), grown
+    by margin mm. None if there are no such voxels.
+    '''
+    labelArray = itk.GetArrayViewFromImage(labelImage)
+    if labels is None:
+        mask = labelArray != 0
+    else:
+        mask = numpy.in1d(labelArray, labels).reshape(labelArray.shape)
+    nonZero = [numpy.flatnonzero(mask.any(axis=axes)) for axes in ((0, 1), (0, 2), (1, 2))]
+    if any(len(indices) == 0 for indices in nonZero):
+        return None
+    # Voxel extent of the bounding box, in (i, j, k) order
+    lower = [indices[0] - 0.5 for indices in nonZero]
+    upper = [indices[-1] + 0.5 for indices in nonZero]
+    imageSpacing = image.GetSpacing()
+    minimum = [float('inf')] * 3
+    maximum = [float('-inf')] * 3
+    for corner in range(0, 8):
+        labelIndex = itk.ContinuousIndex[itk.D, 3]()
+        for axis in range(0, 3):
+            labelIndex.SetElement(axis, upper[axis] if corner & (1 << axis) else lower[axis])
+        point = labelImage.TransformContinuousIndexToPhysicalPoint(labelIndex)
+        imageIndex = image.TransformPhysicalPointToContinuousIndex(point)
+        for axis in range(0, 3):
+            minimum[axis] = min(minimum[axis], imageIndex[axis])
+            maximum[axis] = max(maximum[axis], imageIndex[axis])
+    marginVoxels = [margin / imageSpacing[axis] for axis in range(0, 3)]
+    return ([minimum[axis] - marginVoxels[axis] for axis in range(0, 3)],
+            [maximum[axis] + marginVoxels[axis] for axis in range(0, 3)])
+
+
+def labelRegion(image, labelImage, margin=0.0, labels=None):
+    '''
+    Returns (index, size), in the index space of image, of the voxels of image in labelBounds() (clipped to image).
+    None if the label map is empty there.
+    '''
+    bounds = labelBounds(image, labelImage, margin, labels)
+    if bounds is None:
+        return None
+    imageSize = image.GetLargestPossibleRegion().GetSize()
+    index = []
+    size = []
+    for axis in range(0, 3):
+        start = max(0, int(math.floor(bounds[0][axis] + 0.5)))
+        end = min(int(imageSize[axis]), int(math.ceil(bounds[1][axis] + 0.5)))
+        if end <= start:
+            return None
+        index.append(start)
+        size.append(end - start)
+    return index, size
+
+
+def cropAndPad(image, levels, region=None):
+    '''
+    Returns the part of image in region ((index, size), default: the whole image) grown to fftFriendlySize() along
+    each axis, centered on region as far as the image allows. Axes where the image is too small are padded by
+    mirroring it. The returned image starts at index 0, its origin is the physical point of its first voxel.
+    '''
+    imageSize = [int(size) for size in image.GetLargestPossibleRegion().GetSize()]
+    if region is None:
+        region = ([0, 0, 0], imageSize)
+    index, size = region
+    cropIndex = []
+    cropSize = []
+    padding = []
+    for axis in range(0, 3):
+        targetSize = fftFriendlySize(size[axis], levels)
+        if targetSize <= imageSize[axis]:
+            start = min(max(0, index[axis] - (targetSize - size[axis]) // 2), imageSize[axis] - targetSize)
+            cropIndex.append(start)
+            cropSize.append(targetSize)
+            padding.append((0, 0))
+        else:
+            cropIndex.append(0)
+            cropSize.append(imageSize[axis])
+            padLower = (targetSize - imageSize[axis]) // 2
+            padding.append((padLower, targetSize - imageSize[axis] - padLower))
+    if cropIndex == [0, 0, 0] and cropSize == imageSize and padding == [(0, 0)] * 3:
+        return image
+    print 'Wavelet region: index %s, size %s, padding %s' % (cropIndex, [lower + cropSize[axis] + upper for
+                                                                          axis, (lower, upper) in enumerate(padding)],
+                                                              padding)
+    array = itk.GetArrayViewFromImage(image)[cropIndex[2]:cropIndex[2] + cropSize[2],
+                                             cropIndex[1]:cropIndex[1] + cropSize[1],
+                                             cropIndex[0]:cropIndex[0] + cropSize[0]]
+    if any(padding[axis] != (0, 0) for axis in range(0, 3)):
+        array = numpy.pad(array, list(reversed(padding)), 'symmetric')
+    output = itk.GetImageFromArray(numpy.ascontiguousarray(array))
+    firstVoxel = itk.ContinuousIndex[itk.D, 3]()
+    for axis in range(0, 3):
+        firstVoxel.SetElement(axis, cropIndex[axis] - padding[axis][0])
+    output.SetOrigin(image.TransformContinuousIndexToPhysicalPoint(firstVoxel))
+    output.SetSpacing(image.GetSpacing())
+    output.SetDirection(image.GetDirection())
+    return output
+
+
+def forwardFFT(image, fftFilter=None):
+    '''
+    Returns the spectrum of image (cast to float), disconnected from the pipeline. fftFilter: the forward FFT filter
+    to use (a new one by default).
+    '''
+    castFilter = itk.CastImageFilter[itk.output(image),RealImageType].New(image)
+    if fftFilter is None:
+        fftFilter = itk.ForwardFFTImageFilter[RealImageType,ComplexImageType].New()
+    print "Perform FFT on input image"
+    fftFilter.SetInput(castFilter.GetOutput())
+    fftFilter.Update()
+    spectrum = fftFilter.GetOutput()
+    spectrum.DisconnectPipeline()
+    return spectrum
+
+
+def iterateWavelets(image, high_sub_bands, levels, filterBankStore=None, waveletType='Simoncelli', cache=None,
+                    lowMemory=False):
+    '''
+    Generator over the wavelet decomposition of image. Yields (outputIndex, image) for the levels*high_sub_bands
+    band images, followed by the approximation image (outputIndex = levels*high_sub_bands).
+    Each yielded image is disconnected from the pipeline, so it can be kept after the next one is computed.
+    If filterBankStore is given, the filter bank is written there once per image size (see storeFilterBank()).
+    The filter banks are taken from cache (a WaveletFilterCache, the module cache by default). If lowMemory is True,
+    the decomposition is computed on half spectra (see iterateHalfSpectrumWavelets()).
+    '''
+    if lowMemory:
+        spectrum = halfSpectrum(itk.GetArrayViewFromImage(image))
+        for nOutput, waveletImage in iterateHalfSpectrumWavelets(spectrum, image, high_sub_bands, levels,
+                                                                 filterBankStore, waveletType, cache):
+            yield nOutput, waveletImage
+        return
+    spectrum = forwardFFT(image)
+    try:
+        for nOutput, waveletImage in iterateSpectrumWavelets(spectrum, image, high_sub_bands, levels, filterBankStore,
+                                                             waveletType, cache):
+            yield nOutput, waveletImage
+    finally:
+        spectrum.ReleaseData()
+
+
+def iterateWaveletSweep(image, configurations, filterBankStore=None, cache=None, lowMemory=False):
+    '''
+    Generator over the wavelet decompositions of image with each (waveletType, high_sub_bands, levels) of
+    configurations. The forward FFT is computed once and its spectrum shared by all the configurations. Yields
+    (configuration, outputIndex, image) as iterateWavelets() does for each configuration in turn. The size of image
+    must be a multiple of 2**levels for the largest levels (see cropAndPad()).
+    '''
+    spectrum = halfSpectrum(itk.GetArrayViewFromImage(image)) if lowMemory else forwardFFT(image)
+    try:
+        for configuration in configurations:
+            waveletType, high_sub_bands, levels = configuration
+            print 'Wavelet %s, high_sub_bands %d, levels %d' % (waveletType, high_sub_bands, levels)
+            if lowMemory:
+                wavelets = iterateHalfSpectrumWavelets(spectrum, image, high_sub_bands, levels, filterBankStore,
+                                                       waveletType, cache)
+            else:
+                wavelets = iterateSpectrumWavelets(spectrum, image, high_sub_bands, levels, filterBankStore,
+                                                   waveletType, cache)
+            for nOutput, waveletImage in wavelets:
+                yield configuration, nOutput, waveletImage
+    finally:
+        if not lowMemory:
+            spectrum.ReleaseData()
+
+
+def iterateSpectrumWavelets(spectrum, image, high_sub_bands, levels, filterBankStore=None, waveletType='Simoncelli',
+                            cache=None):
+    '''
+    Generator over the wavelet decomposition of spectrum, the forward FFT of image (see forwardFFT()): same outputs
+    as iterateWavelets(), with the geometry of image. spectrum is not modified.
+    The decomposition is the one of WaveletFrequencyForward, with the filter banks of cache (see getFilterBank()):
+    for level l and band b, the band spectrum is filterBank_l[b+1] * spectrum_l, and spectrum_l+1 is
+    spectrum_l * filterBank_l[0] shrunk by FrequencyShrinkImageFilter. Only one band spectrum is alive at a time.
+    '''
+    if cache is None:
+        cache = filterCache
+    spacing = image.GetSpacing()
+    origin = image.GetOrigin()
+    direction = image.GetDirection()
+    size = spectrum.GetLargestPossibleRegion().GetSize()
+
+    entry = cache.acquire(size, high_sub_bands, levels, waveletType)
+    try:
+        if filterBankStore is not None:
+            storeFilterBank(size, high_sub_bands, waveletType, filterBankStore)
+        inverseFFT = itk.InverseFFTImageFilter[ComplexImageType, RealImageType].New()
+        levelSpectrum = spectrum
+        for level in range(0, levels):
+            filterBank = getFilterBank(entry, level)
+            for band in range(0,high_sub_bands):
+                nOutput = level * high_sub_bands + band;
+                print "OutputIndex : " + str(nOutput)
+                print "Level: " + str(level + 1) + " / " +str(levels)
+                print "Band: " + str(band + 1) + " / " + str(high_sub_bands)
+                print "Largest Region: " + str(levelSpectrum.GetLargestPossibleRegion())
+
+                bandSpectrum = filterSpectrum(levelSpectrum, filterBank[band + 1])
+                inverseFFT.SetInput( bandSpectrum )
+                inverseFFT.Update()
+                # The band spectrum is not needed anymore: released before the wavelet image is used
+                bandSpectrum.ReleaseData()
+                waveletImage = inverseFFT.GetOutput()
+                waveletImage.DisconnectPipeline()
+                waveletImage.SetSpacing(spacing*(2**level))
+                waveletImage.SetDirection(direction)
+                waveletImage.SetOrigin(origin)
+                yield nOutput, waveletImage
+            shrinkFilter = itk.FrequencyShrinkImageFilter[ComplexImageType].New(
+                filterSpectrum(levelSpectrum, filterBank[0]))
+            shrinkFilter.Update()
+            if levelSpectrum is not spectrum:
+                levelSpectrum.ReleaseData()
+            levelSpectrum = shrinkFilter.GetOutput()
+            levelSpectrum.DisconnectPipeline()
+
+        approxIndex = levels * high_sub_bands
+        inverseFFT.SetInput( levelSpectrum )
+        inverseFFT.Update()
+        waveletImage = inverseFFT.GetOutput()
+        waveletImage.DisconnectPipeline()
+        waveletImage.SetSpacing(spacing*(2**levels))
+        waveletImage.SetDirection(direction)
+        waveletImage.SetOrigin(origin)
+        yield approxIndex, waveletImage
+    finally:
+        cache.release(entry)
+
+
+# Number of elements of the slabs the FFTs of the low memory mode are computed on
+FFTSlabSize = 2**22
+
+
+def slabRanges(size, elementsPerIndex, slabSize=FFTSlabSize):
+    step = max(1, slabSize // max(1, elementsPerIndex))
+    return [(first, min(size, first + step)) for first in range(0, size, step)]
+
+
+def halfSpectrum(array):
+    '''
+    Returns the half spectrum (numpy.fft.rfftn) of the 3D array, in single precision. The FFT is computed one axis at
+    a time, on slabs: only the output and the double precision spectrum of one slab are allocated.
+    '''
+    sizeK, sizeJ, sizeI = array.shape
+    spectrum = numpy.empty((sizeK, sizeJ, sizeI // 2 + 1), dtype=numpy.complex64)
+    for first, last in slabRanges(sizeK, sizeJ * sizeI):
+        spectrum[first:last] = numpy.fft.rfft(array[first:last], axis=2)
+    for first, last in slabRanges(sizeK, sizeJ * sizeI):
+        spectrum[first:last] = numpy.fft.fft(spectrum[first:last], axis=1)
+    for first, last in slabRanges(sizeJ, sizeK * sizeI):
+        spectrum[:, first:last] = numpy.fft.fft(spectrum[:, first:last], axis=0)
+    return spectrum
+
+
+def inverseHalfSpectrum(spectrum, sizeI):
+    '''
+    Returns the single precision real image (numpy.fft.irfftn) of size sizeI along its last axis of the half
+    spectrum, which is overwritten. Computed one axis at a time, on slabs, as halfSpectrum().
+    '''
+    sizeK, sizeJ, halfSizeI = spectrum.shape
+    for first, last in slabRanges(sizeJ, sizeK * halfSizeI):
+        spectrum[:, first:last] = numpy.fft.ifft(spectrum[:, first:last], axis=0)
+    for first, last in slabRanges(sizeK, sizeJ * halfSizeI):
+        spectrum[first:last] = numpy.fft.ifft(spectrum[first:last], axis=1)
+    output = numpy.empty((sizeK, sizeJ, sizeI), dtype=numpy.float32)
+    for first, last in slabRanges(sizeK, sizeJ * halfSizeI):
+        output[first:last] = numpy.fft.irfft(spectrum[first:last], n=sizeI, axis=2)
+    return output
+
+
+def shrinkHalfSpectrum(spectrum):
+    '''
+    Half spectrum of the image subsampled by 2 along each axis (sizes must be even): each frequency is the average
+    of its aliases, as FrequencyShrinkImageFilter does on a full spectrum. The aliases along the last axis that are
+    not stored are the conjugates of the opposite frequencies.
+    '''
+    sizeK, sizeJ, halfSizeI = spectrum.shape
+    halfShrunkI = (halfSizeI - 1) // 2 + 1
+    oppositeK = numpy.negative(numpy.arange(sizeK)) % sizeK
+    oppositeJ = numpy.negative(numpy.arange(sizeJ)) % sizeJ
+    # Frequency m + i of the last axis (m = halfSizeI - 1) is the conjugate of the opposite of m - i
+    aliases = spectrum[:, :, halfSizeI - halfShrunkI:halfSizeI][:, :, ::-1]
+    shrunk = (spectrum[:, :, :halfShrunkI] + numpy.conj(aliases[oppositeK][:, oppositeJ])) / 2
+    shrunk = (shrunk[:sizeK // 2] + shrunk[sizeK // 2:]) / 2
+    return (shrunk[:, :sizeJ // 2] + shrunk[:, sizeJ // 2:]) / 2
+
+
+def getHalfFilterBank(entry, level):
+    '''
+    Returns the real part of the half (as in halfSpectrum()) of the forward filter bank of a cache entry at a level
+    (the size of the image divided by 2**level), generating it on first use. The full filter bank is not kept.
+    '''
+    halfFilterBanks = entry['halfFilterBanks']
+    if level not in halfFilterBanks:
+        size, high_sub_bands, levels, waveletType = entry['key']
+        levelSize = [int(s) // 2**level for s in size]
+        print "Create Forward Filter Bank (half), level " + str(level)
+        forwardFilterBank = createForwardFilterBank(levelSize, high_sub_bands, waveletType)
+        halfFilterBank = []
+        for nOutput in range(0, forwardFilterBank.GetNumberOfOutputs()):
+            realFilter = itk.ComplexToRealImageFilter[ComplexImageType, RealImageType].New(
+                forwardFilterBank.GetOutput(nOutput))
+            realFilter.Update()
+            halfFilterBank.append(numpy.array(itk.GetArrayViewFromImage(realFilter.GetOutput())[:, :,
+                                                                                                :levelSize[0] // 2 + 1]))
+            forwardFilterBank.GetOutput(nOutput).ReleaseData()
+        halfFilterBanks[level] = halfFilterBank
+        entry['memory'] += sum(array.nbytes for array in halfFilterBank)
+    return halfFilterBanks[level]
+
+
+def imageFromArray(array, spacing, origin, direction):
+    image = itk.GetImageViewFromArray(array)
+    # The view does not own its buffer: the array is kept with the image
+    image.array = array
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetDirection(direction)
+    return image
+
+
+def iterateHalfSpectrumWavelets(spectrum, image, high_sub_bands, levels, filterBankStore=None,
+                                waveletType='Simoncelli', cache=None):
+    '''
+    Generator over the wavelet decomposition of spectrum, the half spectrum of image (see halfSpectrum()): same
+    outputs as iterateWavelets(), computed with NumPy (see the description of the low memory mode above).
+    spectrum is not modified. Each wavelet image is computed when the previous one has been used.
+    '''
+    if cache is None:
+        cache = filterCache
+    spacing = image.GetSpacing()
+    origin = image.GetOrigin()
+    direction = image.GetDirection()
+    size = image.GetLargestPossibleRegion().GetSize()
+
+    entry = cache.acquire(size, high_sub_bands, levels, waveletType)
+    try:
+        if filterBankStore is not None:
+            storeFilterBank(size, high_sub_bands, waveletType, filterBankStore)
+        levelSpectrum = spectrum
+        for level in range(0, levels):
+            filterBank = getHalfFilterBank(entry, level)
+            for band in range(0, high_sub_bands):
+                nOutput = level * high_sub_bands + band
+                print "OutputIndex : " + str(nOutput)
+                print "Level: " + str(level + 1) + " / " + str(levels)
+                print "Band: " + str(band + 1) + " / " + str(high_sub_bands)
+                scale = bandScale(level, band, high_sub_bands)
+                bandSpectrum = levelSpectrum * (filterBank[band + 1] * numpy.float32(scale))
+                waveletArray = inverseHalfSpectrum(bandSpectrum, int(size[0]) // 2**level)
+                del bandSpectrum
+                yield nOutput, imageFromArray(waveletArray, spacing*(2**level), origin, direction)
+                del waveletArray
+            levelSpectrum = shrinkHalfSpectrum(levelSpectrum * filterBank[0])
+
+        approxIndex = levels * high_sub_bands
+        if levels == 0:
+            levelSpectrum = levelSpectrum.copy()
+        waveletArray = inverseHalfSpectrum(levelSpectrum, int(size[0]) // 2**levels)
+        del levelSpectrum
+        yield approxIndex, imageFromArray(waveletArray, spacing*(2**levels), origin, direction)
+    finally:
+        cache.release(entry)
+
+
+def peakMemory():
+    '''
+    Peak resident memory of this process (in bytes)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def computeWavelets(image, high_sub_bands, levels, filterBankStore=None, waveletType='Simoncelli', cache=None):
+    '''
+    Returns the list of the levels*high_sub_bands+1 wavelet images of image (bands first, approximation last).
+    Prefer iterateWavelets() when the images are only written or reduced one at a time: the list keeps all of them
+    in memory.
+    '''
+    return [waveletImage for nOutput, waveletImage in
+            iterateWavelets(image, high_sub_bands, levels, filterBankStore, waveletType, cache)]
+
+
+def writeWavelets(wavelets, outputImage):
+    '''
+    Writes (outputIndex, image) pairs as given by iterateWavelets() to <outputImage><outputIndex>.nrrd
+    '''
+    for nOutput, image in wavelets:
         itk.ImageFileWriter.New(Input=image, FileName=outputImage+str(nOutput)+".nrrd").Update()
 
-approxIndex = int(wavelet.GetTotalOutputs() - 1)
-inverseFFT.SetInput( wavelet.GetOutput(approxIndex) )
-inverseFFT.Update()
-image=inverseFFT.GetOutput()
-image.SetSpacing(spacing*(2**levels))
-image.SetDirection(direction)
-image.SetOrigin(origin)
-itk.ImageFileWriter.New(Input=image, FileName=outputImage+str(approxIndex)+".nrrd").Update()
+
+def sweepOutputImage(outputImage, configuration):
+    '''
+    Prefix of the wavelet images of a configuration of a sweep: in the sub-directory <wavelet>_<bands>_<levels> of
+    the directory of outputImage
+    '''
+    directory, prefix = os.path.split(outputImage)
+    return os.path.join(directory, '%s_%d_%d' % configuration, prefix)
+
+
+def writeWaveletSweep(sweep, outputImage):
+    '''
+    Writes the (configuration, outputIndex, image) given by iterateWaveletSweep() (see sweepOutputImage())
+    '''
+    for configuration, nOutput, image in sweep:
+        configurationOutputImage = sweepOutputImage(outputImage, configuration)
+        if not os.path.isdir(os.path.dirname(configurationOutputImage)):
+            os.makedirs(os.path.dirname(configurationOutputImage))
+        writeWavelets([(nOutput, image)], configurationOutputImage)
+
+
+def parseSweep(text):
+    '''
+    Configurations from 'wavelet:high_sub_bands:levels,...'
+    '''
+    configurations = []
+    for configuration in text.split(','):
+        waveletType, high_sub_bands, levels = configuration.split(':')
+        if waveletType not in WaveletFunctions:
+            raise argparse.ArgumentTypeError('Unknown wavelet %s (%s)' % (waveletType, ', '.join(WaveletFunctions)))
+        configurations.append((waveletType, int(high_sub_bands), int(levels)))
+    return configurations
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description='Isotropic wavelet analysis of a 3D image')
+    parser.add_argument('inputImage')
+    parser.add_argument('outputImage', help='prefix of the output wavelet images')
+    parser.add_argument('high_sub_bands', type=int)
+    parser.add_argument('levels', type=int)
+    parser.add_argument('--filterBankStore', default=None,
+                        help='directory where the filter bank is written, once per image size (default: not written)')
+    parser.add_argument('--label', default=None,
+                        help='label map: only the bounding box of its non zero voxels (plus margin) is analyzed')
+    parser.add_argument('--margin', type=float, default=5.0, help='margin (in mm) around the label bounding box')
+    parser.add_argument('--pad', action='store_true',
+                        help='pad the image to a size with small prime factors (implied by --label)')
+    parser.add_argument('--wavelet', default='Simoncelli', choices=sorted(WaveletFunctions.keys()))
+    parser.add_argument('--lowMemory', action='store_true',
+                        help='compute the decomposition on half spectra (Hermitian symmetry), one band at a time')
+    parser.add_argument('--sweep', type=parseSweep, default=None,
+                        help='wavelet:high_sub_bands:levels,... configurations computed from one forward FFT, each '
+                             'written in its own sub-directory')
+    args = parser.parse_args(argv[1:])
+    levels = args.levels
+    if args.sweep is not None:
+        levels = max(configurationLevels for waveletType, high_sub_bands, configurationLevels in args.sweep)
+    print ("Generating Wavelet Space for input image %s" % args.inputImage)
+
+    print "Reading image"
+    image = readImage(args.inputImage)
+    if args.label is not None:
+        region = labelRegion(image, readImage(args.label), args.margin)
+        if region is None:
+            print 'Empty label map, the whole image is analyzed'
+        image = cropAndPad(image, levels, region)
+    elif args.pad:
+        image = cropAndPad(image, levels)
+    if args.sweep is not None:
+        writeWaveletSweep(iterateWaveletSweep(image, args.sweep, filterBankStore=args.filterBankStore,
+                                              lowMemory=args.lowMemory), args.outputImage)
+    else:
+        writeWavelets(iterateWavelets(image, args.high_sub_bands, args.levels, filterBankStore=args.filterBankStore,
+                                      waveletType=args.wavelet, lowMemory=args.lowMemory), args.outputImage)
+    print 'Peak memory: %.1f MB' % (peakMemory() / 2.0**20)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
+import sys
+import argparse
 from ToothFractureRoutines import *
+from ToothFractureScheduler import runTasks
+from WaveletFeatures import createFeatureWriter, WaveletStatistics
 
 '''
 This script runs Tooth fracture simulation and analysis on a set of directories given the plane equations at which the
@@ -22,6 +26,9 @@ and use that as a reference volume in Slicer's 'Resample Scalar/Vector/DWI Volum
 * Set the parameters in this script AND adjust paths to tools in ToothFractureRoutines.py
 * If you have setup Python virtual environment, start now
 * Run this script once with simulateFractures True, and once with simulateFractures False
+    Each (case, fracture plane) is an independent task: use --jobs N to run N of them in parallel (the number of
+    concurrent tasks is also limited by the available memory, or --memoryLimit in GB).
+    Rerunning the script only redoes the stages whose inputs or parameters changed (see PipelineManifest.py).
     Outputs: Wavelets and fracture simulated grayscale images
 * Run the SlicerExtension: ToothFractureStatistics
     Input: The data directory (dataDirectory parameter below) with all the wavelets and grayscales calculated
@@ -82,40 +89,169 @@ DataSetDict['01_CBCT_2ndMolar_right'] =  [
 simulateFracture = False
 # -- Fracture simulation parameters
 fractureSize = 0.1
+#    True to simulate all the fractures of a case with one run of ToothFractureSimulation (batch mode, the resampling
+#    and noise generation are shared by the planes), False to run it once per plane, in the plane tasks. The batch
+#    mode needs ToothFractureSimulation built from this version of Simulation/ (--planes).
+batchSimulation = False
+#    True to simulate the fractures in the plane tasks with FractureSimulation.py and pass them in memory to the wavelet
+#    analysis (no fractured images are written, batchSimulation is not used)
+inMemoryFracture = False
 # -- Wavelet analysis parameters
 high_sub_bands = 4
 levels = 4
+# -- Margin (in mm) around the tooth label bounding box the wavelets are computed on, None for the whole image
+waveletROIMargin = None
 # -- Target resolution parameters
 targetSpacing = 0.085
+#    Margin (in mm) around the tooth (labels 1 and 2) covered by the reference grid, None to cover the whole image.
+#    With a margin, the healthy image is resampled from inputImage on that grid (resampledInput is not used).
+gridROIMargin = None
+# -- Directory where wavelet filter banks are written once per image size, None to skip them
+filterBankStore = None
+# -- True to compute the wavelets from half of the spectrum of the images (less memory, same results up to rounding)
+lowMemoryWavelets = False
+# -- Wavelet features computed during the wavelet analysis (instead of with ToothFractureStatistics).
+#    featureCSVFile: CSV file in dataDirectory, None to skip. Rows are appended to an existing file. A name ending
+#    with .features writes a binary feature store instead (see FeatureStore.py, exported to CSV with FeatureStore.py).
+featureCSVFile = None
+featureUseMax = True
+featurePercentiles = []
+#    Labels of the tooth the features are computed on (mapped on each wavelet level, dilated by featureMaskDilation
+#    mm), None to compute them on the whole wavelet images
+featureMaskLabels = None
+featureMaskDilation = 0.0
+#    Additional statistics accumulated in the same sweep over each wavelet image: mean, std, energy, l1 and kurtosis,
+#    histogram of |wavelet| ((bins, max) or None) and k largest |wavelet| values
+featureMoments = False
+featureHistogram = None
+featureTopK = 0
+#    Size (in voxels) of the blocks of the max and energy maps saved next to each wavelet directory, None to skip them
+featureBlockSize = None
+#    False to only compute the features without writing the wavelet images (requires featureCSVFile)
+writeWaveletImages = True
 # Directory that has all the subdirectories in DataSetDict
 dataDirectory = 'Data/'
+# Data in each subdirectory
+inputImage = 'ToothCBCT.nrrd'
+inputLabelImage = 'ToothCBCT-label.nrrd'
+resampledInput = 'ToothCBCT-resampled.nrrd'
+waveletAnalysisOutputPrefix = 'wavelet'
 
-for directoryName, planeEquations in DataSetDict.iteritems():
-    # Set variables for the algorithm
-    # Data
+featureStatistics = None
+if featureCSVFile is not None:
+    featureStatistics = WaveletStatistics(featureUseMax, featurePercentiles, maskLabels=featureMaskLabels,
+                                          maskDilation=featureMaskDilation, moments=featureMoments,
+                                          histogramBins=featureHistogram[0] if featureHistogram else 0,
+                                          histogramMax=featureHistogram[1] if featureHistogram else 0.0,
+                                          topK=featureTopK, blockSize=featureBlockSize,
+                                          # The deepest levels of the wavelets of a region are smaller than the pad
+                                          scalePad=waveletROIMargin is not None)
+
+
+def caseFractures(planeEquations):
+    '''
+    Returns the (planeEquation, namePostfix, waveletAnalysisDirectoryName) of the fractures of a case
+    '''
+    return [(planeEquation, '_'+str(num), 'FracturedToothWavelet_'+str(num))
+            for num, planeEquation in enumerate(planeEquations)]
+
+
+def prepareCase(directoryName):
+    '''
+    Creates the reference grid of a case, and simulates its fractures in batch mode if batchSimulation is set.
+    Returns the memory needed by each of its tasks.
+    '''
+    workingDirectory = os.path.join(dataDirectory, directoryName)
+    gridImage = createReferenceGrid(workingDirectory, inputImage, targetSpacing, inputLabelImage=inputLabelImage,
+                                    roiMargin=gridROIMargin)
+    if simulateFracture and batchSimulation and not inMemoryFracture:
+        simulateFractures(workingDirectory, inputImage, inputLabelImage, caseFractures(DataSetDict[directoryName]),
+                          fractureSize, targetSpacing, gridROIMargin=gridROIMargin)
+    return estimateJobMemory(workingDirectory, inputImage, targetSpacing, high_sub_bands, gridImage,
+                             lowMemoryWavelets)
+
+
+def inputMemory(directoryName):
+    '''
+    Memory needed by the tasks of a case, estimated from the header of its input image before the reference grid
+    exists (0 if the input image cannot be read: the task of the case reports the error)
+    '''
+    workingDirectory = os.path.join(dataDirectory, directoryName)
+    try:
+        return estimateJobMemory(workingDirectory, inputImage, targetSpacing, high_sub_bands,
+                                 lowMemory=lowMemoryWavelets)
+    except (IOError, OSError):
+        return 0
+
+
+def planeTasks(directoryName, planeEquations):
+    '''
+    Returns the tasks (see ToothFractureScheduler.py) of a case: one per fracture plane, or one for the healthy image
+    '''
     workingDirectory = os.path.join(dataDirectory, directoryName)
-    inputImage = 'ToothCBCT.nrrd'
-    inputLabelImage = 'ToothCBCT-label.nrrd'
-    resampledInput = 'ToothCBCT-resampled.nrrd'
-    waveletAnalysisOutputPrefix = 'wavelet'
+    options = {'filterBankStore': filterBankStore, 'writeWaveletImages': writeWaveletImages,
+               'featureStatistics': featureStatistics, 'createGrid': False, 'inMemoryFracture': inMemoryFracture,
+               'waveletROIMargin': waveletROIMargin, 'gridROIMargin': gridROIMargin,
+               'lowMemoryWavelets': lowMemoryWavelets}
 
-    print '========== Processing: ' + workingDirectory
+    tasks = []
     if simulateFracture:
-        num = 0
-
-        for planeEquation in planeEquations:
-            print "**** Processing fracture number: " + str(num)
-            namePostfix = '_'+str(num)
-            waveletAnalysisDirectoryName = 'FracturedToothWavelet' + namePostfix
-            simulateFractureAndCreateWavelets(workingDirectory, inputImage, inputLabelImage, resampledInput,
-                    waveletAnalysisDirectoryName, waveletAnalysisOutputPrefix,
-                    True, planeEquation,
-                    fractureSize, high_sub_bands, levels, targetSpacing, namePostfix, True)
-            num +=1
+        for num, (planeEquation, namePostfix, waveletAnalysisDirectoryName) in enumerate(caseFractures(planeEquations)):
+            tasks.append((directoryName + ' fracture ' + str(num), simulateFractureAndCreateWavelets,
+                          (workingDirectory, inputImage, inputLabelImage, resampledInput,
+                           waveletAnalysisDirectoryName, waveletAnalysisOutputPrefix,
+                           True, planeEquation,
+                           fractureSize, high_sub_bands, levels, targetSpacing, namePostfix, True), options))
     else:
-        print "***** Processing the resampled input"
         waveletAnalysisDirectoryName = 'NoFractureToothWavelet'
-        simulateFractureAndCreateWavelets(workingDirectory, inputImage, inputLabelImage, resampledInput,
-                waveletAnalysisDirectoryName, waveletAnalysisOutputPrefix,
-                False, [0,0,0,1],
-                fractureSize, high_sub_bands, levels, targetSpacing, '',  True)
+        tasks.append((directoryName + ' resampled input', simulateFractureAndCreateWavelets,
+                      (workingDirectory, inputImage, inputLabelImage, resampledInput,
+                       waveletAnalysisDirectoryName, waveletAnalysisOutputPrefix,
+                       False, [0,0,0,1],
+                       fractureSize, high_sub_bands, levels, targetSpacing, '',  True), options))
+    return tasks
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+                                     description='Tooth fracture simulation and wavelet analysis of the cases in '
+                                                 'DataSetDict (parameters are set in this script)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of (case, fracture plane) tasks to run in parallel')
+    parser.add_argument('--memoryLimit', type=float, default=None,
+                        help='memory (in GB) the concurrent tasks may use (default: the available memory)')
+    args = parser.parse_args(argv[1:])
+
+    # The reference grid (and the batch fracture simulation) is shared by all the planes of a case: do it first,
+    # once per case
+    print '========== Creating the reference grids'
+    memoryLimit = args.memoryLimit * 1024**3 if args.memoryLimit is not None else None
+    gridTasks = [(directoryName, prepareCase, (directoryName,), {}) for directoryName in DataSetDict]
+    gridMemoryPerJob = max([inputMemory(directoryName) for directoryName in DataSetDict] + [0])
+    gridResults = runTasks(gridTasks, args.jobs, gridMemoryPerJob, memoryLimit)
+
+    tasks = []
+    memoryPerJob = 0
+    for directoryName, caseMemory, error, taskTime in gridResults:
+        if error is None:
+            memoryPerJob = max(memoryPerJob, caseMemory)
+            tasks += planeTasks(directoryName, DataSetDict[directoryName])
+
+    featureWriter = None
+    onResult = None
+    if featureStatistics is not None:
+        featureWriter = createFeatureWriter(os.path.join(dataDirectory, featureCSVFile),
+                                            range(0, high_sub_bands*levels), featureStatistics)
+        onResult = lambda name, row: featureWriter.writeRow(*row)
+
+    try:
+        results = runTasks(tasks, args.jobs, memoryPerJob, memoryLimit, onResult, shareThreads)
+    finally:
+        # Writes the rows still buffered by a feature store
+        if featureWriter is not None:
+            featureWriter.close()
+    return 1 if any(error is not None for name, result, error, taskTime in gridResults + results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
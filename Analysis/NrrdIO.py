@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+import os
+import re
+import gzip
+import numpy
+
+'''
+Minimal NRRD reader returning NumPy arrays, so that the wavelet images can be read without ITK or Slicer.
+
+Supports the files written by ITK: attached or detached ("data file") data, raw or gzip encoding.
+Arrays are indexed like slicer.util.array: [k, j, i] (the first NRRD axis varies fastest).
+Raw data is memory mapped (read-only): nothing is read until the array is used, and only the pages of the part that
+is used (e.g. the cropped region the features are computed on) are read. Processes reading the same file share the
+page cache instead of each holding a copy. Gzip data is decompressed in blocks straight into the array.
+
+createNrrd() writes the header of a raw NRRD file and returns its data memory mapped for writing, so that large
+outputs (e.g. the fracture probability map) can be filled one slab at a time.
+'''
+
+NrrdTypes = {
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+    'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+    'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+    'float': 'f4', 'double': 'f8'}
+
+
+def readHeader(f):
+    '''
+    Reads the header of an opened NRRD file. Returns a dict of the fields (lower case names) and leaves f at the
+    beginning of the attached data.
+    '''
+    magic = f.readline()
+    if not magic.startswith('NRRD'):
+        raise IOError('Not a NRRD file: %s' % f.name)
+    header = {}
+    while True:
+        line = f.readline()
+        if line.strip() == '':
+            break
+        if line.startswith('#') or ':=' in line:
+            continue
+        field, value = line.split(':', 1)
+        header[field.strip().lower()] = value.strip()
+    return header
+
+
+def dataType(header):
+    dtype = numpy.dtype(NrrdTypes[header['type']])
+    if dtype.itemsize > 1 and header.get('endian', 'little') == 'big':
+        dtype = dtype.newbyteorder('>')
+    elif dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('<')
+    return dtype
+
+
+def shape(header):
+    return tuple(reversed([int(size) for size in header['sizes'].split()]))
+
+
+def spaceDirections(header):
+    '''
+    Returns the list of the space direction vectors (None for non-spatial axes), in NRRD axis order
+    '''
+    if 'space directions' not in header:
+        spacings = [float(value) for value in header['spacings'].split()]
+        return [[axisSpacing if i == axis else 0.0 for i in range(len(spacings))]
+                for axis, axisSpacing in enumerate(spacings)]
+    directions = []
+    for vector in re.findall(r'\([^)]*\)|none', header['space directions']):
+        if vector == 'none':
+            directions.append(None)
+        else:
+            directions.append([float(value) for value in vector.strip('()').split(',')])
+    return directions
+
+
+def spacing(header):
+    '''
+    Voxel spacing, in NRRD axis order (i, j, k)
+    '''
+    return [numpy.sqrt(numpy.dot(vector, vector)) for vector in spaceDirections(header) if vector is not None]
+
+
+def spaceOrigin(header):
+    '''
+    Physical point of the first voxel, in LPS coordinates (as in ITK)
+    '''
+    if 'space origin' not in header:
+        return [0.0] * len(spacing(header))
+    origin = [float(value) for value in header['space origin'].strip('()').split(',')]
+    return [value * sign for value, sign in zip(origin, spaceSigns(header))]
+
+
+def spaceSigns(header):
+    '''
+    Signs converting the coordinates of the NRRD space to LPS
+    '''
+    space = header.get('space', 'left-posterior-superior').lower()
+    if space in ('right-anterior-superior', 'ras', 'right-anterior-superior-time', 'ras-time'):
+        return [-1.0, -1.0, 1.0]
+    return [1.0, 1.0, 1.0]
+
+
+def direction(header):
+    '''
+    Direction matrix (ITK convention, LPS): column n is the unit vector of the n-th (spatial) NRRD axis
+    '''
+    vectors = [numpy.array(vector) * spaceSigns(header)[0:len(vector)]
+               for vector in spaceDirections(header) if vector is not None]
+    return numpy.array([vector / numpy.sqrt(numpy.dot(vector, vector)) for vector in vectors]).T
+
+
+def readNrrdHeader(fileName):
+    with open(fileName, 'rb') as f:
+        return readHeader(f)
+
+
+def readNrrd(fileName, mmap=True, blockSize=2**24):
+    '''
+    Returns (array, header) for the NRRD file fileName. Raw data is memory mapped (read-only view) unless mmap is
+    False, gzip data is decompressed blockSize bytes at a time into the array.
+    '''
+    with open(fileName, 'rb') as f:
+        header = readHeader(f)
+        dtype = dataType(header)
+        arrayShape = shape(header)
+        numberOfBytes = int(numpy.prod(arrayShape)) * dtype.itemsize
+        dataFileName = header.get('data file', header.get('datafile'))
+        if dataFileName is not None:
+            dataFileName = os.path.join(os.path.dirname(fileName), dataFileName)
+            dataFile = open(dataFileName, 'rb')
+        else:
+            dataFileName = fileName
+            dataFile = f
+        try:
+            for line in range(int(header.get('line skip', header.get('lineskip', 0)))):
+                dataFile.readline()
+            byteSkip = int(header.get('byte skip', header.get('byteskip', 0)))
+            encoding = header.get('encoding', 'raw')
+            if encoding == 'raw':
+                if byteSkip == -1:
+                    # The data is at the end of the file
+                    dataFile.seek(-numberOfBytes, os.SEEK_END)
+                else:
+                    dataFile.seek(byteSkip, os.SEEK_CUR)
+                if mmap and numberOfBytes > 0:
+                    array = numpy.memmap(dataFileName, dtype=dtype, mode='r', offset=dataFile.tell(),
+                                         shape=arrayShape)
+                else:
+                    array = numpy.frombuffer(dataFile.read(numberOfBytes), dtype=dtype).reshape(arrayShape)
+            elif encoding in ('gzip', 'gz'):
+                array = numpy.empty(arrayShape, dtype=dtype)
+                data = array.reshape(-1).view(numpy.uint8)
+                compressed = gzip.GzipFile(fileobj=dataFile, mode='rb')
+                # The byte skip of compressed data applies to the decompressed data
+                while byteSkip > 0:
+                    byteSkip -= len(compressed.read(min(byteSkip, blockSize)))
+                position = 0
+                while position < numberOfBytes:
+                    block = compressed.read(min(blockSize, numberOfBytes - position))
+                    if not block:
+                        break
+                    data[position:position + len(block)] = numpy.frombuffer(block, dtype=numpy.uint8)
+                    position += len(block)
+                if position != numberOfBytes:
+                    raise IOError('Truncated NRRD data: %s' % fileName)
+            else:
+                raise IOError('Unsupported NRRD encoding %s: %s' % (encoding, fileName))
+        finally:
+            if dataFile is not f:
+                dataFile.close()
+    return array, header
+
+
+def nrrdType(dtype):
+    return {'i1': 'int8', 'u1': 'uint8', 'i2': 'short', 'u2': 'ushort', 'i4': 'int', 'u4': 'uint',
+            'i8': 'longlong', 'u8': 'ulonglong', 'f4': 'float', 'f8': 'double'}[numpy.dtype(dtype).str[1:]]
+
+
+def createNrrd(fileName, arrayShape, dtype, origin, spacing, direction):
+    '''
+    Writes a raw (little endian) NRRD file of shape arrayShape ([k, j, i]) and returns its data as a writable
+    memmap, initialized with 0. origin, spacing and direction are in LPS and ITK conventions (see direction()).
+    '''
+    dtype = numpy.dtype(dtype).newbyteorder('<')
+    direction = numpy.asarray(direction, dtype=numpy.float64)
+    directions = ['(%s)' % ','.join('%.17g' % value for value in direction[:, axis] * spacing[axis])
+                  for axis in range(0, len(spacing))]
+    header = ['NRRD0004',
+              'type: ' + nrrdType(dtype),
+              'dimension: %d' % len(arrayShape),
+              'space: left-posterior-superior',
+              'sizes: ' + ' '.join(str(size) for size in reversed(arrayShape)),
+              'space directions: ' + ' '.join(directions),
+              'kinds: ' + ' '.join(['domain'] * len(arrayShape)),
+              'endian: little',
+              'encoding: raw',
+              'space origin: (%s)' % ','.join('%.17g' % value for value in origin)]
+    with open(fileName, 'wb') as f:
+        f.write('\n'.join(header) + '\n\n')
+        offset = f.tell()
+        numberOfBytes = int(numpy.prod(arrayShape)) * dtype.itemsize
+        if numberOfBytes > 0:
+            # Sparse file: the data is allocated as it is written
+            f.seek(offset + numberOfBytes - 1)
+            f.write('\0')
+    if numberOfBytes == 0:
+        return numpy.zeros(arrayShape, dtype=dtype)
+    return numpy.memmap(fileName, dtype=dtype, mode='r+', offset=offset, shape=tuple(arrayShape))
+
+
+def writeNrrd(fileName, array, origin, spacing, direction):
+    data = createNrrd(fileName, array.shape, array.dtype, origin, spacing, direction)
+    data[...] = array
+    del data
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import os
+import json
+import hashlib
+import tempfile
+
+'''
+Manifest of the stages of the tooth fracture pipeline (grid, fracture, wavelets, features), used to rerun only the
+stages whose inputs changed.
+
+For each stage, the manifest records a signature: a hash of the contents of its input files and of its parameters,
+as well as the size and modification time of each output file. A stage is up to date if its signature is unchanged
+and its outputs are still there, unmodified. Changing a parameter (e.g. the plane equation or fractureSize) changes
+the signature of the stage, and the new outputs change the signature of the stages using them.
+Stages without output files (e.g. the features) can store their result in the manifest.
+
+The outputs are not hashed when they are recorded: a file is only hashed when it is the input of a stage. File hashes
+are cached with the size and modification time of the file in a DigestCache shared by the manifests of a directory
+(the plane manifests of a case all use the same input images), so that the (large) images are hashed once, and
+again only when they change.
+'''
+
+
+def fileDigest(path, blockSize=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def fileStamp(path):
+    '''
+    [size, modification time] of path, None if it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    status = os.stat(path)
+    return [status.st_size, status.st_mtime]
+
+
+class DigestCache(object):
+    '''
+    Hashes of the files of a directory, cached with their size and modification time in
+    <directory>/pipelineDigests.json. Use digestCache() to get the cache of a directory: the manifests of the directory
+    in a process share it. Concurrent processes merge their hashes with the file when they save it.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'pipelineDigests.json')
+        self.digests = self.load()
+        self.changed = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory)
+
+    def digest(self, path):
+        '''
+        Hash of the content of path (None if it does not exist), computed again only if the file changed
+        '''
+        stamp = fileStamp(path)
+        if stamp is None:
+            return None
+        key = self.key(path)
+        cached = self.digests.get(key)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        digest = fileDigest(path)
+        self.digests[key] = stamp + [digest]
+        self.changed = True
+        return digest
+
+    def save(self):
+        if not self.changed:
+            return
+        digests = self.load()
+        digests.update(self.digests)
+        self.digests = digests
+        # Unique temporary file: other processes may save the cache of the same directory
+        handle, temporaryPath = tempfile.mkstemp(prefix='pipelineDigests', suffix='.tmp', dir=self.directory)
+        with os.fdopen(handle, 'w') as f:
+            json.dump(digests, f, indent=1, sort_keys=True)
+        os.rename(temporaryPath, self.path)
+        self.changed = False
+
+
+# DigestCache of each directory in this process
+digestCaches = {}
+
+
+def digestCache(directory):
+    directory = os.path.abspath(directory)
+    if directory not in digestCaches:
+        digestCaches[directory] = DigestCache(directory)
+    return digestCaches[directory]
+
+
+class Manifest(object):
+    def __init__(self, manifestPath):
+        self.manifestPath = manifestPath
+        self.directory = os.path.dirname(os.path.abspath(manifestPath))
+        self.stages = {}
+        self.digests = digestCache(self.directory)
+        if os.path.exists(manifestPath):
+            with open(manifestPath, 'r') as f:
+                content = json.load(f)
+            self.stages = content.get('stages', {})
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory)
+
+    def digest(self, path):
+        return self.digests.digest(path)
+
+    def signature(self, inputs, parameters):
+        sha1 = hashlib.sha1()
+        for path in inputs:
+            sha1.update('%s %s\n' % (self.key(path), self.digest(path)))
+        sha1.update(json.dumps(parameters, sort_keys=True))
+        return sha1.hexdigest()
+
+    def isUpToDate(self, stage, inputs, parameters, outputs=()):
+        entry = self.stages.get(stage)
+        if entry is None:
+            return False
+        signature = self.signature(inputs, parameters)
+        # Keeps the hashes of the inputs for the next manifests of the directory
+        self.digests.save()
+        if entry['signature'] != signature:
+            return False
+        if sorted(entry['outputs'].keys()) != sorted(self.key(path) for path in outputs):
+            return False
+        for path in outputs:
+            stamp = fileStamp(path)
+            if stamp is None or stamp != entry['outputs'][self.key(path)]:
+                return False
+        return True
+
+    def record(self, stage, inputs, parameters, outputs=(), result=None):
+        '''
+        Records a stage that just ran and saves the manifest
+        '''
+        self.stages[stage] = {'signature': self.signature(inputs, parameters),
+                              'outputs': dict((self.key(path), fileStamp(path)) for path in outputs),
+                              'result': result}
+        self.save()
+
+    def invalidate(self, stage):
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def result(self, stage):
+        return self.stages[stage]['result']
+
+    def save(self):
+        temporaryPath = self.manifestPath + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=1, sort_keys=True)
+        os.rename(temporaryPath, self.manifestPath)
+        self.digests.save()
@@ -1,21 +1,52 @@
 #!/usr/bin/env python
 
+import re
 import csv
 import sys
+import fnmatch
+import operator
+import time
+import argparse
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
-import matplotlib.pyplot as plt
 from blagging import *
+from FeatureStore import FeatureStore, isFeatureStore
 
 from sklearn import svm, datasets
+from sklearn.base import clone
 from sklearn.cross_validation import KFold, StratifiedKFold, cross_val_score
 from sklearn.metrics import auc, roc_auc_score, roc_curve, precision_recall_curve
 from sklearn.decomposition import PCA
 from scipy import interp
+from sklearn.externals import joblib
 
 '''
 This script runs creates a balanced Bagging ensemble classifier using SVM, and plots a KFold-cross validation
 mean ROC curve
 
+The cross-validation is repeated (--repetitions) with shuffled stratified folds to reduce the variance of the AUC of
+a single split of the few data points (a single repetition keeps the unshuffled folds of the original script). The repetitions run on a pool of worker processes (--jobs). The folds and the
+classifiers of each repetition are seeded from --seed, so that the results do not depend on the number of jobs.
+crossValidation() returns the per-fold ROC curves (true positive rates on a 100-point false positive rate grid) and
+AUCs, and the out-of-fold probabilities as NumPy arrays (see CrossValidationResults), which can be saved (--saveCV)
+to a .npz file; the plots are optional (--noPlot).
+
+The confidence intervals of the AUC and of the ROC curve (TPR band on the same grid) are computed by bootstrapping
+the data points (stratified: the --bootstrap replicates have as many data points of each class as the data). The AUC
+and ROC of a replicate are those of the out-of-fold probabilities of each repetition, averaged over the repetitions.
+All the replicates are computed at once from the number of times they draw each data point (see bootstrapROC()),
+with a rank-based AUC.
+
+The permutation test (--permutations) checks that the out-of-fold AUC (averaged over the first
+--permutationRepetitions repetitions of the cross-validation) is not chance: the labels are shuffled and the
+classifiers are trained again on the folds of those repetitions, on the pool of worker processes. The data, folds and
+permutations are shared by the workers, the AUC of the observed labels uses the out-of-fold probabilities of the
+cross-validation. The data points are shuffled over the labels rather than the labels over the data points, so
+that the folds stay stratified (the BlaggingClassifier fails on training folds with too few healthy teeth).
+With --permutationTime, the test stops after that time and uses the permutations that finished.
+The p-value is (number of permutations with an AUC at least the observed AUC + 1) / (permutations + 1).
+
 The synthetic tooth fracture data was imbalanced (6 healthy, 36 unhealthy) as of 4/4/2017,
 and hence a balanced bagging approach was used.
 
@@ -27,10 +58,22 @@ The input parameters:
  - A path to a csv file that is generated by ToothFractureStatistics Slicer extension.
  The CSV file will have class labels in the 3rd column, and wavelet responses in the columns after that.
  A header row is assumed to be present
- - 0-indexed column number with class labels
+ It can also be a feature store (<name>.features, see FeatureStore.py) with the same columns.
+ - 0-indexed column number (or name) with class labels
  - A string indicating positive class label
- - 0-indexed column number of data beginning
- - 0-indexed column number of data end.
+ - 0-indexed column number of data beginning (optional)
+ - 0-indexed column number of data end (optional).
+ - --columns pattern ... and/or --columnRegex expression ...: the data columns selected by name, glob pattern or
+ regular expression instead of (or in addition to) the column numbers
+ - --dtype float64|float32 (default float64): type of the data, read directly from the file (see readFeatureTable())
+ - --saveClassifier file (optional): the classifier trained on all the data points is saved to this file
+ (sklearn.externals.joblib), e.g. for FractureProbabilityMap.py.
+ - --folds n (default 3), --repetitions n (default 1), --seed n (default 0), --jobs n (default 1): cross-validation
+ - --saveCV file.npz (optional): cross-validation results
+ - --bootstrap n (default 2000), --confidence level (default 0.95): bootstrap confidence intervals
+ - --permutations n (default 0), --permutationRepetitions n (default 1), --permutationTime seconds (optional):
+ permutation test of the AUC
+ - --noPlot: only print the results
 
 Examples:
 ToothFractureROCAnalysis.py /path/to/ToothFractureAnalysis.csv 2 'Fractured' 3 6
@@ -38,34 +81,523 @@ ToothFractureROCAnalysis.py /path/to/ToothFractureAnalysis.csv 2 'Fractured' 3 6
 - The positive class label for binary classification is 'Fractured'
 - Data will be formed from columns 3-6 (0-indexed)
 
+ToothFractureROCAnalysis.py /path/to/ToothFractureAnalysis.csv Classification 'Fractured' --columns 'wavelet*'
+- Data will be formed from all the columns whose name starts with 'wavelet'
+
 '''
 
-def plot_ROC_curve(classifier, X, y, pos_label=1, n_folds=3):
-    mean_tpr = 0.0
-    mean_fpr = np.linspace(0, 1, 100)
-    all_tpr = []
-    plt.subplot(1, 2, 1)
-    # Create ROC Curves using KFold - cross validation.
-    for i, (train, test) in enumerate(StratifiedKFold(y, n_folds=n_folds)):
-        print 'Running fold ', i
-        probas_ = classifier.fit(X[train], y[train]).predict_proba(X[test])
-        print 'Number of positive labels in training: ', np.sum(y[train]), ' Number of negative lables in training: ', y[train].shape[0]-np.sum(y[train])
+def columnIndex(header, column):
+    '''
+    Index of column (0-indexed number, as an int or a string of digits, or name) in the header row. Negative numbers
+    count from the last column, as in Python.
+    '''
+    if isinstance(column, int) or column.lstrip('-').isdigit():
+        index = int(column)
+        if not -len(header) <= index < len(header):
+            raise ValueError('No column %d in the %d columns' % (index, len(header)))
+        return index % len(header)
+    if column not in header:
+        raise ValueError('No column %s in %s' % (column, ', '.join(header)))
+    return header.index(column)
+
+
+def selectColumns(header, columns=None, columnRegex=None, columnRange=None):
+    '''
+    Indices of the columns of header selected by names or glob patterns (columns, e.g. 'wavelet*'), regular
+    expressions (columnRegex, matching the whole name) or by a range of 0-indexed numbers (columnRange: (first, last),
+    both included, negative numbers count from the last column, see columnIndex()), in the order of the file.
+    '''
+    selected = set()
+    if columnRange is not None:
+        first, last = [columnIndex(header, bound) for bound in columnRange]
+        selected.update(range(first, last + 1))
+    for pattern in columns or []:
+        selected.update(index for index, name in enumerate(header) if fnmatch.fnmatchcase(name, pattern))
+    for pattern in columnRegex or []:
+        expression = re.compile(pattern + '$')
+        selected.update(index for index, name in enumerate(header) if expression.match(name))
+    return sorted(selected)
+
+
+def readFeatureTable(fileName, classLabelColumn, positiveClassName, columns=None, columnRegex=None, columnRange=None,
+                     dtype=np.float64):
+    '''
+    Reads the CSV file (with a header row) of the features in one pass, directly into a dtype array: the selected
+    fields of all the rows are parsed at once by numpy. The rows are split by csv.reader, so quoted fields may contain
+    commas.
+    Returns the features X (data points x selected columns, see selectColumns()), the binary labels y (1 for the
+    positiveClassName rows of the classLabelColumn column, see columnIndex()) and the names of the selected columns.
+    '''
+    labels = []
+    values = []
+    with open(fileName, 'r') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        labelIndex = columnIndex(header, classLabelColumn)
+        indices = selectColumns(header, columns, columnRegex, columnRange)
+        if not indices:
+            raise ValueError('No feature column selected in ' + fileName)
+        selectedFields = operator.itemgetter(*indices) if len(indices) > 1 else lambda fields: (fields[indices[0]],)
+        for fields in reader:
+            if not fields:
+                continue
+            labels.append(fields[labelIndex])
+            values.append(','.join(selectedFields(fields)))
+    X = np.fromstring(','.join(values), dtype=dtype, sep=',')
+    if X.size != len(values) * len(indices):
+        raise ValueError('%s: the selected columns are not all numbers' % fileName)
+    y = (np.array(labels) == positiveClassName).astype(int)
+    return X.reshape(len(values), len(indices)), y, [header[index] for index in indices]
+
+
+def readFeatureStore(path, classLabelColumn, positiveClassName, columns=None, columnRegex=None, columnRange=None,
+                     dtype=np.float64):
+    '''
+    Same as readFeatureTable() for a feature store (see FeatureStore.py): only the selected columns are read (memory
+    mapped), without conversion from text. float32 columns read into a wider dtype go through their text (the shortest
+    decimal of each value, as written in the CSV files), so that X is the same as readFeatureTable() gives.
+    '''
+    store = FeatureStore(path)
+    labelIndex = columnIndex(store.names, classLabelColumn)
+    indices = selectColumns(store.names, columns, columnRegex, columnRange)
+    if not indices:
+        raise ValueError('No feature column selected in ' + path)
+    X = np.empty((store.rows, len(indices)), dtype=dtype)
+    for column, index in enumerate(indices):
+        values = store.column(store.names[index])
+        if store.types[index] == 'float32' and np.dtype(dtype).itemsize > 4:
+            values = values.astype(str).astype(dtype)
+        X[:, column] = values
+    y = (store.column(store.names[labelIndex]) == positiveClassName).astype(int)
+    return X, y, [store.names[index] for index in indices]
+
+
+MAX_SEED = np.iinfo(np.int32).max
+# Number of classifier seeds tried on a fold (see fitFold())
+MAX_FIT_ATTEMPTS = 10
+
+
+class CrossValidationResults(object):
+    '''
+    Results of repeated stratified K-fold cross-validation (see crossValidation()):
+    - meanFPR: false positive rate grid the ROC curves are interpolated on
+    - tprs: true positive rates of each fold on meanFPR, shape (repetitions, folds, len(meanFPR))
+    - aucs: AUC of each fold, shape (repetitions, folds)
+    - folds: test fold of each data point, shape (repetitions, data points)
+    - probabilities: out-of-fold probability of the positive class of each data point, shape (repetitions, data points)
+    - seeds: seed of each repetition
+    '''
+    def __init__(self, meanFPR, tprs, aucs, folds, probabilities, seeds):
+        self.meanFPR = meanFPR
+        self.tprs = tprs
+        self.aucs = aucs
+        self.folds = folds
+        self.probabilities = probabilities
+        self.seeds = seeds
+
+    def meanTPR(self):
+        mean_tpr = self.tprs.reshape(-1, len(self.meanFPR)).mean(axis=0)
+        mean_tpr[-1] = 1.0
+        return mean_tpr
+
+    def meanAUC(self):
+        return auc(self.meanFPR, self.meanTPR())
+
+    def save(self, fileName):
+        np.savez(fileName, meanFPR=self.meanFPR, tprs=self.tprs, aucs=self.aucs, folds=self.folds,
+                 probabilities=self.probabilities, seeds=self.seeds)
+
+    @staticmethod
+    def load(fileName):
+        data = np.load(fileName)
+        return CrossValidationResults(data['meanFPR'], data['tprs'], data['aucs'], data['folds'],
+                                      data['probabilities'], data['seeds'])
+
+
+def fitFold(classifier, X, y, random_state):
+    '''
+    Fits a copy of classifier seeded from random_state. With few data points of one class (6 healthy teeth), a
+    bootstrap sample of the BlaggingClassifier may have no data point of that class: the fit is then retried with the
+    next seed of random_state (so that the result is still reproducible). Training data with a single class cannot be
+    fitted with any seed: raises ValueError.
+    '''
+    classes = np.unique(y)
+    if len(classes) < 2:
+        raise ValueError('The training folds only have the class %s' % classes)
+    for attempt in range(MAX_FIT_ATTEMPTS):
+        foldClassifier = clone(classifier).set_params(random_state=random_state.randint(MAX_SEED))
+        try:
+            return foldClassifier.fit(X, y)
+        except SingleClassSampleError:
+            if attempt == MAX_FIT_ATTEMPTS - 1:
+                raise
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+def outOfFoldProbabilities(classifier, X, y, folds, random_state, deadline=None):
+    '''
+    Probability of the positive class of each data point, predicted by classifier trained on the other folds (folds:
+    test fold of each data point). The classifiers are seeded from random_state.
+    If deadline (a time.time()) has passed before a fit, raises TimeLimitExceeded.
+    '''
+    probabilities = np.empty(len(y))
+    for i in range(folds.max() + 1):
+        if deadline is not None and time.time() > deadline:
+            raise TimeLimitExceeded()
+        test = folds == i
+        train = ~test
+        probabilities[test] = fitFold(classifier, X[train], y[train], random_state).predict_proba(X[test])[:, 1]
+    return probabilities
+
+
+def crossValidationRepetition(classifier, X, y, n_folds, seed, meanFPR, shuffle=True):
+    '''
+    One repetition of the cross-validation: stratified folds shuffled with seed (if shuffle), and classifiers seeded
+    from it. Returns the test fold and out-of-fold probability of each data point, and the interpolated TPR and AUC of each fold.
+    '''
+    folds = np.empty(len(y), dtype=np.int8)
+    tprs = np.empty((n_folds, len(meanFPR)))
+    aucs = np.empty(n_folds)
+    random_state = np.random.RandomState(seed)
+    foldSeed = random_state.randint(MAX_SEED)
+    for i, (train, test) in enumerate(StratifiedKFold(y, n_folds=n_folds, shuffle=shuffle,
+                                                      random_state=foldSeed if shuffle else None)):
+        folds[test] = i
+    probabilities = outOfFoldProbabilities(classifier, X, y, folds, random_state)
+    for i in range(n_folds):
+        test = folds == i
         # Compute ROC curve and area under the curve
-        fpr, tpr, thresholds = roc_curve(y[test], probas_[:, 1], pos_label=1)
-        mean_tpr += interp(mean_fpr, fpr, tpr)
-        mean_tpr[0] = 0.0
-        roc_auc = auc(fpr, tpr)
-        print 'AUC for fold ', i, ' ROC ', roc_auc
-        # Plot individual ROC curve
-        #plt.plot(fpr, tpr, lw=1, label='ROC fold %d (area = %0.2f)' % (i, roc_auc))
+        fpr, tpr, thresholds = roc_curve(y[test], probabilities[test], pos_label=1)
+        tprs[i] = interp(meanFPR, fpr, tpr)
+        tprs[i, 0] = 0.0
+        aucs[i] = auc(fpr, tpr)
+    return folds, probabilities, tprs, aucs
+
+
+# Data of each worker process
+workerData = None
+
+
+def initializeWorker(classifier, X, y, n_folds, meanFPR, shuffle):
+    global workerData
+    workerData = (classifier, X, y, n_folds, meanFPR, shuffle)
+
+
+def runRepetition(task):
+    repetition, seed = task
+    classifier, X, y, n_folds, meanFPR, shuffle = workerData
+    return (repetition,) + crossValidationRepetition(classifier, X, y, n_folds, seed, meanFPR, shuffle)
+
+
+def crossValidation(classifier, X, y, n_folds=3, repetitions=1, seed=0, jobs=1):
+    '''
+    Repeated stratified K-fold cross-validation of classifier on (X, y), with jobs worker processes.
+    The seeds of the repetitions are drawn from seed: the results only depend on seed, not on jobs. With a single
+    repetition, the folds are not shuffled (the stratified folds of the original script).
+    Returns a CrossValidationResults.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y)
+    meanFPR = np.linspace(0, 1, 100)
+    seeds = np.random.RandomState(seed).randint(MAX_SEED, size=repetitions)
+    tasks = list(enumerate(seeds))
+    # Shuffling only matters to draw different folds in each repetition
+    initializerArguments = (classifier, X, y, n_folds, meanFPR, repetitions > 1)
+    jobs = min(jobs, repetitions)
+    if jobs == 1:
+        initializeWorker(*initializerArguments)
+        taskResults = (runRepetition(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, initializeWorker, initializerArguments)
+        taskResults = pool.imap_unordered(runRepetition, tasks)
+    folds = np.empty((repetitions, len(y)), dtype=np.int8)
+    probabilities = np.empty((repetitions, len(y)))
+    tprs = np.empty((repetitions, n_folds, len(meanFPR)))
+    aucs = np.empty((repetitions, n_folds))
+    try:
+        for repetition, repetitionFolds, repetitionProbabilities, repetitionTPRs, repetitionAUCs in taskResults:
+            folds[repetition] = repetitionFolds
+            probabilities[repetition] = repetitionProbabilities
+            tprs[repetition] = repetitionTPRs
+            aucs[repetition] = repetitionAUCs
+    except BaseException:
+        if jobs != 1:
+            pool.terminate()
+            pool.join()
+        raise
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    return CrossValidationResults(meanFPR, tprs, aucs, folds, probabilities, seeds)
+
+
+def bootstrapCounts(y, n_bootstrap, random_state):
+    '''
+    Number of times each data point is drawn in each of n_bootstrap stratified bootstrap replicates (the data points of
+    each class are resampled separately, so that all the replicates have the same number of data points of each class),
+    shape (n_bootstrap, data points).
+    '''
+    counts = np.zeros((n_bootstrap, len(y)), dtype=np.int64)
+    offsets = len(y) * np.arange(n_bootstrap)[:, np.newaxis]
+    for label in (0, 1):
+        members = np.flatnonzero(y == label)
+        draws = random_state.choice(members, (n_bootstrap, len(members)))
+        counts += np.bincount((draws + offsets).ravel(), minlength=counts.size).reshape(counts.shape)
+    return counts
+
+
+def rankCounts(scores, y, counts):
+    '''
+    ROC of the data sets made of counts[i] copies of the data points (scores, y), for each row i of counts. The data
+    points are ranked once, by decreasing score: the ROC points of a data set are the cumulative counts of negatives and
+    positives at the end of each group of tied scores.
+    Returns the number of negatives and positives with a score higher than or equal to each group, starting with a
+    (0, 0) point: two arrays of shape (len(counts), number of distinct scores + 1).
+    '''
+    order = np.argsort(-scores, kind='mergesort')
+    sortedScores = scores[order]
+    ends = np.append(np.flatnonzero(sortedScores[:-1] != sortedScores[1:]), len(scores) - 1)
+    rocPoints = []
+    for label in (0, 1):
+        cumulative = np.cumsum(counts[:, order] * (y[order] == label), axis=1)
+        rocPoints.append(np.hstack([np.zeros((len(counts), 1), dtype=cumulative.dtype), cumulative[:, ends]]))
+    return rocPoints
+
+
+def rankAUC(negatives, positives):
+    '''
+    AUC (Mann-Whitney statistic, ties count 1/2) of each row of the cumulative counts of rankCounts()
+    '''
+    n_negatives = negatives[:, -1:].astype(np.float64)
+    n_positives = positives[:, -1:].astype(np.float64)
+    groupNegatives = np.diff(negatives, axis=1)
+    groupPositives = np.diff(positives, axis=1)
+    # Positives of each group times the negatives with a lower score, plus half of the negatives of the group
+    pairs = groupPositives * ((n_negatives - negatives[:, 1:]) + 0.5 * groupNegatives)
+    return pairs.sum(axis=1) / (n_positives[:, 0] * n_negatives[:, 0])
+
+
+def rocSegments(negatives, positives):
+    '''
+    Segments of the ROC curves of the cumulative counts of rankCounts() (all the rows have the same number of
+    negatives and positives). The false positive rates are multiples of 1/negatives: the segment starting at each of
+    these levels is given by its intercept and slope (arrays of shape (rows, negatives + 1)), the curves are
+    interpolated like the fold curves (see crossValidationRepetition()).
+    '''
+    n_rows, n_points = negatives.shape
+    n_negatives = negatives[0, -1]
+    fprLevels = np.arange(n_negatives + 1) / float(n_negatives)
+    tpr = positives / float(positives[0, -1])
+    # Last ROC point at or below each level
+    rowOffsets = (n_negatives + 1) * np.arange(n_rows)[:, np.newaxis]
+    levelCounts = np.bincount((negatives + rowOffsets).ravel(), minlength=n_rows * (n_negatives + 1))
+    first = np.cumsum(levelCounts.reshape(n_rows, n_negatives + 1), axis=1) - 1
+    second = np.minimum(first + 1, n_points - 1)
+    firstFPR = fprLevels[np.take_along_axis(negatives, first, axis=1)]
+    firstTPR = np.take_along_axis(tpr, first, axis=1)
+    width = fprLevels[np.take_along_axis(negatives, second, axis=1)] - firstFPR
+    slope = np.divide(np.take_along_axis(tpr, second, axis=1) - firstTPR, width, out=np.zeros(width.shape),
+                      where=width > 0)
+    return firstTPR - slope * firstFPR, slope
+
+
+def segmentTPR(intercept, slope, meanFPR):
+    '''
+    True positive rates on the false positive rate grid meanFPR of the segments of rocSegments()
+    '''
+    fprLevels = np.arange(intercept.shape[1]) / float(intercept.shape[1] - 1)
+    gridLevels = np.searchsorted(fprLevels, meanFPR, side='right') - 1
+    tprs = intercept.take(gridLevels, axis=1) + slope.take(gridLevels, axis=1) * meanFPR
+    tprs[:, 0] = 0.0
+    return tprs
+
+
+class BootstrapResults(object):
+    '''
+    Bootstrap replicates (stratified: the data points of each class are resampled separately) of the ROC of the
+    out-of-fold probabilities of the cross-validation:
+    - auc, tpr: on the original data points
+    - aucs: shape (replicates,), tprs: shape (replicates, len(meanFPR))
+    The AUC and TPR of a data set are averaged over the repetitions of the cross-validation.
+    '''
+    def __init__(self, meanFPR, auc, tpr, aucs, tprs):
+        self.meanFPR = meanFPR
+        self.auc = auc
+        self.tpr = tpr
+        self.aucs = aucs
+        self.tprs = tprs
+
+    def aucInterval(self, confidence=0.95):
+        return tuple(np.percentile(self.aucs, [50 * (1 - confidence), 50 * (1 + confidence)]))
+
+    def tprBand(self, confidence=0.95):
+        return np.percentile(self.tprs, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+
+def bootstrapROC(results, y, n_bootstrap=2000, seed=0):
+    '''
+    Bootstraps the data points of the cross-validation results (see CrossValidationResults) n_bootstrap times.
+    The data points of each repetition are ranked once, the ROC of all the replicates is computed from their counts.
+    The ROC segments are summed over the repetitions, then interpolated on the grid (the interpolation is linear).
+    Returns a BootstrapResults.
+    '''
+    y = np.asarray(y)
+    counts = np.vstack([np.ones((1, len(y)), dtype=np.int64),
+                        bootstrapCounts(y, n_bootstrap, np.random.RandomState(seed))])
+    aucs = 0.0
+    intercepts = 0.0
+    slopes = 0.0
+    for probabilities in results.probabilities:
+        negatives, positives = rankCounts(probabilities, y, counts)
+        aucs = aucs + rankAUC(negatives, positives)
+        intercept, slope = rocSegments(negatives, positives)
+        intercepts = intercepts + intercept
+        slopes = slopes + slope
+    repetitions = len(results.probabilities)
+    aucs /= repetitions
+    tprs = segmentTPR(intercepts / repetitions, slopes / repetitions, results.meanFPR)
+    return BootstrapResults(results.meanFPR, aucs[0], tprs[0], aucs[1:], tprs[1:])
+
+
+def outOfFoldAUC(probabilities, y):
+    '''
+    AUC of the out-of-fold probabilities of each repetition (rows of probabilities), averaged over the repetitions
+    '''
+    probabilities = np.atleast_2d(probabilities)
+    aucs = [rankAUC(*rankCounts(repetitionProbabilities, y, np.ones((1, len(y)), dtype=np.int64)))[0]
+            for repetitionProbabilities in probabilities]
+    return np.mean(aucs)
+
+
+def sharedArray(array, typecode):
+    '''
+    Copy of array in shared memory (multiprocessing.sharedctypes.RawArray), inherited by the worker processes without
+    being pickled. Returns (shared memory, shape, dtype), see sharedView().
+    '''
+    shared = RawArray(typecode, array.size)
+    view = np.frombuffer(shared, dtype=array.dtype)
+    view[:] = array.ravel()
+    return shared, array.shape, array.dtype
+
+
+def sharedView(shared):
+    memory, shape, dtype = shared
+    return np.frombuffer(memory, dtype=dtype).reshape(shape)
+
+
+# Data of each permutation worker process
+permutationData = None
+
+
+def initializePermutationWorker(classifier, X, y, folds, permutations, seeds):
+    global permutationData
+    permutationData = (classifier, sharedView(X), y, sharedView(folds), sharedView(permutations), seeds)
+
+
+def runPermutation(permutation, deadline=None):
+    '''
+    Out-of-fold AUC of the cross-validation with permuted labels. The data points are permuted instead of the labels
+    (the pairs of data points and labels are shuffled the same way): the labels, and hence the stratified folds of the
+    repetitions of the cross-validation, do not change. Only the classifiers are fitted again.
+    deadline: see outOfFoldProbabilities().
+    '''
+    classifier, X, y, folds, permutations, seeds = permutationData
+    permutedX = X[permutations[permutation]]
+    random_state = np.random.RandomState(seeds[permutation])
+    probabilities = [outOfFoldProbabilities(classifier, permutedX, y, repetitionFolds, random_state, deadline)
+                     for repetitionFolds in folds]
+    return permutation, outOfFoldAUC(probabilities, y)
+
+
+def permutationTest(classifier, X, y, results, n_permutations, repetitions=1, seed=0, jobs=1, timeLimit=None):
+    '''
+    Permutation test of the out-of-fold AUC of the cross-validation results (see CrossValidationResults), averaged over
+    its first repetitions: the labels y are shuffled n_permutations times and the classifiers are trained and evaluated
+    again on the same folds, by jobs worker processes (see runPermutation()). The data, folds and permutations, which do not depend on the
+    permuted labels, are computed once and shared by the workers. The observed AUC uses the cached out-of-fold
+    probabilities of the cross-validation.
+    If timeLimit (in seconds) is set, the permutations which did not finish in time are dropped (the running ones are
+    stopped: with one job, the time is checked before each fit, so the test may overrun by the time of one fit).
+    Returns the observed AUC and the AUC of each finished permutation (null distribution), see permutationPValue().
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y)
+    repetitions = min(repetitions, len(results.folds))
+    observed = outOfFoldAUC(results.probabilities[:repetitions], y)
+    random_state = np.random.RandomState(seed)
+    permutations = np.array([random_state.permutation(len(y)) for permutation in range(n_permutations)],
+                            dtype=np.int32).reshape(n_permutations, len(y))
+    seeds = random_state.randint(MAX_SEED, size=n_permutations)
+    initializerArguments = (classifier, sharedArray(X, 'd'), y, sharedArray(results.folds[:repetitions], 'b'),
+                            sharedArray(permutations, 'i'), seeds)
+    start = time.time()
+    null = np.empty(n_permutations)
+    finished = np.zeros(n_permutations, dtype=bool)
+    jobs = min(jobs, max(1, n_permutations))
+    if jobs == 1:
+        initializePermutationWorker(*initializerArguments)
+        deadline = start + timeLimit if timeLimit is not None else None
+        try:
+            for permutation in range(n_permutations):
+                null[permutation] = runPermutation(permutation, deadline)[1]
+                finished[permutation] = True
+        except TimeLimitExceeded:
+            pass
+        return observed, null[finished]
+    pool = multiprocessing.Pool(jobs, initializePermutationWorker, initializerArguments)
+    taskResults = pool.imap_unordered(runPermutation, range(n_permutations))
+    try:
+        for task in range(n_permutations):
+            if timeLimit is None:
+                permutation, permutationAUC = taskResults.next()
+            else:
+                permutation, permutationAUC = taskResults.next(max(0, timeLimit - (time.time() - start)))
+            null[permutation] = permutationAUC
+            finished[permutation] = True
+    except multiprocessing.TimeoutError:
+        pool.terminate()
+        pool.join()
+        return observed, null[finished]
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return observed, null[finished]
+
+
+def permutationPValue(observed, null):
+    '''
+    p-value of observed for the null distribution of a permutation test (counting the observed labels as one of the
+    permutations)
+    '''
+    return (np.count_nonzero(null >= observed) + 1.0) / (len(null) + 1)
+
+
+def plot_ROC_curve(results, bootstrap=None, confidence=0.95):
+    '''
+    Plots the mean of the ROC curves of the folds. With bootstrap (see bootstrapROC()), also plots the ROC of the
+    out-of-fold probabilities with its confidence band: the band and the AUC interval are those of this curve, not of
+    the mean of the folds.
+    '''
+    import matplotlib.pyplot as plt
+    plt.subplot(1, 2, 1)
+    if bootstrap is not None:
+        # Plot the out-of-fold ROC curve and its bootstrap confidence band
+        lower, upper = bootstrap.tprBand(confidence)
+        plt.fill_between(bootstrap.meanFPR, lower, upper, color=(0.8, 0.8, 0.8),
+                         label='Out-of-fold ROC %d%% CI (AUC %0.2f-%0.2f)' %
+                               ((100 * confidence,) + bootstrap.aucInterval(confidence)))
+        plt.plot(bootstrap.meanFPR, bootstrap.tpr, 'b-', label='Out-of-fold ROC (area = %0.2f)' % bootstrap.auc, lw=2)
     # Plot the center line
     plt.plot([0, 1], [0, 1], '--', color=(0.6, 0.6, 0.6), label='Midline')
-    mean_tpr /= n_folds
-    mean_tpr[-1] = 1.0
-    mean_auc = auc(mean_fpr, mean_tpr)
     # Plot the mean ROC curve
-    plt.plot(mean_fpr, mean_tpr, 'k--',
-         label='Mean ROC (area = %0.2f)' % mean_auc, lw=2)
+    plt.plot(results.meanFPR, results.meanTPR(), 'k--',
+         label='Mean ROC of the folds (area = %0.2f)' % results.meanAUC(), lw=2)
     plt.xlim([-0.05, 1.05])
     plt.ylim([-0.05, 1.05])
     plt.xlabel('False Positive Rate')
@@ -74,56 +606,113 @@ def plot_ROC_curve(classifier, X, y, pos_label=1, n_folds=3):
     plt.legend(loc="lower right")
 
 
-############ ENTRY POINT OF THE SCRIPT ################
-if len(sys.argv) != 6:
-  print "Usage: " + sys.argv[0] + " inputCSVFile classLabelColumn positiveClassName dataColumnMin dataColumnMax"
-  sys.exit(1)
-
-# Read in the csv file
-filepath  = sys.argv[1]
-with open(filepath, 'r') as f:
-    reader = csv.reader(f)
-    data = list(reader)
-
-classLabelColumn = int(sys.argv[2])
-dataColumnMin = int(sys.argv[4])
-dataColumnMax = int(sys.argv[5])
-positiveClassName = sys.argv[3]
-
-# Get the class names
-list1 = [classLabelColumn]
-Y = [[each_list[i] for i in list1] for each_list in data]
-Y.pop(0)
-# Create a binary label array to be passed to the classifiers.
-y = np.array([ (1 if val[0] == positiveClassName else 0) for val in Y])
-
-
-# Get the wavelet response values.
-list1 = range(dataColumnMin,dataColumnMax+1)
-x = [[each_list[i] for i in list1] for each_list in data]
-x.pop(0)
-
-X = np.asarray(x)
-print 'Found ', X.shape[0], ' data points with ', X.shape[1], ' features'
-
-plt.figure()
-plt.title('Synthetic Tooth Fracture detection')
-
-# setup an SVM classifier
-classifier = svm.SVC(kernel='linear', probability=True, C = 0.5)
-# Create ROC using balanced bagging classifier
-plot_ROC_curve(BlaggingClassifier(base_estimator=classifier, n_estimators=5), X, y)
-
-# Plot PCA's first two components to look at the data discrimination.
-pca = PCA(n_components=2)
-pcaX = pca.fit_transform(X)
-zero_class = np.where(y == 0)
-one_class = np.where(y == 1)
-plt.subplot(1, 2, 2)
-plt.scatter(pcaX[zero_class, 0], pcaX[zero_class, 1], s=160, edgecolors='b',
-            facecolors='none', linewidths=2, label='Not Fractured')
-plt.scatter(pcaX[one_class, 0], pcaX[one_class, 1], s=80, edgecolors='orange',
-            facecolors='none', linewidths=2, label='Fractured')
-plt.xlabel('PCA first component')
-plt.ylabel('PCA second component')
-plt.show()
\ No newline at end of file
+def plot_PCA(X, y):
+    import matplotlib.pyplot as plt
+    # Plot PCA's first two components to look at the data discrimination.
+    pca = PCA(n_components=2)
+    pcaX = pca.fit_transform(X)
+    zero_class = np.where(y == 0)
+    one_class = np.where(y == 1)
+    plt.subplot(1, 2, 2)
+    plt.scatter(pcaX[zero_class, 0], pcaX[zero_class, 1], s=160, edgecolors='b',
+                facecolors='none', linewidths=2, label='Not Fractured')
+    plt.scatter(pcaX[one_class, 0], pcaX[one_class, 1], s=80, edgecolors='orange',
+                facecolors='none', linewidths=2, label='Fractured')
+    plt.xlabel('PCA first component')
+    plt.ylabel('PCA second component')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('inputCSVFile')
+    parser.add_argument('classLabelColumn', help='0-indexed number or name of the column of the class labels')
+    parser.add_argument('positiveClassName')
+    parser.add_argument('dataColumnMin', type=int, nargs='?', default=None)
+    parser.add_argument('dataColumnMax', type=int, nargs='?', default=None)
+    parser.add_argument('--columns', nargs='+', default=None,
+                        help='names or glob patterns (e.g. \'wavelet*\') of the feature columns')
+    parser.add_argument('--columnRegex', nargs='+', default=None,
+                        help='regular expressions of the names of the feature columns')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='type of the features')
+    parser.add_argument('--saveClassifier', default=None, help='file the classifier trained on all the data is saved to')
+    parser.add_argument('--folds', type=int, default=3, help='number of cross-validation folds')
+    parser.add_argument('--repetitions', type=int, default=1, help='number of repetitions of the cross-validation')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the folds and classifiers')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--saveCV', default=None, help='.npz file the cross-validation results are saved to')
+    parser.add_argument('--bootstrap', type=int, default=2000,
+                        help='number of bootstrap replicates of the confidence intervals (0: none)')
+    parser.add_argument('--confidence', type=float, default=0.95, help='level of the confidence intervals')
+    parser.add_argument('--permutations', type=int, default=0,
+                        help='number of label permutations of the permutation test of the AUC (0: none)')
+    parser.add_argument('--permutationRepetitions', type=int, default=1,
+                        help='number of repetitions of the cross-validation of each permutation')
+    parser.add_argument('--permutationTime', type=float, default=None,
+                        help='time limit (in seconds) of the permutation test')
+    parser.add_argument('--noPlot', action='store_true', help='do not plot the ROC curve and PCA')
+    args = parser.parse_args(argv[1:])
+
+    columnRange = None
+    if args.dataColumnMin is not None:
+        columnRange = (args.dataColumnMin, args.dataColumnMax if args.dataColumnMax is not None else args.dataColumnMin)
+    elif not args.columns and not args.columnRegex:
+        parser.error('select the feature columns with dataColumnMin dataColumnMax, --columns or --columnRegex')
+
+    # Read in the csv file
+    readFeatures = readFeatureStore if isFeatureStore(args.inputCSVFile) else readFeatureTable
+    X, y, featureNames = readFeatures(args.inputCSVFile, args.classLabelColumn, args.positiveClassName,
+                                      args.columns, args.columnRegex, columnRange, np.dtype(args.dtype))
+    print 'Found ', X.shape[0], ' data points with ', X.shape[1], ' features'
+    print 'Features: ' + ', '.join(featureNames)
+
+    # setup an SVM classifier
+    classifier = svm.SVC(kernel='linear', probability=True, C = 0.5)
+    # Create ROC using balanced bagging classifier
+    start = time.time()
+    results = crossValidation(BlaggingClassifier(base_estimator=classifier, n_estimators=5), X, y,
+                              n_folds=args.folds, repetitions=args.repetitions, seed=args.seed, jobs=args.jobs)
+    print 'Cross-validation: %d repetitions of %d folds in %.1fs' % (args.repetitions, args.folds,
+                                                                     time.time() - start)
+    if args.repetitions == 1:
+        for i, roc_auc in enumerate(results.aucs[0]):
+            print 'AUC for fold ', i, ' ROC ', roc_auc
+    print 'Fold AUC: mean %.3f, std %.3f' % (results.aucs.mean(), results.aucs.std())
+    print 'Mean ROC AUC: %.3f' % results.meanAUC()
+    bootstrap = None
+    if args.bootstrap > 0:
+        start = time.time()
+        bootstrap = bootstrapROC(results, y, args.bootstrap, args.seed)
+        lower, upper = bootstrap.aucInterval(args.confidence)
+        print 'Out-of-fold ROC AUC: %.3f, %g%% bootstrap CI [%.3f, %.3f] (%d replicates in %.1fs)' % (
+            bootstrap.auc, 100 * args.confidence, lower, upper, args.bootstrap, time.time() - start)
+    if args.permutations > 0:
+        start = time.time()
+        observed, null = permutationTest(BlaggingClassifier(base_estimator=classifier, n_estimators=5), X, y, results,
+                                         args.permutations, args.permutationRepetitions, args.seed, args.jobs,
+                                         args.permutationTime)
+        print 'Permutation test: %d of %d permutations in %.1fs' % (len(null), args.permutations, time.time() - start)
+        if len(null) > 0:
+            print 'Out-of-fold ROC AUC: %.3f, null distribution: mean %.3f, std %.3f, p-value %.4f' % (
+                observed, null.mean(), null.std(), permutationPValue(observed, null))
+    if args.saveCV is not None:
+        results.save(args.saveCV)
+        print 'Cross-validation results saved to ', args.saveCV
+
+    if args.saveClassifier is not None:
+        # Trained on all the data points
+        finalClassifier = BlaggingClassifier(base_estimator=classifier, n_estimators=5).fit(X, y)
+        joblib.dump(finalClassifier, args.saveClassifier)
+        print 'Classifier saved to ', args.saveClassifier
+
+    if not args.noPlot:
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plt.title('Synthetic Tooth Fracture detection')
+        plot_ROC_curve(results, bootstrap, args.confidence)
+        plot_PCA(X, y)
+        plt.show()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
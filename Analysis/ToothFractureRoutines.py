@@ -1,21 +1,244 @@
 #!/usr/bin/env python
 import os
+import math
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
 from subprocess import call
 import itk
+from ITKIsoWavelets import readImage, iterateWavelets, writeWavelets, labelRegion, labelBounds, \
+    cropAndPad, peakMemory
+from NrrdIO import readNrrdHeader, shape, spacing
+from PipelineManifest import Manifest
+from FractureSimulation import cachedSimulator, resampleImage
+from WaveletFeatures import Geometry, blockMapsFileName, saveBlockMaps
 
 '''
 This file contains functions to run tooth fracture simulation and wavelet analysis.
 '''
 
+# locations of command line programs and python scripts
+###### *********** CHANGE THESE ************** ##############
+ITKTransformTool = 'ITKTransformTools-r/ITKTransformTools'
+ToothFractureSimulationCmd = 'ToothFracture/Simulation/ToothFractureSimulation'
+
+# Seed of the noise the fractures are filled with (ToothFractureSimulation and FractureSimulation.py)
+fractureNoiseSeed = 0
+
+# Wavelet of the pipeline (see ITKIsoWavelets.WaveletFunctions), recorded in the manifest of the wavelets stage
+pipelineWaveletType = 'Simoncelli'
+
+
+def imageGeometry(image):
+    '''
+    Grid of an ITK image (see WaveletFeatures.Geometry)
+    '''
+    direction = image.GetDirection().GetVnlMatrix()
+    return Geometry(reversed(image.GetLargestPossibleRegion().GetSize()), image.GetOrigin(), image.GetSpacing(),
+                    [[direction.get(row, column) for column in range(0, 3)] for row in range(0, 3)])
+
+
+def smoothedImage(image, smoothnessSigma):
+    '''
+    Returns image smoothed in memory (disconnected from the pipeline)
+    '''
+    smoothFilter = itk.SmoothingRecursiveGaussianImageFilter.New(image)
+    smoothFilter.SetSigma(smoothnessSigma)
+    smoothFilter.Update()
+    output = smoothFilter.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
 
 def smoothImage(inputImageFileName, outputImageFileName, smoothnessSigma):
     print 'Smoothing image: ', inputImageFileName, ' with Sigma ', smoothnessSigma
-    reader = itk.ImageFileReader.New(FileName=inputImageFileName)
-    reader.Update()
-    smoothFilter = itk.SmoothingRecursiveGaussianImageFilter.New(reader)
-    smoothFilter.SetSigma(smoothnessSigma)
+    itk.ImageFileWriter.New(Input=smoothedImage(readImage(inputImageFileName), smoothnessSigma),
+                            FileName= outputImageFileName).Update()
+
+
+def shareThreads(jobs):
+    '''
+    Gives each of jobs concurrent worker processes its share of the CPUs for the ITK filters
+    '''
+    numberOfThreads = max(1, multiprocessing.cpu_count() // jobs)
+    multiThreader = getattr(itk, 'MultiThreaderBase', None) or itk.MultiThreader
+    multiThreader.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+
+
+def referenceGridName(targetSpacing, roiMargin=None):
+    if roiMargin is not None:
+        return 'grid_'+str(targetSpacing)+'_roi'+str(roiMargin)+'_iso.nrrd'
+    return 'grid_'+str(targetSpacing)+'_iso.nrrd'
+
+
+def manifestPath(workingDirectory, name):
+    '''
+    Manifest (see PipelineManifest.py) of the stages of the case in workingDirectory: one for the reference grid
+    (name='grid') and one per wavelet analysis directory, so that concurrent tasks never write the same manifest.
+    '''
+    return os.path.join(workingDirectory, 'pipelineManifest_' + name + '.json')
+
+
+def roiGrid(inputImage, labelImage, targetSpacing, roiMargin):
+    '''
+    Returns an empty image with targetSpacing isotropic spacing and the direction of inputImage, covering the bounding
+    box of the tooth and dark labels (1 and 2) of labelImage plus roiMargin mm, clipped to inputImage.
+    '''
+    bounds = labelBounds(inputImage, labelImage, roiMargin, labels=[1, 2])
+    if bounds is None:
+        raise RuntimeError('No tooth label to create the reference grid')
+    inputSize = inputImage.GetLargestPossibleRegion().GetSize()
+    inputSpacing = inputImage.GetSpacing()
+    lower = itk.ContinuousIndex[itk.D, 3]()
+    size = []
+    for axis in range(0, 3):
+        lowerEdge = max(-0.5, bounds[0][axis])
+        upperEdge = min(inputSize[axis] - 0.5, bounds[1][axis])
+        size.append(max(1, int(math.ceil((upperEdge - lowerEdge) * inputSpacing[axis] / targetSpacing))))
+        # Center of the first voxel of the grid
+        lower.SetElement(axis, lowerEdge + 0.5 * targetSpacing / inputSpacing[axis])
+    grid = itk.Image[itk.UC, 3].New()
+    region = itk.ImageRegion[3]()
+    region.SetSize(size)
+    grid.SetRegions(region)
+    grid.SetSpacing([targetSpacing] * 3)
+    grid.SetDirection(inputImage.GetDirection())
+    grid.SetOrigin(inputImage.TransformContinuousIndexToPhysicalPoint(lower))
+    grid.Allocate()
+    grid.FillBuffer(0)
+    return grid
+
+
+def createReferenceGrid(workingDirectory, inputImage, targetSpacing, overwrite=False, inputLabelImage=None,
+                        roiMargin=None):
+    '''
+    Create reference image (empty image, grid) with targetSpacing isotropic spacing (e.g. 0.085) covering inputImage.
+    Returns the name of the grid image in workingDirectory. Skipped if the grid is up to date.
+    If roiMargin is set (in mm), the grid only covers the tooth (labels 1 and 2 of inputLabelImage) plus this margin
+    (see roiGrid()), instead of the whole field of view.
+    git clone git@github.com:fbudin69500/ITKTransformTools.git
+    '''
+    spacingStr = str(targetSpacing)
+    emptyImageName = referenceGridName(targetSpacing, roiMargin)
+    manifest = Manifest(manifestPath(workingDirectory, 'grid'))
+    inputs = [os.path.join(workingDirectory, inputImage)]
+    if roiMargin is None:
+        stage = 'grid'
+        parameters = {'targetSpacing': targetSpacing, 'tool': ITKTransformTool}
+    else:
+        stage = 'roiGrid'
+        inputs.append(os.path.join(workingDirectory, inputLabelImage))
+        parameters = {'targetSpacing': targetSpacing, 'roiMargin': roiMargin}
+    outputs = [os.path.join(workingDirectory, emptyImageName)]
+    if not overwrite and manifest.isUpToDate(stage, inputs, parameters, outputs):
+        print 'Reference grid is up to date: ' + outputs[0]
+        return emptyImageName
+
+    if roiMargin is None:
+        commandLine = [ITKTransformTool,
+                        'size', os.path.join(workingDirectory, inputImage),
+                        '-', '--grid', os.path.join(workingDirectory, emptyImageName),
+                        '--spacing', spacingStr, spacingStr, spacingStr]
+        print commandLine
+        if call(commandLine) != 0:
+            raise RuntimeError('Reference grid creation failed: ' + ' '.join(commandLine))
+    else:
+        print 'Creating the reference grid of the tooth: ' + outputs[0]
+        grid = roiGrid(readImage(inputs[0]), readImage(inputs[1]), targetSpacing, roiMargin)
+        itk.ImageFileWriter.New(Input=grid, FileName=outputs[0]).Update()
+    manifest.record(stage, inputs, parameters, outputs)
+    return emptyImageName
+
+
+def estimateJobMemory(workingDirectory, inputImage, targetSpacing, high_sub_bands, gridImage=None, lowMemory=False):
+    '''
+    Rough peak memory (in bytes) of simulateFractureAndCreateWavelets for one image: computed from the size of
+    gridImage (the reference grid) if given and it exists, or else of inputImage resampled at targetSpacing. Counts the resampled
+    image, label and noise image of the simulation, the float image, its spectrum, one band spectrum and the cached real
+    filter banks of all levels (each level is 1/8 of the previous one). With lowMemory, the spectra and the filter
+    banks only have half of the frequencies (see ITKIsoWavelets.iterateWavelets()).
+    '''
+    numberOfVoxels = 1
+    if gridImage is not None and os.path.exists(os.path.join(workingDirectory, gridImage)):
+        for size in shape(readNrrdHeader(os.path.join(workingDirectory, gridImage))):
+            numberOfVoxels *= size
+    else:
+        header = readNrrdHeader(os.path.join(workingDirectory, inputImage))
+        for size, inputSpacing in zip(reversed(shape(header)), spacing(header)):
+            numberOfVoxels *= int(size * inputSpacing / targetSpacing) + 1
+    spectrumBytesPerVoxel = 4 if lowMemory else 8
+    filterBytesPerVoxel = 2 if lowMemory else 4
+    bytesPerVoxel = 2 + 1 + 4 + 4 + 2 * spectrumBytesPerVoxel + filterBytesPerVoxel * (high_sub_bands + 1) * 8.0 / 7
+    return int(numberOfVoxels * bytesPerVoxel)
+
+
+def fractureStage(workingDirectory, inputImage, inputLabelImage, emptyImageName, planeEquation, fractureSize,
+                  namePostfix):
+    '''
+    Returns the (inputs, parameters, outputs) of the fracture stage of one plane, as recorded in the manifest
+    '''
+    inputs = [os.path.join(workingDirectory, inputImage),
+              os.path.join(workingDirectory, emptyImageName),
+              os.path.join(workingDirectory, inputLabelImage)]
+    parameters = {'planeEquation': list(planeEquation), 'fractureSize': fractureSize, 'noiseSeed': fractureNoiseSeed,
+                  'tool': ToothFractureSimulationCmd}
+    outputs = [os.path.join(workingDirectory, 'fracturedTooth' + namePostfix + '.nrrd'),
+               os.path.join(workingDirectory, 'fracturedToothLabel' + namePostfix + '.nrrd')]
+    return inputs, parameters, outputs
+
+
+@contextmanager
+def scratchFile(suffix='.nrrd'):
+    '''
+    Context manager giving a unique temporary file name, on tmpfs (/dev/shm) if available, removed on exit.
+    For the intermediate data that has to go through a file, e.g. the planes file of simulateFractures(): the stages
+    pass images in memory otherwise.
+    '''
+    scratchDirectory = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+    fileDescriptor, fileName = tempfile.mkstemp(suffix=suffix, prefix='ToothFracture', dir=scratchDirectory)
+    os.close(fileDescriptor)
+    try:
+        yield fileName
+    finally:
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+
+def simulateFractures(workingDirectory, inputImage, inputLabelImage, fractures, fractureSize, targetSpacing,
+                      overwrite=False, gridROIMargin=None):
+    '''
+    Simulates all the fractures of a case with one run of ToothFractureSimulation (batch mode): the image and the
+    label are resampled and the noise image is generated once for all the planes.
+    fractures is a list of (planeEquation, namePostfix, waveletAnalysisDirectoryName), with the same values as
+    the corresponding calls of simulateFractureAndCreateWavelets. The fracture stage of each plane is recorded in its
+    manifest, so that simulateFractureAndCreateWavelets then skips it. Planes that are up to date are not simulated
+    again. The reference grid must have been created with createReferenceGrid().
+    '''
+    emptyImageName = referenceGridName(targetSpacing, gridROIMargin)
+    pending = []
+    for planeEquation, namePostfix, waveletAnalysisDirectoryName in fractures:
+        manifest = Manifest(manifestPath(workingDirectory, waveletAnalysisDirectoryName))
+        stage = fractureStage(workingDirectory, inputImage, inputLabelImage, emptyImageName, planeEquation,
+                              fractureSize, namePostfix)
+        if overwrite or not manifest.isUpToDate('fracture', *stage):
+            pending.append((manifest, planeEquation, stage))
+    if not pending:
+        print 'Bypassing simulating fractures since all the fractures are up to date'
+        return
+    print 'Simulating %d fractures' % len(pending)
+    inputs = pending[0][2][0]
+    with scratchFile('.txt') as planesFileName:
+        with open(planesFileName, 'w') as planesFile:
+            for manifest, planeEquation, (planeInputs, parameters, outputs) in pending:
+                planesFile.write('\t'.join([str(value) for value in planeEquation[0:4]] + outputs) + '\n')
+        commandLine = [ToothFractureSimulationCmd, '--planes', planesFileName] + inputs + \
+                      [str(fractureSize), str(fractureNoiseSeed)]
+        print commandLine
+        if call(commandLine) != 0:
+            raise RuntimeError('Fracture simulation failed: ' + ' '.join(commandLine))
+    for manifest, planeEquation, (planeInputs, parameters, outputs) in pending:
+        manifest.record('fracture', planeInputs, parameters, outputs)
 
-    itk.ImageFileWriter.New(Input=smoothFilter.GetOutput(), FileName= outputImageFileName).Update()
 
 '''
 Function to simulate the fractures and create wavelets
@@ -36,13 +259,37 @@ Input parameters:
 - targetSpacing: target resampled resolution (in mm) for the input image. Fractures will be simulated at this resolution.
 - namePostfix = '': A postfix to be applied to wavelet directory names
 - tamper=False: If True grayscale images are tampered with a little. Right now smoothness is applied
-- overwrite = False: If True function will redo fracture simulation and generate respective output.
+- overwrite = False: If True function will redo all the stages and generate respective output. Otherwise the stages
+  (fracture, wavelets including the smoothing, features) whose inputs and parameters did not change since they last
+  ran are skipped (see PipelineManifest.py).
+- filterBankStore = None: If set, directory where the wavelet filter banks are written (once per image size).
+- lowMemoryWavelets = False: If True the wavelets are computed from half of the spectrum of the image (see
+  ITKIsoWavelets.iterateWavelets()), which uses less memory. The results differ from the standard path by rounding.
+- writeWaveletImages = True: If False the wavelet images are not written (use with featureStatistics).
+- featureStatistics = None: A WaveletFeatures.WaveletStatistics. If set, the features of each wavelet image are
+  computed as soon as it is available. If it has maskLabels, they are computed on the tooth label (fractured label,
+  or inputLabelImage for the healthy image) mapped on each wavelet level. If it has a blockSize, the block maps of the
+  wavelet bands are saved in <waveletAnalysisDirectoryName>_blocks.npz (see WaveletFeatures.blockMaps()).
+- createGrid = True: If False the reference grid must have been created with createReferenceGrid().
+- inMemoryFracture = False: If True the fracture is simulated in this process (FractureSimulation.py, same output as
+  ToothFractureSimulation) and passed in memory to the wavelet analysis: the fractured image and label are not written.
+- waveletROIMargin = None: If set (in mm), the wavelet analysis is restricted to the bounding box of the tooth label
+  (fractured label, or inputLabelImage for the healthy image) plus this margin, grown to a size for which the FFT is
+  fast. The wavelet images cover that region (with its origin) instead of the whole image.
+- gridROIMargin = None: If set (in mm), the reference grid only covers the tooth (labels 1 and 2) plus this margin
+  (see createReferenceGrid()): the fracture is simulated on this grid, and inputImage is resampled (linear) on it for
+  the healthy image instead of using resampledInput.
 
 ---------
 Outputs:
 ---------
-- If simulateFracture is true: a grayscale image and corresponding label map with the tooth fracture.
-- A directory with high_sub_bands*levels wavelet output signal images.
+- If simulateFracture is true (and inMemoryFracture is false): a grayscale image and corresponding label map with the
+  tooth fracture.
+- A directory with high_sub_bands*levels wavelet output signal images (unless writeWaveletImages is False).
+- Returned, if featureStatistics is set: the row of wavelet features [caseName, waveletAnalysisDirectoryName,
+  classification, features] (see WaveletFeatures.FeatureCSVWriter.writeRow).
+- pipelineManifest_<waveletAnalysisDirectoryName>.json in workingDirectory, recording the stages that ran, and
+  pipelineDigests.json, the hashes of the input files shared by the manifests of the case.
 
 
 -------------
@@ -51,7 +298,7 @@ Dependencies:
 - ITK compiled with python wrapping and virtual environment setup with itk is ideal to have
 - ITKTransformTools: git@github.com:fbudin69500/ITKTransformTools.git
 - ToothFractureSimulation command line: from repository: clone git@github.com:fbudin69500/ToothFracture.git
-- Wavelet analysis script from above repository
+- Wavelet analysis module (ITKIsoWavelets.py) from above repository, imported from this directory
 - ITKIsotropicWavelets compiled with BUILD_TESTING OFF, and WRAP_PYTHON ON during cmake configuration
 - Change paths to the tools inside the function before you run.
 
@@ -61,71 +308,154 @@ def simulateFractureAndCreateWavelets(workingDirectory, inputImage, inputLabelIm
             waveletAnalysisDirectoryName, waveletAnalysisOutputPrefix,
             simulateFracture, planeEquation,
             fractureSize, high_sub_bands, levels,
-            targetSpacing, namePostfix = '', tamper=False, overwrite = False):
-
-    # locations of command line programs and python scripts
-    ###### *********** CHANGE THESE ************** ##############
-    ITKTransformTool = 'ITKTransformTools-r/ITKTransformTools'
-    ToothFractureSimulationCmd = 'ToothFracture/Simulation/ToothFractureSimulation'
-    ToothFractureAnalysisScript = 'ToothFracture/Analysis/ITKIsoWavelets.py'
+            targetSpacing, namePostfix = '', tamper=False, overwrite = False, filterBankStore = None,
+            writeWaveletImages = True, featureStatistics = None, createGrid = True, inMemoryFracture = False,
+            waveletROIMargin = None, gridROIMargin = None, lowMemoryWavelets = False):
 
-    '''
-    Create reference image (empty image, grid) with 0.085 isotropic spacing:
-    git clone git@github.com:fbudin69500/ITKTransformTools.git
-    '''
-    spacingStr = str(targetSpacing)
-    emptyImageName = 'grid_'+spacingStr+'_iso.nrrd'
-
-    commandLine = [ITKTransformTool,
-                    'size', os.path.join(workingDirectory, inputImage),
-                    '-', '--grid', os.path.join(workingDirectory, emptyImageName),
-                    '--spacing', spacingStr, spacingStr, spacingStr]
-    print commandLine
-    call(commandLine)
+    if createGrid:
+        emptyImageName = createReferenceGrid(workingDirectory, inputImage, targetSpacing,
+                                             inputLabelImage=inputLabelImage, roiMargin=gridROIMargin)
+    else:
+        emptyImageName = referenceGridName(targetSpacing, gridROIMargin)
+    # Each stage is skipped if its inputs and parameters did not change since it last ran
+    manifest = Manifest(manifestPath(workingDirectory, waveletAnalysisDirectoryName))
 
     inputForWaveletAnalysis = ''
     if simulateFracture:
         # Run fracture simulation
         # git clone git@github.com:fbudin69500/ToothFracture.git
 
-        outputFractureFile = os.path.join(workingDirectory, 'fracturedTooth'+namePostfix+'.nrrd')
+        inputs, parameters, outputs = fractureStage(workingDirectory, inputImage, inputLabelImage, emptyImageName,
+                                                    planeEquation, fractureSize, namePostfix)
+        outputFractureFile = outputs[0]
 
+        if inMemoryFracture:
+            # The fractured image is computed in memory when the wavelets run: the wavelets stage depends on the
+            # inputs and parameters of the simulation
+            simulationInputs = inputs
+            simulationParameters = {'planeEquation': list(planeEquation), 'fractureSize': fractureSize,
+                                    'noiseSeed': fractureNoiseSeed, 'engine': 'FractureSimulation'}
         # Run the fracture simulatin
-        if overwrite or  not os.path.exists(outputFractureFile):
+        elif overwrite or not manifest.isUpToDate('fracture', inputs, parameters, outputs):
             print 'Simulating fracture'
-            commandLine = [ToothFractureSimulationCmd,
-                           os.path.join(workingDirectory, inputImage),
-                           os.path.join(workingDirectory, emptyImageName),
-                           os.path.join(workingDirectory, inputLabelImage),
-                           outputFractureFile,
-                           os.path.join(workingDirectory, 'fracturedToothLabel' + namePostfix + '.nrrd'),
-                           str(planeEquation[0]), str(planeEquation[1]), str(planeEquation[2]), str(planeEquation[3]),
-                           str(fractureSize)]
+            commandLine = [ToothFractureSimulationCmd] + inputs + outputs + \
+                          [str(planeEquation[0]), str(planeEquation[1]), str(planeEquation[2]), str(planeEquation[3]),
+                           str(fractureSize), str(fractureNoiseSeed)]
             print commandLine
-            call(commandLine)
+            if call(commandLine) != 0:
+                raise RuntimeError('Fracture simulation failed: ' + ' '.join(commandLine))
+            manifest.record('fracture', inputs, parameters, outputs)
         else:
-            print "Bypassing simulating fractures since either the file exists and overwrite was not requested"
-        inputForWaveletAnalysis = os.path.join(workingDirectory, 'fracturedTooth'+namePostfix+'.nrrd')
+            print "Bypassing simulating fractures since the fracture is up to date and overwrite was not requested"
+        if not inMemoryFracture:
+            inputForWaveletAnalysis = outputFractureFile
+        roiLabelFile = outputs[1]
+    elif gridROIMargin is not None:
+        # resampledInput covers the whole field of view: the input is resampled on the grid of the tooth instead
+        inputForWaveletAnalysis = os.path.join(workingDirectory, inputImage)
+        roiLabelFile = os.path.join(workingDirectory, inputLabelImage)
     else:
         inputForWaveletAnalysis = os.path.join(workingDirectory, resampledInput)
+        roiLabelFile = os.path.join(workingDirectory, inputLabelImage)
 
-    if tamper:
-        print 'Will tamper with image here'
-        tamperedOutputFileName = os.path.join(workingDirectory, 'temp.nrrd')
-        smoothImage(inputForWaveletAnalysis, tamperedOutputFileName, 1.5*fractureSize)
-        inputForWaveletAnalysis = tamperedOutputFileName
+    # The smoothing (tamper) output is passed in memory to the wavelet analysis: it is part of the wavelets stage
+    smoothingSigma = 1.5*fractureSize if tamper else None
 
-    # Run wavelet analysis
-    print "Running wavelet analysis"
     waveletDirectoryPath = os.path.join(workingDirectory, waveletAnalysisDirectoryName)
-    if not os.path.exists(waveletDirectoryPath):
-        print 'creating directory: ' + waveletDirectoryPath
-        os.mkdir(waveletDirectoryPath)
+    waveletOutputPrefix = os.path.join(waveletDirectoryPath, waveletAnalysisOutputPrefix)
+    inputs = [inputForWaveletAnalysis]
+    waveletParameters = {'high_sub_bands': high_sub_bands, 'levels': levels, 'wavelet': pipelineWaveletType,
+                         'smoothingSigma': smoothingSigma}
+    if simulateFracture and inMemoryFracture:
+        inputs = simulationInputs
+        waveletParameters['fracture'] = simulationParameters
+    elif not simulateFracture and gridROIMargin is not None:
+        inputs = inputs + [os.path.join(workingDirectory, emptyImageName)]
+        waveletParameters['resampledOn'] = emptyImageName
+    if waveletROIMargin is not None:
+        # The wavelets are computed on the bounding box of the tooth label (see ITKIsoWavelets.cropAndPad())
+        waveletParameters['roiMargin'] = waveletROIMargin
+        if not (simulateFracture and inMemoryFracture):
+            inputs = inputs + [roiLabelFile]
+    if lowMemoryWavelets:
+        waveletParameters['lowMemory'] = True
+    waveletOutputs = [waveletOutputPrefix+str(nOutput)+'.nrrd' for nOutput in range(0, high_sub_bands*levels+1)]
+    featureParameters = dict(waveletParameters)
+    featureInputs = inputs
+    useLabelMask = featureStatistics is not None and featureStatistics.maskLabels is not None
+    if featureStatistics is not None:
+        featureParameters['statistics'] = featureStatistics.parameters()
+        if useLabelMask and roiLabelFile not in inputs and not (simulateFracture and inMemoryFracture):
+            featureInputs = inputs + [roiLabelFile]
+    runWavelets = writeWaveletImages and \
+                  (overwrite or not manifest.isUpToDate('wavelets', inputs, waveletParameters, waveletOutputs))
+    featureOutputs = []
+    if featureStatistics is not None and featureStatistics.blockSize is not None:
+        featureOutputs = [blockMapsFileName(waveletDirectoryPath)]
+    runFeatures = featureStatistics is not None and \
+                  (overwrite or not manifest.isUpToDate('features', featureInputs, featureParameters, featureOutputs))
 
-    commandLine = [ToothFractureAnalysisScript,
-                  inputForWaveletAnalysis,
-                  os.path.join(waveletDirectoryPath, waveletAnalysisOutputPrefix),
-                  str(high_sub_bands), str(levels)]
-    call(commandLine)
+    if runWavelets or runFeatures:
+        # Run wavelet analysis
+        print "Running wavelet analysis"
+        if runWavelets and not os.path.exists(waveletDirectoryPath):
+            print 'creating directory: ' + waveletDirectoryPath
+            os.mkdir(waveletDirectoryPath)
+        if runWavelets:
+            manifest.invalidate('wavelets')
+
+        # In process: the ITK import and wrapped types are shared by all the images of the run
+        if simulateFracture and inMemoryFracture:
+            print 'Simulating fracture in memory'
+            simulator = cachedSimulator(*simulationInputs, noiseSeed=fractureNoiseSeed)
+            image, label = simulator.simulate(planeEquation, fractureSize)
+        else:
+            image = readImage(inputForWaveletAnalysis)
+            if not simulateFracture and gridROIMargin is not None:
+                image = resampleImage(image, readImage(os.path.join(workingDirectory, emptyImageName)))
+        if (waveletROIMargin is not None or (runFeatures and useLabelMask)) and \
+                not (simulateFracture and inMemoryFracture):
+            label = readImage(roiLabelFile)
+        labelMask = None
+        if runFeatures and useLabelMask:
+            labelMask = featureStatistics.labelMask(itk.GetArrayViewFromImage(label), imageGeometry(label))
+        if tamper:
+            # Smoothed before the crop: the smoothing of the region must not see its mirror padding
+            print 'Will tamper with image here'
+            print 'Smoothing image with Sigma ', smoothingSigma
+            image = smoothedImage(image, smoothingSigma)
+        if waveletROIMargin is not None:
+            image = cropAndPad(image, levels, labelRegion(image, label, waveletROIMargin))
+        elif gridROIMargin is not None:
+            # The size of the grid of the tooth is arbitrary: padded to a size the FFT can use
+            image = cropAndPad(image, levels)
+        features = []
+        maps = {}
+        for nOutput, waveletImage in iterateWavelets(image, high_sub_bands, levels, filterBankStore=filterBankStore,
+                                                     waveletType=pipelineWaveletType, lowMemory=lowMemoryWavelets):
+            if runWavelets:
+                writeWavelets([(nOutput, waveletImage)], waveletOutputPrefix)
+            # Features are computed on the bands only, not on the approximation image
+            if runFeatures and nOutput < high_sub_bands*levels:
+                mask = labelMask(imageGeometry(waveletImage)) if labelMask is not None else None
+                features += featureStatistics(itk.GetArrayViewFromImage(waveletImage), mask, nOutput // high_sub_bands)
+                if featureOutputs:
+                    maps[nOutput] = featureStatistics.blockMaps(itk.GetArrayViewFromImage(waveletImage)) + \
+                                    (imageGeometry(waveletImage),)
+        print 'Wavelet analysis done, peak memory: %.1f MB' % (peakMemory() / 2.0**20)
+        if runWavelets:
+            manifest.record('wavelets', inputs, waveletParameters, waveletOutputs)
+        if runFeatures:
+            if featureOutputs:
+                saveBlockMaps(featureOutputs[0], featureStatistics.blockSize, maps)
+            manifest.record('features', featureInputs, featureParameters, featureOutputs,
+                            result=[str(value) for value in features])
+    else:
+        print "Bypassing wavelet analysis since its outputs are up to date"
 
     print('Done!')
+    if featureStatistics is not None:
+        caseName = os.path.split(os.path.normpath(workingDirectory))[1]
+        classification = 'Fractured' if simulateFracture else 'NotFractured'
+        return [caseName, waveletAnalysisDirectoryName, classification,
+                [str(value) for value in manifest.result('features')]]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import sys
+import time
+import traceback
+import multiprocessing
+
+'''
+Runs independent tasks of the tooth fracture pipeline (one (case, fracture plane) each, see MainScript.py) on a pool
+of worker processes.
+
+A task is a tuple (name, function, args, kwargs), function must be importable from a module so that it can be sent
+to the workers. The number of concurrent tasks is limited by the requested number of jobs and by the memory:
+each 0.085mm volume is large, so no more tasks run at once than fit in the available memory.
+A failing task does not stop the others: failures are collected and reported in a summary at the end.
+'''
+
+
+def availableMemory():
+    '''
+    Returns the memory available to new processes (in bytes), or None if unknown.
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def maxConcurrentJobs(jobs, memoryPerJob=None, memoryLimit=None):
+    '''
+    Number of tasks that can run at once: at most jobs, and no more than memoryLimit (default: the available
+    memory) can hold if each task uses memoryPerJob bytes. Always at least 1.
+    '''
+    if memoryLimit is None:
+        memoryLimit = availableMemory()
+    if memoryPerJob and memoryLimit:
+        jobs = min(jobs, int(memoryLimit // memoryPerJob))
+    return max(1, jobs)
+
+
+def runTask(task):
+    '''
+    Runs one task, returns (name, result, error, elapsed time). error is the formatted traceback if the task failed.
+    '''
+    name, function, args, kwargs = task
+    print 'Starting task: ' + name
+    start = time.time()
+    try:
+        result = function(*args, **kwargs)
+        return name, result, None, time.time() - start
+    except Exception:
+        return name, None, traceback.format_exc(), time.time() - start
+
+
+def printSummary(results, elapsed):
+    failures = [(name, error) for name, result, error, taskTime in results if error is not None]
+    print '========== Summary: %d tasks, %d succeeded, %d failed in %.1fs' % (len(results),
+                                                                            len(results) - len(failures),
+                                                                            len(failures), elapsed)
+    for name, result, error, taskTime in results:
+        print '%s %s (%.1fs)' % ('FAILED' if error is not None else 'OK    ', name, taskTime)
+    for name, error in failures:
+        print '---------- ' + name
+        print error
+
+
+def runTasks(tasks, jobs=1, memoryPerJob=None, memoryLimit=None, onResult=None, workerInitializer=None):
+    '''
+    Runs tasks on up to jobs worker processes (see maxConcurrentJobs()). onResult(name, result) is called in this
+    process as each task succeeds, in completion order. workerInitializer(jobs) is called in each worker process
+    when it starts (e.g. to share the CPUs between the workers).
+    Returns the list of (name, result, error, elapsed time) and prints a summary.
+    '''
+    start = time.time()
+    jobs = min(maxConcurrentJobs(jobs, memoryPerJob, memoryLimit), max(1, len(tasks)))
+    print 'Running %d tasks with %d concurrent jobs' % (len(tasks), jobs)
+    results = []
+    if jobs == 1:
+        taskResults = (runTask(task) for task in tasks)
+    else:
+        if workerInitializer is not None:
+            pool = multiprocessing.Pool(jobs, workerInitializer, (jobs,))
+        else:
+            pool = multiprocessing.Pool(jobs)
+        taskResults = pool.imap_unordered(runTask, tasks)
+    try:
+        for name, result, error, taskTime in taskResults:
+            results.append((name, result, error, taskTime))
+            if error is not None:
+                print >> sys.stderr, 'Task failed: ' + name
+                print >> sys.stderr, error
+            elif onResult is not None:
+                onResult(name, result)
+    except BaseException:
+        if jobs != 1:
+            pool.terminate()
+            pool.join()
+        raise
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    printSummary(results, time.time() - start)
+    return results
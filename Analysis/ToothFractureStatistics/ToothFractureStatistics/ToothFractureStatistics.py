@@ -90,6 +90,16 @@ class ToothFractureStatisticsWidget(ScriptedLoadableModuleWidget):
             "If checked, use n'th percentile value (chosen from above slider) as the feature value, else just the max.")
         parametersFormLayout.addRow("Use Percentile", self.enableScreenshotsFlagCheckBox)
 
+        #
+        # check box to record all the percentiles from the slider value to 100 in one pass
+        #
+        self.percentileSweepCheckBox = qt.QCheckBox()
+        self.percentileSweepCheckBox.checked = 0
+        self.percentileSweepCheckBox.setToolTip(
+            "If checked, record the max and every percentile from the slider value to 100 (in steps of 1) as features, "
+            "computed in one pass per wavelet, so that the percentile can be chosen later without running again.")
+        parametersFormLayout.addRow("Percentile Sweep", self.percentileSweepCheckBox)
+
         #
         # Apply Button
         #
@@ -118,7 +128,11 @@ class ToothFractureStatisticsWidget(ScriptedLoadableModuleWidget):
         usePercentiles = self.enableScreenshotsFlagCheckBox.checked
         percentileValue = self.imageThresholdSliderWidget.value
         outputFileName = self.outputFileName.text
-        logic.run(self.InputDirectorySelector.directory, outputFileName, percentileValue, usePercentiles)
+        percentiles = None
+        if self.percentileSweepCheckBox.checked:
+            percentiles = range(int(percentileValue), 101)
+        logic.run(self.InputDirectorySelector.directory, outputFileName, percentileValue, usePercentiles,
+                  percentiles=percentiles)
 
     def UpdateDirectoryButtonText(self, directory_button, length=40):
         dir_str = directory_button.directory
@@ -243,28 +257,40 @@ class ToothFractureStatisticsLogic(ScriptedLoadableModuleLogic):
             imagename = nodeName + '.nrrd'
             waveletImage = self.loadMRMLNode(nodeName, fullpath, imagename, 'VolumeFile')
             if waveletImage is not None:
-                waveletArray = abs(slicer.util.array(nodeName))
+                waveletArray = slicer.util.array(nodeName)
                 imageShape = waveletArray.shape
-                subimage = waveletArray[pad - 1:imageShape[0] - pad - 1, pad - 1:imageShape[1] - pad - 1,
-                           pad - 1:imageShape[2] - pad - 1]
-                if self.usePercentiles:
+                # Crop before abs() so that only the cropped region is copied
+                subimage = abs(waveletArray[pad - 1:imageShape[0] - pad - 1, pad - 1:imageShape[1] - pad - 1,
+                               pad - 1:imageShape[2] - pad - 1])
+                if subimage.size == 0:
+                    # Image smaller than the pad (deep level of the wavelets of a region): no value
+                    values = [float('nan')] * (1 + len(self.percentiles) if self.percentiles is not None else 1)
+                elif self.percentiles is not None:
+                    import numpy
+                    # All the percentiles in one partition of subimage (a copy, so it can be overwritten)
+                    values = [subimage.max()] + list(numpy.percentile(subimage, self.percentiles,
+                                                                      overwrite_input=True))
+                elif self.usePercentiles:
                     import numpy
-                    maxValue = numpy.percentile(subimage, self.percentileValue)
+                    values = [numpy.percentile(subimage, self.percentileValue)]
                 else:
-                    maxValue = subimage.max()
+                    values = [subimage.max()]
 
                 # report max
                 print 'image: ' + caseName + ' ' + waveletDirectory + ' ' + nodeName
-                print maxValue
+                print ' '.join(str(value) for value in values)
                 # create the row for csv file:
-                row.append(str(maxValue))
+                row += [str(value) for value in values]
                 # cleanup
                 slicer.mrmlScene.RemoveNode(waveletImage)
         csvWriter.writerow(row)
 
-    def run(self, inputDataDirectory, outputFileName, percentileValue, usePercentiles=False, enableScreenshots=0):
+    def run(self, inputDataDirectory, outputFileName, percentileValue, usePercentiles=False, enableScreenshots=0,
+            percentiles=None):
         """
     Run the actual algorithm
+    If percentiles (a list) is given, the max and these percentiles are recorded for each wavelet, in columns
+    wavelet<n>_max and wavelet<n>_p<percentile>.
     """
         # Find the first level directories in the input Directory which has directories by the names of
         # FracturedToothWavelet_0 and NoFractureToothWavelet
@@ -288,11 +314,16 @@ class ToothFractureStatisticsLogic(ScriptedLoadableModuleLogic):
 
         headerRow = ['Case Name', 'FractureNumber', 'Classification']
         for rangeNum in waveletRange:
-            headerRow.append('wavelet' + str(rangeNum))
+            if percentiles is not None:
+                headerRow.append('wavelet' + str(rangeNum) + '_max')
+                headerRow += ['wavelet' + str(rangeNum) + '_p%g' % percentile for percentile in percentiles]
+            else:
+                headerRow.append('wavelet' + str(rangeNum))
         cw.writerow(headerRow)
 
         self.usePercentiles = usePercentiles
         self.percentileValue = percentileValue
+        self.percentiles = percentiles
 
         # Process all the wavelet directories
         for path in paths:
@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import argparse
+import numpy
+from NrrdIO import readNrrd, readNrrdHeader, shape, spacing, spaceOrigin, direction
+from FeatureStore import FeatureStoreWriter, isFeatureStore
+
+'''
+Features computed on the wavelet images of the tooth fracture analysis.
+
+These are the statistics of the ToothFractureStatistics Slicer extension (max or percentile of |wavelet|, away from
+the image boundary), computed on NumPy arrays. They can be computed right after each inverse FFT of the wavelet
+analysis (see simulateFractureAndCreateWavelets in ToothFractureRoutines.py) so that the wavelet images do not have
+to be written and read back.
+
+The CSV file has the same layout as the one of ToothFractureStatistics:
+Case Name, FractureNumber, Classification, wavelet0, ..., wavelet15
+When several statistics are computed per wavelet, the wavelet columns are named wavelet<n>_<statistic>: max, p<p>
+(percentile p of |wavelet|), mean, std, energy (sum of squares), l1 (sum of |wavelet|), kurtosis (excess),
+h<i> (fraction of |wavelet| in bin i of a fixed histogram) and top<i> (i-th largest |wavelet|).
+Except for the percentiles, they are all accumulated in one sweep over chunks of the image (see sweepStatistics()),
+so that each wavelet image is read once whatever the number of statistics.
+
+Instead of cropping pad voxels, the statistics can be restricted to the tooth: the label map of the image (see
+LabelMask) is mapped on the grid of each wavelet image (the spacing of level l is spacing*2**l), optionally dilated,
+and only the voxels in the mask are reduced.
+
+For the localization of the fracture, each band can also be reduced to block maps (see blockMaps()): the max of
+|wavelet| and the energy of each block of blockSize**3 voxels, saved with saveBlockMaps() in
+<waveletDirectory>_blocks.npz next to the wavelet directory.
+
+Run as a script, this is a headless replacement of ToothFractureStatisticsLogic.run (no Slicer, no MRML scene): it
+reads the wavelet images of the same directory layout straight into NumPy and writes the same CSV file.
+    WaveletFeatures.py inputDataDirectory outputFileName [--percentile value | --percentiles 50:100:1]
+                       [--labelMask [--maskDilation mm]] [--moments] [--histogram bins max] [--topK k]
+                       [--blockSize voxels] [--scalePad]
+With --percentiles, the max and all the percentiles of each wavelet are computed in one pass and written to the CSV
+file, so that the percentile used by the ROC analysis can be chosen without extracting the features again.
+If outputFileName ends with .features, the features are written to a binary feature store (see FeatureStore.py)
+instead of the CSV file: same columns, no conversion of the values to text.
+'''
+
+# Used to counter the wavelet property/bug which somehow has an interpolation of the original image
+defaultPad = 20
+
+
+def cropPadded(waveletArray, pad=defaultPad):
+    '''
+    Same crop as ToothFractureStatisticsLogic.processCase. Empty if an axis has less than 2*pad voxels.
+    '''
+    imageShape = waveletArray.shape
+    return waveletArray[pad - 1:imageShape[0] - pad - 1, pad - 1:imageShape[1] - pad - 1,
+                        pad - 1:imageShape[2] - pad - 1]
+
+
+def sweepStatistics(subimage, useMax=True, moments=False, histogramBins=0, histogramMax=0.0, topK=0,
+                    chunkSize=2**22):
+    '''
+    Statistics of subimage accumulated over chunks of about chunkSize voxels along its first axis (each chunk is read
+    and converted once): returns (max of |x| or None, list of the other statistics), see statisticNames().
+    The histogram has histogramBins bins of the same width over [0, histogramMax[ for |x|, the last one also
+    counts the larger values.
+    '''
+    count = subimage.size
+    rows = max(1, chunkSize // max(1, count // max(1, subimage.shape[0])))
+    maximum = None
+    sums = numpy.zeros(4)
+    sumOfAbs = 0.0
+    histogram = numpy.zeros(histogramBins, dtype=numpy.int64)
+    top = numpy.zeros(0, dtype=subimage.dtype)
+    useAbs = histogramBins > 0 or topK > 0
+    for first in range(0, subimage.shape[0], rows):
+        chunk = subimage[first:first + rows]
+        if useMax:
+            chunkMaximum = max(chunk.max(), -chunk.min())
+            maximum = chunkMaximum if maximum is None else max(maximum, chunkMaximum)
+        if moments:
+            values = chunk.astype(numpy.float64).ravel()
+            power = values * values
+            sums += [values.sum(), power.sum(), (power * values).sum(), (power * power).sum()]
+            sumOfAbs += numpy.abs(values).sum()
+        if useAbs:
+            absChunk = numpy.abs(chunk).ravel()
+        if histogramBins > 0:
+            bins = numpy.minimum((absChunk * (histogramBins / float(histogramMax))).astype(numpy.int64),
+                                 histogramBins - 1)
+            histogram += numpy.bincount(bins, minlength=histogramBins)
+        if topK > 0:
+            # Only the k largest values of the chunk can be in the k largest values of the image
+            candidates = numpy.concatenate((top, absChunk))
+            if candidates.size > topK:
+                candidates = numpy.partition(candidates, candidates.size - topK)[candidates.size - topK:]
+            top = candidates
+    others = []
+    if moments:
+        mean = sums[0] / count
+        # Central moments from the raw moments (the wavelet bands have a mean close to 0)
+        variance = sums[1] / count - mean * mean
+        fourthMoment = sums[3] / count - 4 * mean * sums[2] / count + 6 * mean * mean * sums[1] / count - \
+                       3 * mean ** 4
+        kurtosis = fourthMoment / (variance * variance) - 3 if variance > 0 else numpy.nan
+        others += [mean, numpy.sqrt(max(variance, 0.0)), sums[1], sumOfAbs, kurtosis]
+    if histogramBins > 0:
+        others += list(histogram / float(count))
+    if topK > 0:
+        top = numpy.sort(top)[::-1]
+        others += list(top) + [numpy.nan] * (topK - top.size)
+    return maximum, others
+
+
+def statisticNames(useMax=True, percentiles=(), moments=False, histogramBins=0, topK=0):
+    return (['max'] if useMax else []) + ['p%g' % percentile for percentile in percentiles] + \
+           (['mean', 'std', 'energy', 'l1', 'kurtosis'] if moments else []) + \
+           ['h%d' % i for i in range(0, histogramBins)] + ['top%d' % i for i in range(1, topK + 1)]
+
+
+def waveletStatistics(waveletArray, useMax=True, percentiles=(), pad=defaultPad, mask=None, moments=False,
+                      histogramBins=0, histogramMax=0.0, topK=0):
+    '''
+    Returns the max (if useMax), the requested percentiles of |waveletArray| and the statistics of
+    sweepStatistics() (in the order of statisticNames()) once cropped by pad voxels, or, if mask (a boolean array
+    with the shape of waveletArray) is given, of the voxels in mask. NaN if there are no voxels left (mask empty, or
+    waveletArray too small for pad, e.g. the deepest levels of the wavelets of a region, see WaveletStatistics).
+    The values have the type numpy returns for them (float32 max for float32 wavelets), so that str() gives the
+    same text as ToothFractureStatistics.
+    '''
+    if mask is not None:
+        # Copy of the voxels of the mask only
+        subimage = waveletArray[mask]
+    else:
+        # Cropping first only touches the region the statistics are computed on (waveletArray can be memory mapped,
+        # see NrrdIO.readNrrd()). The max of |x| is computed without the copy made by abs().
+        subimage = cropPadded(waveletArray, pad)
+    if subimage.size == 0:
+        return [numpy.nan] * len(statisticNames(useMax, percentiles, moments, histogramBins, topK))
+    maximum, others = sweepStatistics(subimage, useMax, moments, histogramBins, histogramMax, topK)
+    values = [maximum] if useMax else []
+    if percentiles:
+        # All the percentiles in one partition of the (copied) |x|, instead of one sort per percentile
+        values += list(numpy.percentile(abs(subimage), list(percentiles), overwrite_input=True))
+    return values + others
+
+
+def blockMaps(waveletArray, blockSize, slabBlocks=4):
+    '''
+    Returns the max of |x| and the energy (sum of squares) of each block of blockSize**3 voxels of waveletArray, as
+    float32 arrays of shape ceil(waveletArray.shape / blockSize) (the last blocks along each axis are partial).
+    The blocks are reduced by reshaping slabs of slabBlocks block rows, so that waveletArray is read once.
+    '''
+    gridShape = [-(-size // blockSize) for size in waveletArray.shape]
+    maxMap = numpy.empty(gridShape, dtype=numpy.float32)
+    energyMap = numpy.empty(gridShape, dtype=numpy.float32)
+    for first in range(0, gridShape[0], slabBlocks):
+        last = min(gridShape[0], first + slabBlocks)
+        # Zero padding to whole blocks changes neither the max of |x| nor the energy
+        slab = numpy.zeros([(last - first) * blockSize] + [size * blockSize for size in gridShape[1:]],
+                           dtype=numpy.float32)
+        data = waveletArray[first * blockSize:last * blockSize]
+        slab[:data.shape[0], :data.shape[1], :data.shape[2]] = data
+        blocks = slab.reshape(last - first, blockSize, gridShape[1], blockSize, gridShape[2], blockSize)
+        numpy.abs(slab, out=slab)
+        maxMap[first:last] = blocks.max(axis=(1, 3, 5))
+        numpy.square(slab, out=slab)
+        energyMap[first:last] = blocks.sum(axis=(1, 3, 5), dtype=numpy.float64)
+    return maxMap, energyMap
+
+
+def blockMapsFileName(waveletDirectoryPath):
+    return os.path.normpath(waveletDirectoryPath) + '_blocks.npz'
+
+
+def saveBlockMaps(fileName, blockSize, maps):
+    '''
+    Saves the block maps of the wavelets of a directory: maps is a dictionary waveletNumber: (maxMap, energyMap,
+    geometry) where geometry is the Geometry of the wavelet image. The file has the arrays blockSize, max<n>,
+    energy<n>, and the origin<n>, spacing<n> and direction<n> of the wavelet image (the block [k, j, i] covers its
+    voxels [k*blockSize:(k+1)*blockSize, ...]).
+    '''
+    arrays = {'blockSize': numpy.array(blockSize)}
+    for waveletNumber, (maxMap, energyMap, geometry) in maps.items():
+        arrays.update({'max%d' % waveletNumber: maxMap, 'energy%d' % waveletNumber: energyMap,
+                       'origin%d' % waveletNumber: geometry.origin, 'spacing%d' % waveletNumber: geometry.spacing,
+                       'direction%d' % waveletNumber: geometry.direction})
+    # Written next to its final name so that an interrupted run does not leave a truncated file
+    temporaryFileName = fileName[:-len('.npz')] + '.tmp.npz'
+    numpy.savez(temporaryFileName, **arrays)
+    os.rename(temporaryFileName, fileName)
+
+
+def featureNames(waveletRange, useMax=True, percentiles=(), moments=False, histogramBins=0, topK=0):
+    waveletStatisticNames = statisticNames(useMax, percentiles, moments, histogramBins, topK)
+    names = []
+    for waveletNumber in waveletRange:
+        if len(waveletStatisticNames) == 1:
+            names.append('wavelet' + str(waveletNumber))
+        else:
+            names += ['wavelet' + str(waveletNumber) + '_' + name for name in waveletStatisticNames]
+    return names
+
+
+class WaveletStatistics(object):
+    '''
+    The statistics computed on each wavelet image (see waveletStatistics()). Instances can be sent to worker
+    processes.
+    If maskLabels is set, the statistics are computed on the voxels with these labels (dilated by maskDilation mm),
+    see LabelMask: the caller gives the mask of each wavelet image.
+    If blockSize is set, the caller also saves the block maps of each wavelet image (see blockMaps()).
+    If scalePad is set, the pad of a wavelet image of level l (see padForLevel()) is the pad of level 0 divided by
+    2**l, the same width in mm: for the wavelets of a region (waveletROIMargin of ToothFractureRoutines.py), whose
+    deepest levels are smaller than 2*pad voxels.
+    '''
+    def __init__(self, useMax=True, percentiles=(), pad=defaultPad, maskLabels=None, maskDilation=0.0, moments=False,
+                 histogramBins=0, histogramMax=0.0, topK=0, blockSize=None, scalePad=False):
+        if histogramBins > 0 and histogramMax <= 0:
+            raise ValueError('histogramMax must be positive')
+        self.useMax = useMax
+        self.percentiles = list(percentiles)
+        self.pad = pad
+        self.maskLabels = list(maskLabels) if maskLabels is not None else None
+        self.maskDilation = maskDilation
+        self.moments = moments
+        self.histogramBins = histogramBins
+        self.histogramMax = histogramMax
+        self.topK = topK
+        self.blockSize = blockSize
+        self.scalePad = scalePad
+
+    def __call__(self, waveletArray, mask=None, level=0):
+        return waveletStatistics(waveletArray, self.useMax, self.percentiles, self.padForLevel(level), mask,
+                                 self.moments, self.histogramBins, self.histogramMax, self.topK)
+
+    def padForLevel(self, level):
+        if not self.scalePad:
+            return self.pad
+        return max(1, -(-self.pad // 2**level))
+
+    def names(self, waveletRange):
+        return featureNames(waveletRange, self.useMax, self.percentiles, self.moments, self.histogramBins, self.topK)
+
+    def labelMask(self, labelArray, labelGeometry):
+        return LabelMask(labelArray, labelGeometry, self.maskLabels, self.maskDilation)
+
+    def parameters(self):
+        parameters = {'useMax': self.useMax, 'percentiles': self.percentiles, 'pad': self.pad}
+        if self.scalePad:
+            parameters['scalePad'] = True
+        if self.maskLabels is not None:
+            parameters.update({'maskLabels': self.maskLabels, 'maskDilation': self.maskDilation})
+        if self.moments or self.histogramBins > 0 or self.topK > 0:
+            parameters.update({'moments': self.moments, 'histogramBins': self.histogramBins,
+                               'histogramMax': self.histogramMax, 'topK': self.topK})
+        if self.blockSize is not None:
+            parameters['blockSize'] = self.blockSize
+        return parameters
+
+    def blockMaps(self, waveletArray):
+        return blockMaps(waveletArray, self.blockSize)
+
+
+class Geometry(object):
+    '''
+    Grid of an image: shape ([k, j, i]), origin, spacing ((i, j, k) order) and direction matrix, in LPS as in ITK
+    '''
+    def __init__(self, arrayShape, origin, spacing, direction):
+        self.shape = tuple(int(size) for size in arrayShape)
+        self.origin = numpy.array(origin, dtype=numpy.float64)
+        self.spacing = numpy.array(spacing, dtype=numpy.float64)
+        self.direction = numpy.array(direction, dtype=numpy.float64).reshape(3, 3)
+
+    def key(self):
+        return (self.shape, tuple(self.origin), tuple(self.spacing), tuple(self.direction.ravel()))
+
+    def indexToPhysicalPoint(self):
+        return self.direction.dot(numpy.diag(self.spacing))
+
+
+def nrrdGeometry(header):
+    return Geometry(shape(header), spaceOrigin(header), spacing(header), direction(header))
+
+
+def continuousIndex(sourceGeometry, geometry, firstSlice, lastSlice):
+    '''
+    Continuous index (i, j, k) in sourceGeometry of the voxels of the slices [firstSlice, lastSlice[ of geometry:
+    three arrays that broadcast to the shape of the slab ([k, j, i]).
+    '''
+    physicalPointToSourceIndex = numpy.linalg.inv(sourceGeometry.indexToPhysicalPoint())
+    # Continuous index in the source = transform.index + offset, with index = (i, j, k) in geometry
+    transform = physicalPointToSourceIndex.dot(geometry.indexToPhysicalPoint())
+    offset = physicalPointToSourceIndex.dot(geometry.origin - sourceGeometry.origin)
+    sizeK, sizeJ, sizeI = geometry.shape
+    index = [numpy.arange(0, sizeI).reshape(1, 1, sizeI),
+             numpy.arange(0, sizeJ).reshape(1, sizeJ, 1),
+             numpy.arange(firstSlice, lastSlice).reshape(lastSlice - firstSlice, 1, 1)]
+    return [transform[axis, 0] * index[0] + transform[axis, 1] * index[1] + transform[axis, 2] * index[2] +
+            offset[axis] for axis in range(0, 3)]
+
+
+class LabelMask(object):
+    '''
+    Mask of the voxels of a label map with a value in labels, mapped on the grid of each wavelet image: a wavelet
+    voxel is in the mask if its center is in a voxel of the label map in the mask (nearest neighbor), then the mask
+    is dilated by dilation mm (needs scipy). The masks are cached per grid, the images of a level share theirs.
+    '''
+    def __init__(self, labelArray, labelGeometry, labels=(1, 2), dilation=0.0, slabSize=16):
+        self.mask = numpy.in1d(labelArray, labels).reshape(labelArray.shape)
+        self.geometry = labelGeometry
+        self.dilation = dilation
+        self.slabSize = slabSize
+        self.masks = {}
+
+    def __call__(self, geometry):
+        key = geometry.key()
+        if key not in self.masks:
+            self.masks[key] = self.resample(geometry)
+        return self.masks[key]
+
+    def resample(self, geometry):
+        sizeK, sizeJ, sizeI = geometry.shape
+        labelShape = self.mask.shape
+        mask = numpy.zeros(geometry.shape, dtype=bool)
+        for firstSlice in range(0, sizeK, self.slabSize):
+            lastSlice = min(sizeK, firstSlice + self.slabSize)
+            labelIndex = [numpy.floor(index + 0.5).astype(numpy.int64)
+                          for index in continuousIndex(self.geometry, geometry, firstSlice, lastSlice)]
+            inside = numpy.ones((lastSlice - firstSlice, sizeJ, sizeI), dtype=bool)
+            for axis in range(0, 3):
+                inside &= (labelIndex[axis] >= 0) & (labelIndex[axis] < labelShape[2 - axis])
+            mask[firstSlice:lastSlice][inside] = self.mask[labelIndex[2][inside], labelIndex[1][inside],
+                                                           labelIndex[0][inside]]
+        if self.dilation > 0:
+            from scipy import ndimage
+            radius = [self.dilation / axisSpacing for axisSpacing in reversed(geometry.spacing)]
+            grid = numpy.ogrid[tuple(slice(-int(r), int(r) + 1) for r in radius)]
+            structure = sum((axisIndex / r) ** 2 for axisIndex, r in zip(grid, radius)) <= 1
+            mask = ndimage.binary_dilation(mask, structure)
+        return mask
+
+    @classmethod
+    def fromFile(cls, fileName, labels=(1, 2), dilation=0.0):
+        labelArray, header = readNrrd(fileName)
+        return cls(labelArray, nrrdGeometry(header), labels, dilation)
+
+
+class FeatureCSVWriter(object):
+    '''
+    Writes one row of wavelet features per (case, wavelet directory) to a CSV file, as soon as it is computed.
+    If append is True, an existing file with the same header is appended to, so that the healthy and the fractured
+    runs of MainScript.py can share one file.
+    '''
+    def __init__(self, csvFilePath, waveletRange, statistics, append=True):
+        self.statistics = statistics
+        headerRow = ['Case Name', 'FractureNumber', 'Classification'] + statistics.names(waveletRange)
+        if not append or not os.path.exists(csvFilePath) or os.path.getsize(csvFilePath) == 0:
+            append = False
+        else:
+            with open(csvFilePath, 'r') as f:
+                existingHeader = next(csv.reader(f))
+            if existingHeader != headerRow:
+                raise ValueError('%s exists with different columns' % csvFilePath)
+        self.csvFile = open(csvFilePath, 'a' if append else 'w')
+        self.csvWriter = csv.writer(self.csvFile, delimiter=',')
+        if not append:
+            self.csvWriter.writerow(headerRow)
+
+    def writeRow(self, caseName, waveletDirectory, classification, values):
+        self.csvWriter.writerow([caseName, waveletDirectory, classification] + [str(value) for value in values])
+        self.csvFile.flush()
+
+    def close(self):
+        self.csvFile.close()
+
+
+def createFeatureWriter(path, waveletRange, statistics, append=True):
+    '''
+    FeatureStore.FeatureStoreWriter if path is a feature store (<name>.features), or else FeatureCSVWriter
+    '''
+    if isFeatureStore(path):
+        return FeatureStoreWriter(path, waveletRange, statistics, append)
+    return FeatureCSVWriter(path, waveletRange, statistics, append)
+
+
+# Directory layout written by MainScript.py, read by ToothFractureStatistics
+noFractureDirectory = 'NoFractureToothWavelet'
+waveletDirectories = [noFractureDirectory] + ['FracturedToothWavelet_' + str(i) for i in range(0, 6)]
+waveletRange = range(0, 16)
+caseLabelImage = 'ToothCBCT-label.nrrd'
+
+
+def labelFileName(path, waveletDirectory):
+    '''
+    Label map of the image of a wavelet directory: the fractured label of the plane, or the label of the case
+    '''
+    if waveletDirectory == noFractureDirectory:
+        return os.path.join(path, caseLabelImage)
+    return os.path.join(path, 'fracturedToothLabel' + waveletDirectory[len('FracturedToothWavelet'):] + '.nrrd')
+
+
+def findCases(inputDataDirectory):
+    '''
+    Case directories are the directories containing both FracturedToothWavelet_0 and NoFractureToothWavelet
+    '''
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(inputDataDirectory):
+        if 'FracturedToothWavelet_0' in dirnames and noFractureDirectory in dirnames:
+            paths.append(dirpath)
+    return paths
+
+
+def processCase(path, waveletDirectory, waveletRange, classification, featureWriter):
+    '''
+    Writes the row of the wavelet directory. If one of its files (wavelet images, label map of the mask) is missing, no
+    row is written: returns the missing files (an empty list when the row was written).
+    '''
+    fullpath = os.path.join(path, waveletDirectory)
+    caseName = os.path.split(path)[1]
+    statistics = featureWriter.statistics
+    imagePaths = [os.path.join(fullpath, 'wavelet' + str(waveletNumber) + '.nrrd') for waveletNumber in waveletRange]
+    labelPath = labelFileName(path, waveletDirectory) if statistics.maskLabels is not None else None
+    missing = [fileName for fileName in imagePaths + [labelPath] if fileName is not None and
+               not os.path.exists(fileName)]
+    if missing:
+        print 'Missing files, skipping ' + fullpath + ': ' + ', '.join(missing)
+        return missing
+    labelMask = None
+    if labelPath is not None:
+        labelMask = LabelMask.fromFile(labelPath, statistics.maskLabels, statistics.maskDilation)
+    values = []
+    maps = {}
+    levelSpacing = None
+    for waveletNumber, imagePath in zip(waveletRange, imagePaths):
+        waveletArray, header = readNrrd(imagePath)
+        mask = labelMask(nrrdGeometry(header)) if labelMask is not None else None
+        # The spacing doubles at each level: the first wavelet of the directory is of level 0
+        if levelSpacing is None:
+            levelSpacing = spacing(header)[0]
+        level = int(round(numpy.log2(spacing(header)[0] / levelSpacing)))
+        waveletValues = statistics(waveletArray, mask, level)
+        if statistics.blockSize is not None:
+            maps[waveletNumber] = statistics.blockMaps(waveletArray) + (nrrdGeometry(header),)
+        print 'image: ' + caseName + ' ' + waveletDirectory + ' wavelet' + str(waveletNumber)
+        print ' '.join(str(value) for value in waveletValues)
+        values += waveletValues
+    featureWriter.writeRow(caseName, waveletDirectory, classification, values)
+    if statistics.blockSize is not None:
+        saveBlockMaps(blockMapsFileName(fullpath), statistics.blockSize, maps)
+    return []
+
+
+def parsePercentiles(text):
+    '''
+    Percentiles from 'start:stop:step' (stop included) or a comma separated list
+    '''
+    if ':' in text:
+        start, stop, step = [float(value) for value in text.split(':')]
+        return list(numpy.arange(start, stop + step / 2.0, step))
+    return [float(value) for value in text.split(',')]
+
+
+def run(inputDataDirectory, outputFileName, percentileValue, usePercentiles=False, percentiles=None, maskLabels=None,
+        maskDilation=0.0, moments=False, histogramBins=0, histogramMax=0.0, topK=0, blockSize=None, scalePad=False):
+    '''
+    Same processing and output as ToothFractureStatisticsLogic.run. If maskLabels is set, the statistics are computed
+    on these labels of the label map of each image (see LabelMask) instead of the cropped images. moments,
+    histogramBins, histogramMax and topK add the statistics of sweepStatistics(). If blockSize is set, the block maps
+    of each wavelet directory are saved next to it. scalePad: see WaveletStatistics.
+    The wavelet directories with missing files are skipped (no row) and listed at the end.
+    '''
+    paths = findCases(inputDataDirectory)
+    csvFilePath = os.path.join(inputDataDirectory, outputFileName)
+    options = {'maskLabels': maskLabels, 'maskDilation': maskDilation, 'moments': moments,
+               'histogramBins': histogramBins, 'histogramMax': histogramMax, 'topK': topK, 'blockSize': blockSize,
+               'scalePad': scalePad}
+    if percentiles is not None:
+        statistics = WaveletStatistics(True, percentiles, **options)
+    elif usePercentiles:
+        statistics = WaveletStatistics(False, [percentileValue], **options)
+    else:
+        statistics = WaveletStatistics(True, **options)
+    featureWriter = createFeatureWriter(csvFilePath, waveletRange, statistics, append=False)
+    skipped = []
+    try:
+        for path in paths:
+            for waveletDirectory in waveletDirectories:
+                className = 'NotFractured' if waveletDirectory == noFractureDirectory else 'Fractured'
+                if processCase(path, waveletDirectory, waveletRange, className, featureWriter):
+                    skipped.append(os.path.join(path, waveletDirectory))
+    finally:
+        featureWriter.close()
+    if skipped:
+        print 'Skipped %d wavelet directories with missing files: %s' % (len(skipped), ', '.join(skipped))
+    print 'Processing completed'
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+                                     description='Wavelet statistics of the tooth fracture data (headless '
+                                                 'ToothFractureStatistics)')
+    parser.add_argument('inputDataDirectory')
+    parser.add_argument('outputFileName', nargs='?', default='ToothFractureWaveletStatistics.csv',
+                        help='CSV file name, or feature store name (<name>.features, see FeatureStore.py), '
+                             'written in inputDataDirectory')
+    statisticsGroup = parser.add_mutually_exclusive_group()
+    statisticsGroup.add_argument('--percentile', type=float, default=None,
+                                 help='record this percentile of |wavelet| instead of the max')
+    statisticsGroup.add_argument('--percentiles', type=parsePercentiles, default=None,
+                                 help='record the max and these percentiles of |wavelet| (start:stop:step or a comma '
+                                      'separated list)')
+    parser.add_argument('--labelMask', action='store_true',
+                        help='compute the statistics on the tooth (labels 1 and 2 of fracturedToothLabel_<n>.nrrd or '
+                             + caseLabelImage + ') instead of cropping the image borders')
+    parser.add_argument('--maskDilation', type=float, default=0.0, help='dilation of the label mask (in mm)')
+    parser.add_argument('--moments', action='store_true',
+                        help='also record the mean, std, energy, l1 norm and kurtosis of each wavelet')
+    parser.add_argument('--histogram', type=float, nargs=2, default=(0, 0.0), metavar=('bins', 'max'),
+                        help='also record the histogram of |wavelet| with bins bins over [0, max[')
+    parser.add_argument('--topK', type=int, default=0, help='also record the k largest |wavelet| values')
+    parser.add_argument('--blockSize', type=int, default=None,
+                        help='also save the max and energy maps of blocks of this size (in voxels) of each wavelet')
+    parser.add_argument('--scalePad', action='store_true',
+                        help='divide the border crop by 2 at each level (for wavelets computed on a region of the '
+                             'tooth, whose deepest levels are smaller than the crop)')
+    args = parser.parse_args(argv[1:])
+    usePercentiles = args.percentile is not None
+    maskLabels = [1, 2] if args.labelMask else None
+    run(args.inputDataDirectory, args.outputFileName, args.percentile, usePercentiles, args.percentiles, maskLabels,
+        args.maskDilation, args.moments, int(args.histogram[0]), args.histogram[1], args.topK, args.blockSize,
+        args.scalePad)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -40,6 +40,7 @@ from sklearn.ensemble.base import BaseEnsemble, _partition_estimators
 
 
 __all__ = ["BlaggingClassifier",
+           "SingleClassSampleError",
                # TEF: No regressor has been implemented, though it would be
                # easy to do.
            ]
@@ -114,11 +115,17 @@ def _parallel_build_balanced_estimators(n_estimators, ensemble, X, y,
     return estimators, estimators_samples, estimators_features
 
 
+class SingleClassSampleError(ValueError):
+    """Raised when a bootstrap sample has no data point of one of the classes."""
+
+
 # TEF defined this simple downsampling routine.
 def _downsample(X, y):
         X = np.array(X)
         y = np.array(y)
         ccounts = Counter(y)                                # Get class counts
+        if len(ccounts) == 1:
+            raise SingleClassSampleError("The bootstrap sample only has one class")
         if len(ccounts) != 2:
             raise ValueError("BlaggingClassifier only implemented for 2 classes")
         # Identify minority and majority classes
@@ -0,0 +1,36 @@
+import os
+import sys
+import numpy
+import pytest
+
+'''
+Tests of the Analysis modules, run from Analysis with:
+    python -m pytest tests
+The ITK and scikit-learn tests are skipped when these packages are missing. The comparison of FractureSimulation.py
+with ToothFractureSimulation needs the tool built from Simulation/: TOOTH_FRACTURE_SIMULATION=<path of the tool>.
+'''
+
+# The modules of Analysis import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def toothCase(tmpdir):
+    '''
+    Small synthetic case written with NrrdIO: ToothCBCT.nrrd (short) with a bright tooth (label 1) around a dark pulp
+    (label 2), its label map ToothCBCT-label.nrrd, and a reference grid grid.nrrd with a finer spacing.
+    Returns the directory.
+    '''
+    from NrrdIO import writeNrrd
+    random_state = numpy.random.RandomState(0)
+    k, j, i = numpy.mgrid[0:20, 0:24, 0:22]
+    radius = numpy.sqrt((k - 10.0) ** 2 + (j - 12.0) ** 2 + (i - 11.0) ** 2)
+    label = numpy.where(radius < 4, 2, numpy.where(radius < 8, 1, 0)).astype(numpy.uint8)
+    image = (random_state.normal(100, 20, label.shape) + 1000 * (label == 1) + 300 * (label == 2)).astype(numpy.int16)
+    direction = numpy.eye(3)
+    origin = [1.0, -2.0, 0.5]
+    writeNrrd(str(tmpdir.join('ToothCBCT.nrrd')), image, origin, [0.3, 0.3, 0.3], direction)
+    writeNrrd(str(tmpdir.join('ToothCBCT-label.nrrd')), label, origin, [0.3, 0.3, 0.3], direction)
+    writeNrrd(str(tmpdir.join('grid.nrrd')), numpy.zeros((24, 28, 26), dtype=numpy.int16), origin, [0.25, 0.25, 0.25],
+              direction)
+    return str(tmpdir)
@@ -0,0 +1,75 @@
+import os
+import numpy
+import pytest
+from FeatureStore import FeatureStore, FeatureStoreWriter
+from WaveletFeatures import FeatureCSVWriter, WaveletStatistics
+
+
+def writeRows(writer, rows):
+    for row in rows:
+        writer.writeRow(*row)
+    writer.close()
+
+
+def featureRows(statistics, waveletRange, count):
+    random_state = numpy.random.RandomState(0)
+    rows = []
+    for case in range(0, count):
+        # The values as WaveletFeatures computes them: float32 max, float64 percentiles
+        values = []
+        for waveletNumber in waveletRange:
+            array = random_state.rand(50).astype(numpy.float32) * 1000
+            values += statistics(array.reshape(5, 5, 2), numpy.ones((5, 5, 2), dtype=bool))
+        rows.append(('case%d' % (case // 7), 'FracturedToothWavelet_%d' % (case % 7),
+                     'NotFractured' if case % 7 == 0 else 'Fractured', values))
+    return rows
+
+
+@pytest.mark.parametrize('count', [1, 10, 100])
+def testExportMatchesCSV(tmpdir, count):
+    waveletRange = range(0, 4)
+    statistics = WaveletStatistics(True, [50, 90])
+    rows = featureRows(statistics, waveletRange, count)
+    csvPath = str(tmpdir.join('features.csv'))
+    storePath = str(tmpdir.join('features.features'))
+    writeRows(FeatureCSVWriter(csvPath, waveletRange, statistics), rows)
+    writeRows(FeatureStoreWriter(storePath, waveletRange, statistics), rows)
+    FeatureStore(storePath).exportCSV(str(tmpdir.join('exported.csv')))
+    with open(csvPath, 'r') as f, open(str(tmpdir.join('exported.csv')), 'r') as exported:
+        assert exported.read() == f.read()
+
+
+def testAppendAndPending(tmpdir):
+    waveletRange = range(0, 2)
+    statistics = WaveletStatistics()
+    rows = featureRows(statistics, waveletRange, 5)
+    storePath = str(tmpdir.join('features.features'))
+    writeRows(FeatureStoreWriter(storePath, waveletRange, statistics), rows[:3])
+    writer = FeatureStoreWriter(storePath, waveletRange, statistics, append=True)
+    writeRows(writer, rows[3:])
+    store = FeatureStore(storePath)
+    assert store.rows == 5
+    assert list(store.column('Case Name')) == [row[0] for row in rows]
+    numpy.testing.assert_array_equal(store.column('wavelet1'), [row[3][1] for row in rows])
+    # Rows appended but not flushed are written before a column is read
+    store.append(list(rows[0][:3]) + rows[0][3], numericColumns=range(3, 5))
+    assert len(store.column('wavelet0')) == 6
+    assert FeatureStore(storePath).rows == 6
+
+
+def testReadFeaturesMatchesCSV(tmpdir):
+    ROCAnalysis = pytest.importorskip('ToothFractureROCAnalysis')
+    waveletRange = range(0, 4)
+    statistics = WaveletStatistics(True, [50])
+    rows = featureRows(statistics, waveletRange, 21)
+    csvPath = str(tmpdir.join('features.csv'))
+    storePath = str(tmpdir.join('features.features'))
+    writeRows(FeatureCSVWriter(csvPath, waveletRange, statistics), rows)
+    writeRows(FeatureStoreWriter(storePath, waveletRange, statistics), rows)
+    for selection in [{'columnRange': (3, -1)}, {'columns': ['wavelet*_max']}, {'columnRegex': ['wavelet[12]_.*']}]:
+        X, y, names = ROCAnalysis.readFeatureTable(csvPath, 'Classification', 'Fractured', **selection)
+        storeX, storeY, storeNames = ROCAnalysis.readFeatureStore(storePath, 'Classification', 'Fractured',
+                                                                  **selection)
+        assert storeNames == names
+        numpy.testing.assert_array_equal(storeY, y)
+        numpy.testing.assert_array_equal(storeX, X)
@@ -0,0 +1,74 @@
+import os
+import sys
+import subprocess
+from distutils.spawn import find_executable
+import numpy
+import pytest
+
+itk = pytest.importorskip('itk')
+import FractureSimulation
+from NrrdIO import readNrrd
+
+plane = [0.96, 0.0447, 0.2757, -2.79]
+
+
+def simulationTool():
+    '''
+    ToothFractureSimulation built from Simulation/: $TOOTH_FRACTURE_SIMULATION, or else found in the PATH
+    '''
+    tool = os.environ.get('TOOTH_FRACTURE_SIMULATION') or find_executable('ToothFractureSimulation')
+    if tool is None or not os.access(tool, os.X_OK):
+        pytest.skip('ToothFractureSimulation not built (set TOOTH_FRACTURE_SIMULATION)')
+    return tool
+
+
+def caseFiles(directory):
+    return [os.path.join(directory, name) for name in ('ToothCBCT.nrrd', 'grid.nrrd', 'ToothCBCT-label.nrrd')]
+
+
+def setThreads(numberOfThreads):
+    multiThreader = getattr(itk, 'MultiThreaderBase', None) or itk.MultiThreader
+    previous = multiThreader.GetGlobalDefaultNumberOfThreads()
+    multiThreader.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+    return previous
+
+
+def noiseArray(directory, seed):
+    simulator = FractureSimulation.createSimulator(*caseFiles(directory), noiseSeed=seed)
+    return numpy.array(simulator.noiseArray)
+
+
+def testNoiseDoesNotDependOnThreads(toothCase):
+    previous = setThreads(1)
+    try:
+        singleThread = noiseArray(toothCase, 0)
+        setThreads(4)
+        numpy.testing.assert_array_equal(noiseArray(toothCase, 0), singleThread)
+    finally:
+        setThreads(previous)
+    assert singleThread.std() > 0
+    assert not numpy.array_equal(noiseArray(toothCase, 1), singleThread)
+
+
+def testFractureOfTheTooth(toothCase):
+    image, label = FractureSimulation.createSimulator(*caseFiles(toothCase)).simulate(plane, 0.4)
+    labelArray = itk.GetArrayFromImage(label)
+    assert itk.GetArrayFromImage(image).shape == (24, 28, 26)
+    assert set(numpy.unique(labelArray)) <= {0, 1, 2}
+    assert (labelArray == 1).any()
+
+
+@pytest.mark.parametrize('seed', [None, 3])
+def testMatchesTool(toothCase, seed):
+    tool = simulationTool()
+    seedArguments = [str(seed)] if seed is not None else []
+    outputs = {}
+    script = os.path.splitext(FractureSimulation.__file__)[0] + '.py'
+    for name, command in [('tool', [tool]), ('python', [sys.executable, script])]:
+        imageFileName = os.path.join(toothCase, name + 'Image.nrrd')
+        labelFileName = os.path.join(toothCase, name + 'Label.nrrd')
+        subprocess.check_call(command + caseFiles(toothCase) + [imageFileName, labelFileName] +
+                              [str(value) for value in plane] + ['0.4'] + seedArguments)
+        outputs[name] = (readNrrd(imageFileName)[0], readNrrd(labelFileName)[0])
+    numpy.testing.assert_array_equal(outputs['python'][0], outputs['tool'][0])
+    numpy.testing.assert_array_equal(outputs['python'][1], outputs['tool'][1])
@@ -0,0 +1,59 @@
+import numpy
+import pytest
+
+itk = pytest.importorskip('itk')
+import ITKIsoWavelets
+
+
+def smallImage():
+    # Smooth blob plus noise: energy in all the bands. Sizes: multiples of 2**levels, different along each axis.
+    random_state = numpy.random.RandomState(0)
+    k, j, i = numpy.mgrid[0:24, 0:32, 0:16]
+    array = 100 * numpy.exp(-((k - 12.0) ** 2 + (j - 14.0) ** 2 + (i - 8.0) ** 2) / 20.0) + \
+            random_state.rand(24, 32, 16)
+    image = itk.GetImageFromArray(array.astype(numpy.float32))
+    image.SetSpacing([0.2, 0.25, 0.3])
+    image.SetOrigin([1.0, 2.0, 3.0])
+    return image
+
+
+def decomposition(image, lowMemory, cache, high_sub_bands=4, levels=2):
+    return [(nOutput, itk.GetArrayFromImage(waveletImage), tuple(waveletImage.GetSpacing()))
+            for nOutput, waveletImage in ITKIsoWavelets.iterateWavelets(image, high_sub_bands, levels, cache=cache,
+                                                                        lowMemory=lowMemory)]
+
+
+def testLowMemoryMatchesStandard():
+    image = smallImage()
+    standard = decomposition(image, False, ITKIsoWavelets.WaveletFilterCache())
+    lowMemory = decomposition(image, True, ITKIsoWavelets.WaveletFilterCache())
+    assert [nOutput for nOutput, array, spacing in standard] == range(0, 9)
+    assert [nOutput for nOutput, array, spacing in lowMemory] == range(0, 9)
+    for (nOutput, array, spacing), (lowNOutput, lowArray, lowSpacing) in zip(standard, lowMemory):
+        assert lowArray.shape == array.shape
+        assert lowSpacing == pytest.approx(spacing)
+        # Same up to float rounding
+        numpy.testing.assert_allclose(lowArray, array, rtol=0, atol=1e-4 * numpy.abs(array).max())
+
+
+def testFilterBanksReused():
+    image = smallImage()
+    cache = ITKIsoWavelets.WaveletFilterCache()
+    first = decomposition(image, False, cache)
+    memory = cache.memory()
+    assert memory > 0 and len(cache.entries) == 1
+    entry = cache.entries.values()[0]
+    banks = [id(filterImage) for level in sorted(entry['filterBanks']) for filterImage in entry['filterBanks'][level]]
+    second = decomposition(image, False, cache)
+    assert cache.memory() == memory
+    assert [id(filterImage) for level in sorted(entry['filterBanks'])
+            for filterImage in entry['filterBanks'][level]] == banks
+    for (nOutput, array, spacing), (secondNOutput, secondArray, secondSpacing) in zip(first, second):
+        numpy.testing.assert_array_equal(secondArray, array)
+
+
+def testCacheEviction():
+    cache = ITKIsoWavelets.WaveletFilterCache(maxMemory=1)
+    decomposition(smallImage(), False, cache)
+    # The entry is released after the decomposition, then evicted: it uses more than maxMemory
+    assert len(cache.entries) == 0
@@ -0,0 +1,62 @@
+import gzip
+import numpy
+import pytest
+from NrrdIO import readNrrd, readNrrdHeader, writeNrrd, shape, spacing, spaceOrigin, direction
+
+
+def writeAndRead(path, array, origin, arraySpacing, arrayDirection):
+    writeNrrd(path, array, origin, arraySpacing, arrayDirection)
+    return readNrrd(path)
+
+
+@pytest.mark.parametrize('dtype', [numpy.float32, numpy.float64, numpy.int16, numpy.uint8])
+def testRoundTrip(tmpdir, dtype):
+    array = (numpy.random.RandomState(0).rand(5, 6, 7) * 100).astype(dtype)
+    # Rotation around z, and a flip
+    arrayDirection = numpy.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, -1.0]])
+    readArray, header = writeAndRead(str(tmpdir.join('image.nrrd')), array, [1.5, -2.0, 3.25], [0.1, 0.2, 0.3],
+                                     arrayDirection)
+    assert readArray.dtype == array.dtype
+    assert shape(header) == array.shape
+    numpy.testing.assert_array_equal(readArray, array)
+    numpy.testing.assert_allclose(spacing(header), [0.1, 0.2, 0.3])
+    numpy.testing.assert_allclose(spaceOrigin(header), [1.5, -2.0, 3.25])
+    numpy.testing.assert_allclose(direction(header), arrayDirection)
+
+
+def testGzipAndDetachedData(tmpdir):
+    array = numpy.arange(2 * 3 * 4, dtype=numpy.float32).reshape(2, 3, 4)
+    writeNrrd(str(tmpdir.join('raw.nrrd')), array, [0.0, 0.0, 0.0], [1.0, 1.0, 1.0], numpy.eye(3))
+    with open(str(tmpdir.join('raw.nrrd')), 'rb') as f:
+        headerText, data = f.read().split('\n\n', 1)
+    # Same data, gzip encoded
+    with open(str(tmpdir.join('gzip.nrrd')), 'wb') as f:
+        f.write(headerText.replace('encoding: raw', 'encoding: gzip') + '\n\n')
+        with gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+            compressed.write(data)
+    numpy.testing.assert_array_equal(readNrrd(str(tmpdir.join('gzip.nrrd')))[0], array)
+    # Same data, in a detached data file
+    with open(str(tmpdir.join('detached.nhdr')), 'w') as f:
+        f.write(headerText + '\ndata file: detached.raw\n\n')
+    with open(str(tmpdir.join('detached.raw')), 'wb') as f:
+        f.write(data)
+    numpy.testing.assert_array_equal(readNrrd(str(tmpdir.join('detached.nhdr')))[0], array)
+
+
+def testITKGeometry(tmpdir):
+    itk = pytest.importorskip('itk')
+    array = numpy.random.RandomState(1).rand(4, 5, 6).astype(numpy.float32)
+    image = itk.GetImageFromArray(array)
+    image.SetSpacing([0.5, 0.25, 2.0])
+    image.SetOrigin([-1.0, 2.0, 3.0])
+    itk.imwrite(image, str(tmpdir.join('itk.nrrd')), True)
+    readArray, header = readNrrd(str(tmpdir.join('itk.nrrd')))
+    numpy.testing.assert_array_equal(readArray, array)
+    numpy.testing.assert_allclose(spacing(header), [0.5, 0.25, 2.0])
+    numpy.testing.assert_allclose(spaceOrigin(header), [-1.0, 2.0, 3.0])
+    # And back: ITK reads the files written by NrrdIO
+    writeNrrd(str(tmpdir.join('nrrdio.nrrd')), array, [-1.0, 2.0, 3.0], [0.5, 0.25, 2.0], numpy.eye(3))
+    itkImage = itk.imread(str(tmpdir.join('nrrdio.nrrd')))
+    numpy.testing.assert_array_equal(itk.GetArrayFromImage(itkImage), array)
+    numpy.testing.assert_allclose(list(itkImage.GetSpacing()), [0.5, 0.25, 2.0])
+    assert shape(readNrrdHeader(str(tmpdir.join('nrrdio.nrrd')))) == array.shape
@@ -0,0 +1,105 @@
+import os
+import PipelineManifest
+from PipelineManifest import Manifest, digestCache
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def setTime(path, offset):
+    # Modification times of the files written in a test can be equal: moved apart explicitly
+    status = os.stat(path)
+    os.utime(path, (status.st_atime, status.st_mtime + offset))
+
+
+def newProcess():
+    '''
+    Forgets the digest caches of this process, as a new process would
+    '''
+    PipelineManifest.digestCaches.clear()
+
+
+def recordedCase(tmpdir):
+    newProcess()
+    directory = str(tmpdir)
+    inputs = [os.path.join(directory, 'input.nrrd')]
+    outputs = [os.path.join(directory, 'output.nrrd')]
+    write(inputs[0], 'input')
+    write(outputs[0], 'output')
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    manifest.record('fracture', inputs, {'size': 0.4}, outputs)
+    return directory, inputs, outputs
+
+
+def testUpToDate(tmpdir):
+    directory, inputs, outputs = recordedCase(tmpdir)
+    newProcess()
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    assert manifest.isUpToDate('fracture', inputs, {'size': 0.4}, outputs)
+    assert not manifest.isUpToDate('wavelets', inputs, {'size': 0.4}, outputs)
+
+
+def testParameterChange(tmpdir):
+    directory, inputs, outputs = recordedCase(tmpdir)
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    assert not manifest.isUpToDate('fracture', inputs, {'size': 0.5}, outputs)
+
+
+def testInputChange(tmpdir):
+    directory, inputs, outputs = recordedCase(tmpdir)
+    write(inputs[0], 'other')
+    setTime(inputs[0], 10)
+    newProcess()
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    assert not manifest.isUpToDate('fracture', inputs, {'size': 0.4}, outputs)
+
+
+def testInputTouched(tmpdir):
+    # Same content: the stage is still up to date
+    directory, inputs, outputs = recordedCase(tmpdir)
+    setTime(inputs[0], 10)
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    assert manifest.isUpToDate('fracture', inputs, {'size': 0.4}, outputs)
+
+
+def testOutputChange(tmpdir):
+    directory, inputs, outputs = recordedCase(tmpdir)
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    write(outputs[0], 'modified')
+    setTime(outputs[0], 10)
+    assert not manifest.isUpToDate('fracture', inputs, {'size': 0.4}, outputs)
+    os.remove(outputs[0])
+    assert not manifest.isUpToDate('fracture', inputs, {'size': 0.4}, outputs)
+
+
+def testInvalidate(tmpdir):
+    directory, inputs, outputs = recordedCase(tmpdir)
+    manifest = Manifest(os.path.join(directory, 'pipelineManifest_plane.json'))
+    manifest.invalidate('fracture')
+    assert not Manifest(os.path.join(directory, 'pipelineManifest_plane.json')).isUpToDate(
+        'fracture', inputs, {'size': 0.4}, outputs)
+
+
+def testSharedDigests(tmpdir, monkeypatch):
+    '''
+    The manifests of a directory hash a shared input once, and the outputs are not hashed
+    '''
+    newProcess()
+    directory = str(tmpdir)
+    hashed = []
+    fileDigest = PipelineManifest.fileDigest
+    monkeypatch.setattr(PipelineManifest, 'fileDigest', lambda path: hashed.append(os.path.basename(path)) or
+                        fileDigest(path))
+    write(os.path.join(directory, 'input.nrrd'), 'input')
+    for plane in range(0, 3):
+        manifest = Manifest(os.path.join(directory, 'pipelineManifest_%d.json' % plane))
+        output = os.path.join(directory, 'output%d.nrrd' % plane)
+        write(output, 'output')
+        manifest.record('fracture', [os.path.join(directory, 'input.nrrd')], {'plane': plane}, [output])
+    assert hashed == ['input.nrrd']
+    # The hashes are kept for the next processes
+    newProcess()
+    assert digestCache(directory).digest(os.path.join(directory, 'input.nrrd')) is not None
+    assert hashed == ['input.nrrd']
@@ -0,0 +1,49 @@
+import numpy
+import pytest
+
+pytest.importorskip('sklearn')
+from sklearn.metrics import roc_auc_score
+import ToothFractureROCAnalysis as ROCAnalysis
+
+
+def scoresWithTies(seed, count=60):
+    random_state = numpy.random.RandomState(seed)
+    y = (random_state.rand(count) < 0.3).astype(int)
+    # Rounded so that many scores are tied, across the classes too
+    scores = numpy.round(random_state.rand(count) + 0.3 * y, 1)
+    return scores, y
+
+
+@pytest.mark.parametrize('seed', range(0, 5))
+def testRankAUC(seed):
+    scores, y = scoresWithTies(seed)
+    counts = numpy.ones((1, len(y)), dtype=numpy.int64)
+    auc = ROCAnalysis.rankAUC(*ROCAnalysis.rankCounts(scores, y, counts))
+    assert auc.shape == (1,)
+    assert auc[0] == pytest.approx(roc_auc_score(y, scores))
+
+
+def testRankAUCBootstrapCounts():
+    # A row of counts is the data set with counts[i] copies of data point i
+    scores, y = scoresWithTies(0)
+    counts = ROCAnalysis.bootstrapCounts(y, 20, numpy.random.RandomState(0))
+    aucs = ROCAnalysis.rankAUC(*ROCAnalysis.rankCounts(scores, y, counts))
+    for row, auc in zip(counts, aucs):
+        indices = numpy.repeat(numpy.arange(len(y)), row)
+        assert auc == pytest.approx(roc_auc_score(y[indices], scores[indices]))
+
+
+def testSelectColumns():
+    header = ['Case Name', 'FractureNumber', 'Classification', 'wavelet0', 'wavelet1', 'wavelet2']
+    assert ROCAnalysis.selectColumns(header, columnRange=(3, 5)) == [3, 4, 5]
+    assert ROCAnalysis.selectColumns(header, columnRange=(3, -1)) == [3, 4, 5]
+    assert ROCAnalysis.selectColumns(header, columnRange=(-2, -1)) == [4, 5]
+    assert ROCAnalysis.selectColumns(header, columns=['wavelet*'], columnRange=(0, 0)) == [0, 3, 4, 5]
+    with pytest.raises(ValueError):
+        ROCAnalysis.selectColumns(header, columnRange=(3, 6))
+
+
+def testSingleClassTraining():
+    X = numpy.random.RandomState(0).rand(10, 3)
+    with pytest.raises(ValueError):
+        ROCAnalysis.fitFold(ROCAnalysis.svm.SVC(), X, numpy.ones(10, dtype=int), numpy.random.RandomState(0))
@@ -9,41 +9,211 @@
 #include <itkNearestNeighborInterpolateImageFunction.h>
 #include <itkImageDuplicator.h>
 #include <string>
+#include <vector>
+#include <fstream>
+#include <sstream>
+
+typedef short PixelType;
+typedef itk::Image<PixelType,3> InputImageType;
+typedef itk::Image<unsigned char,3> LabelImageType;
+
+const PixelType darkLabel = 2;
+const PixelType toothLabel = 1;
+
+// One fracture: plane equation and output file names
+struct Fracture
+{
+  double a;
+  double b;
+  double c;
+  double d;
+  std::string outputFileName;
+  std::string outLabelFileName;
+};
+
+// Reads the planes file of the batch mode: one fracture per line, tab separated:
+// a b c d outputImage outputLabel
+// Empty lines and lines starting with '#' are skipped.
+bool ReadPlanes(const std::string &planesFileName, std::vector<Fracture> &fractures)
+{
+  std::ifstream planesFile(planesFileName.c_str());
+  if(!planesFile)
+  {
+    std::cerr << "Cannot read planes file: " << planesFileName << std::endl;
+    return false;
+  }
+  std::string line;
+  while(std::getline(planesFile, line))
+  {
+    if(line.empty() || line[0] == '#')
+    {
+      continue;
+    }
+    std::vector<std::string> fields;
+    std::istringstream lineStream(line);
+    std::string field;
+    while(std::getline(lineStream, field, '\t'))
+    {
+      fields.push_back(field);
+    }
+    if(fields.size() != 6)
+    {
+      std::cerr << "Expected 6 tab separated fields (a b c d outputImage outputLabel): " << line << std::endl;
+      return false;
+    }
+    Fracture fracture;
+    fracture.a=std::stod(fields[0]);
+    fracture.b=std::stod(fields[1]);
+    fracture.c=std::stod(fields[2]);
+    fracture.d=std::stod(fields[3]);
+    fracture.outputFileName=fields[4];
+    fracture.outLabelFileName=fields[5];
+    fractures.push_back(fracture);
+  }
+  return true;
+}
+
+// Simulates the fracture along one plane in copies of the resampled image and label map, and writes them.
+// The resampled images and the noise image are shared by all the planes of the case.
+void SimulateFracture(const InputImageType::Pointer &resampled, const LabelImageType::Pointer &labelResampled,
+                      const InputImageType::Pointer &noise, const Fracture &fracture, double displacement)
+{
+  double a=fracture.a;
+  double b=fracture.b;
+  double c=fracture.c;
+  double d=fracture.d;
+  itk::Vector<double,3> normal;
+  normal[0]=a;
+  normal[1]=b;
+  normal[2]=c;
+  normal.Normalize();
+  std::cout<<"Equation: "<<a<< " " <<b << " "<<c<<" "<<d<<std::endl;
+
+  // Copy input image
+  typedef itk::ImageDuplicator< InputImageType > DuplicatorType;
+  DuplicatorType::Pointer duplicator = DuplicatorType::New();
+  duplicator->SetInputImage(resampled);
+  duplicator->Update();
+  InputImageType::Pointer output=duplicator->GetOutput();
+
+  // Copy labelmap image
+  typedef itk::ImageDuplicator< LabelImageType > LabelDuplicatorType;
+  LabelDuplicatorType::Pointer labelDuplicator = LabelDuplicatorType::New();
+  labelDuplicator->SetInputImage(labelResampled);
+  labelDuplicator->Update();
+
+  // Iterate over plan image to generate region of space on one side of the plane
+  // This allows to verify the input equation of the plane
+  typedef itk::ImageRegionIteratorWithIndex<InputImageType> InputIteratorType;
+  typedef itk::ImageRegionIteratorWithIndex<LabelImageType> LabelIteratorType;
+  InputIteratorType itout(output,output->GetLargestPossibleRegion());
+  InputIteratorType itnoise(noise,noise->GetLargestPossibleRegion());
+  LabelIteratorType itmask(labelResampled,labelResampled->GetLargestPossibleRegion());
+
+  for(itmask.GoToBegin(), itnoise.GoToBegin(), itout.GoToBegin(); !itout.IsAtEnd(); ++itmask, ++itnoise, ++itout)
+  {
+    LabelImageType::IndexType index = itout.GetIndex();
+    itk::Point<double,3> point;
+    output->TransformIndexToPhysicalPoint(index, point);
+    // Plane equation is assumed to be in RAS coordinate space (Slicer/VTK)
+    // Point coordinates are in LPS (ITK)
+    // The plane equation is assumed to be of the form: ax+by+cz-d (See EasyClip extension in 3D Slicer)
+    double val = -a*point[0]-b*point[1]+c*point[2]-d;
+    if( std::abs(val) < displacement && itmask.Get() == toothLabel)
+    {
+      itout.Set(itnoise.Get());
+      continue;
+    }
+    itk::Vector<float,3> forwardDisplacement = normal*displacement;
+    // Invert displacement field if on "other" side of plane
+    if( val < 0)
+    {
+      forwardDisplacement = -forwardDisplacement;
+    }
+    point+=forwardDisplacement;
+    LabelImageType::IndexType displacedIndex;
+    output->TransformPhysicalPointToIndex(point,displacedIndex);
+    if(labelResampled->GetPixel(displacedIndex) == toothLabel)
+    {
+      itout.Set(resampled->GetPixel(index));
+      labelDuplicator->GetOutput()->SetPixel(index,toothLabel);
+    }
+  }
+
+  // Write output image
+  typedef itk::ImageFileWriter<InputImageType> WriterType;
+  WriterType::Pointer writer = WriterType::New();
+  writer->SetInput(output);
+  writer->SetFileName(fracture.outputFileName);
+  writer->Update();
+
+  // Write output label map
+  typedef itk::ImageFileWriter<LabelImageType> LabelWriterType;
+  LabelWriterType::Pointer labelWriter = LabelWriterType::New();
+  labelWriter->SetInput(labelDuplicator->GetOutput());
+  labelWriter->SetFileName(fracture.outLabelFileName);
+  labelWriter->Update();
+}
 
 int main(int argc, char* argv[])
 {
-  if(argc != 11 )
+  bool batch = (argc == 7 || argc == 8) && std::string(argv[1]) == "--planes";
+  if(argc != 11 && argc != 12 && !batch)
   {
-    std::cerr << "Usage: " << argv[0] << "input reference label outputImage outputLabel a b c d displacement" << std::endl;
+    std::cerr << "Usage: " << argv[0] << "input reference label outputImage outputLabel a b c d displacement [seed]" << std::endl;
+    std::cerr << "       " << argv[0] << "--planes planesFile input reference label displacement [seed]" << std::endl;
     std::cerr << "a b c d: plane equation" << std::endl;
     std::cerr << "label: 1=tooth, 2=dark/fracture" << std::endl;
     std::cerr << "Reference image: used to resample output image" << std::endl;
+    std::cerr << "planesFile: one fracture per line, tab separated: a b c d outputImage outputLabel" << std::endl;
+    std::cerr << "            (the images are resampled and the noise is generated once for all the planes)" << std::endl;
+    std::cerr << "seed: seed of the noise (default: 0, the same noise on every run)" << std::endl;
     return 1;
   }
-  typedef short PixelType;
-  PixelType darkLabel = 2;
-  PixelType toothLabel = 1;
   double standardDeviationCorrectionFactor = 5;
   // Parameters
-  std::string inputFileName=argv[1];
-  std::string referenceFileName=argv[2];
-  std::string labelFileName=argv[3];
-  std::string outputFileName=argv[4];
-  std::string outLabelFileName=argv[5];
-  // Plane equation parameters
-  double a=std::stod(argv[6]);
-  double b=std::stod(argv[7]);
-  double c=std::stod(argv[8]);
-  double d=std::stod(argv[9]);
-  double displacement=std::stod(argv[10]);
-  itk::Vector<double,3> normal;
-  normal[0]=a;
-  normal[1]=b;
-  normal[2]=c;
-  normal.Normalize();
-  std::cout<<"Equation: "<<a<< " " <<b << " "<<c<<" "<<d<<std::endl;
+  std::vector<Fracture> fractures;
+  std::string inputFileName;
+  std::string referenceFileName;
+  std::string labelFileName;
+  double displacement;
+  int seed = 0;
+  if(batch)
+  {
+    if(!ReadPlanes(argv[2], fractures))
+    {
+      return 1;
+    }
+    inputFileName=argv[3];
+    referenceFileName=argv[4];
+    labelFileName=argv[5];
+    displacement=std::stod(argv[6]);
+    if(argc == 8)
+    {
+      seed=std::stoi(argv[7]);
+    }
+  }
+  else
+  {
+    inputFileName=argv[1];
+    referenceFileName=argv[2];
+    labelFileName=argv[3];
+    // Plane equation parameters
+    Fracture fracture;
+    fracture.outputFileName=argv[4];
+    fracture.outLabelFileName=argv[5];
+    fracture.a=std::stod(argv[6]);
+    fracture.b=std::stod(argv[7]);
+    fracture.c=std::stod(argv[8]);
+    fracture.d=std::stod(argv[9]);
+    fractures.push_back(fracture);
+    displacement=std::stod(argv[10]);
+    if(argc == 12)
+    {
+      seed=std::stoi(argv[11]);
+    }
+  }
   // read input image
-  typedef itk::Image<PixelType,3> InputImageType;
   typedef itk::ImageFileReader<InputImageType> InputReaderType;
   InputReaderType::Pointer reader = InputReaderType::New();
   reader->SetFileName(inputFileName);
@@ -62,16 +232,8 @@ int main(int argc, char* argv[])
   resample->SetReferenceImage(referenceReader->GetOutput());
   resample->UseReferenceImageOn();
   resample->Update();
-  
-  // Copy input image
-  typedef itk::ImageDuplicator< InputImageType > DuplicatorType;
-  DuplicatorType::Pointer duplicator = DuplicatorType::New();
-  duplicator->SetInputImage(resample->GetOutput());
-  duplicator->Update();
-  InputImageType::Pointer output=duplicator->GetOutput();
-  
+
   // Read label map (region to deform)
-  typedef itk::Image<unsigned char,3> LabelImageType;
   typedef itk::ImageFileReader<LabelImageType> LabelReaderType;
   LabelReaderType::Pointer labelReader = LabelReaderType::New();
   labelReader->SetFileName(labelFileName);
@@ -87,13 +249,6 @@ int main(int argc, char* argv[])
   labelResample->UseReferenceImageOn();
   labelResample->Update();
   
-  
-  // Copy labelmap image
-  typedef itk::ImageDuplicator< LabelImageType > LabelDuplicatorType;
-  LabelDuplicatorType::Pointer labelDuplicator = LabelDuplicatorType::New();
-  labelDuplicator->SetInputImage(labelResample->GetOutput());
-  labelDuplicator->Update();
-  
   // Compute tooth mask
   LabelImageType::Pointer toothMask;
   typedef itk::ThresholdImageFilter<LabelImageType> ThresholdFilterType;
@@ -123,6 +278,15 @@ int main(int argc, char* argv[])
   typedef itk::AdditiveGaussianNoiseImageFilter<NoiseImageType,NoiseImageType> NoiseFilterType;
   NoiseFilterType::Pointer noiseFilter = NoiseFilterType::New();
   noiseFilter->SetInput(noise);
+  // Seeded so that the noise, and the fractured images, are the same for the batch and the single plane runs
+  noiseFilter->SetSeed(seed);
+  // The filter seeds a generator per region it splits the image in: a single region, so that the noise does not
+  // depend on the number of threads
+#if ITK_VERSION_MAJOR >= 5
+  noiseFilter->SetNumberOfWorkUnits(1);
+#else
+  noiseFilter->SetNumberOfThreads(1);
+#endif
   noiseFilter->SetMean(mean);
   noiseFilter->SetStandardDeviation(std/standardDeviationCorrectionFactor);
   noiseFilter->Update();
@@ -130,59 +294,13 @@ int main(int argc, char* argv[])
   ClampFilterType::Pointer clampFilter = ClampFilterType::New();
   clampFilter->SetInput(noiseFilter->GetOutput());
   clampFilter->Update();
-  
-  
-  // Iterate over plan image to generate region of space on one side of the plane
-  // This allows to verify the input equation of the plane
-  typedef itk::ImageRegionIteratorWithIndex<InputImageType> InputIteratorType;
-  typedef itk::ImageRegionIteratorWithIndex<LabelImageType> LabelIteratorType;
-  InputIteratorType itout(output,output->GetLargestPossibleRegion());
-  InputIteratorType itnoise(clampFilter->GetOutput(),clampFilter->GetOutput()->GetLargestPossibleRegion());
-  LabelIteratorType itmask(labelResample->GetOutput(),labelResample->GetOutput()->GetLargestPossibleRegion());
 
-  for(itmask.GoToBegin(), itnoise.GoToBegin(), itout.GoToBegin(); !itout.IsAtEnd(); ++itmask, ++itnoise, ++itout)
+  // The resampled images and the noise are computed once, shared by all the fractures
+  for(std::vector<Fracture>::const_iterator fracture = fractures.begin(); fracture != fractures.end(); ++fracture)
   {
-    LabelImageType::IndexType index = itout.GetIndex();
-    itk::Point<double,3> point;
-    output->TransformIndexToPhysicalPoint(index, point);
-    // Plane equation is assumed to be in RAS coordinate space (Slicer/VTK)
-    // Point coordinates are in LPS (ITK)
-    // The plane equation is assumed to be of the form: ax+by+cz-d (See EasyClip extension in 3D Slicer)
-    double val = -a*point[0]-b*point[1]+c*point[2]-d;
-    if( std::abs(val) < displacement && itmask.Get() == toothLabel)
-    {
-      itout.Set(itnoise.Get());
-      continue;
-    }
-    itk::Vector<float,3> forwardDisplacement = normal*displacement;
-    // Invert displacement field if on "other" side of plane
-    if( val < 0)
-    {
-      forwardDisplacement = -forwardDisplacement;
-    }
-    point+=forwardDisplacement;
-    LabelImageType::IndexType displacedIndex;
-    output->TransformPhysicalPointToIndex(point,displacedIndex);
-    if(labelResample->GetOutput()->GetPixel(displacedIndex) == toothLabel)
-    {
-      itout.Set(resample->GetOutput()->GetPixel(index));
-      labelDuplicator->GetOutput()->SetPixel(index,toothLabel);
-    }
+    SimulateFracture(resample->GetOutput(), labelResample->GetOutput(), clampFilter->GetOutput(), *fracture,
+                     displacement);
   }
- 
-  // Write output image 
-  typedef itk::ImageFileWriter<InputImageType> WriterType;
-  WriterType::Pointer writer = WriterType::New();
-  writer->SetInput(output);
-  writer->SetFileName(outputFileName);
-  writer->Update();
- 
-  // Write output label map
-  typedef itk::ImageFileWriter<LabelImageType> LabelWriterType;
-  LabelWriterType::Pointer labelWriter = LabelWriterType::New();
-  labelWriter->SetInput(labelDuplicator->GetOutput());
-  labelWriter->SetFileName(outLabelFileName);
-  labelWriter->Update();
   
   return 0;
 }